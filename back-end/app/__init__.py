@@ -1,45 +1,94 @@
-import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler
-import os
 from flask import Flask, request, current_app
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
-from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
-from elasticsearch import Elasticsearch
-from redis import Redis
-import rq
+from werkzeug.utils import cached_property
 from config import Config
-
-db = SQLAlchemy()
+from app import logs
+from app.assets import Assets
+from app.cache import bytecode_cache, QueryCache
+from app.compression import Compression
+from app.profiler import Profiler
+from app.ratelimit import RateLimiter
+from app.replicas import RoutingSQLAlchemy, Replicas
+from app.resilience import Breakers, Mail, guarded_redis
+
+db = RoutingSQLAlchemy()
+replicas = Replicas(db=db)
+query_cache = QueryCache(db=db)
 migrate = Migrate()
 login = LoginManager()
 login.login_view = 'auth.login'
 login.login_message = _l('Please log in to access this page.')
 mail = Mail()
+breakers = Breakers()
+sampler = Profiler()
+limiter = RateLimiter()
+static_assets = Assets()
+compression = Compression()
 bootstrap = Bootstrap()
 moment = Moment()
 babel = Babel()
 
 
+class Application(Flask):
+    def get_send_file_max_age(self, filename):
+        # built assets have the hash of their content in the name
+        if filename.startswith(self.config['ASSETS_OUTPUT'] + '/'):
+            return self.config['ASSETS_MAX_AGE']
+        return super(Application, self).get_send_file_max_age(filename)
+
+    @cached_property
+    def elasticsearch(self):
+        if not self.config['ELASTICSEARCH_URL']:
+            return None
+        from elasticsearch import Elasticsearch
+        return Elasticsearch([self.config['ELASTICSEARCH_URL']],
+                             timeout=self.config['ELASTICSEARCH_TIMEOUT'],
+                             max_retries=0)
+
+    @cached_property
+    def redis(self):
+        return guarded_redis(
+            self.config['REDIS_URL'], self.extensions['breakers']['redis'],
+            socket_timeout=self.config['REDIS_TIMEOUT'],
+            socket_connect_timeout=self.config['REDIS_TIMEOUT'])
+
+    @cached_property
+    def task_queues(self):
+        import rq
+        return {name: rq.Queue(name, connection=self.redis)
+                for name in self.config['TASK_QUEUES']}
+
+    def enqueue(self, name, *args, **kwargs):
+        queue = self.config['TASK_ROUTES'].get(
+            name, self.config['TASK_DEFAULT_QUEUE'])
+        return self.task_queues[queue].enqueue(name, *args, **kwargs)
+
+
 def create_app(config_class=Config):
-    app = Flask(__name__)
+    app = Application(__name__)
     app.config.from_object(config_class)
 
+    # first, so that requests that other hooks turn down are logged too
+    logs.init_app(app)
     db.init_app(app)
+    replicas.init_app(app)
+    query_cache.init_app(app)
     migrate.init_app(app, db)
     login.init_app(app)
     mail.init_app(app)
+    breakers.init_app(app)
+    sampler.init_app(app)
+    limiter.init_app(app)
+    static_assets.init_app(app)
+    compression.init_app(app)
     bootstrap.init_app(app)
     moment.init_app(app)
     babel.init_app(app)
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
-        if app.config['ELASTICSEARCH_URL'] else None
-    app.redis = Redis.from_url(app.config['REDIS_URL'])
-    app.task_queue = rq.Queue('erp-crm-tasks', connection=app.redis)
+    app.jinja_env.bytecode_cache = bytecode_cache(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -56,41 +105,6 @@ def create_app(config_class=Config):
     from app.api import bp as api_bp
     app.register_blueprint(api_bp, url_prefix='/api')
 
-    if not app.debug and not app.testing:
-        if app.config['MAIL_SERVER']:
-            auth = None
-            if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
-                auth = (app.config['MAIL_USERNAME'],
-                        app.config['MAIL_PASSWORD'])
-            secure = None
-            if app.config['MAIL_USE_TLS']:
-                secure = ()
-            mail_handler = SMTPHandler(
-                mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
-                fromaddr='no-reply@' + app.config['MAIL_SERVER'],
-                toaddrs=app.config['ADMINS'], subject='erp-crm Failure',
-                credentials=auth, secure=secure)
-            mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
-
-        if app.config['LOG_TO_STDOUT']:
-            stream_handler = logging.StreamHandler()
-            stream_handler.setLevel(logging.INFO)
-            app.logger.addHandler(stream_handler)
-        else:
-            if not os.path.exists('logs'):
-                os.mkdir('logs')
-            file_handler = RotatingFileHandler('logs/erp-crm.log',
-                                               maxBytes=10240, backupCount=10)
-            file_handler.setFormatter(logging.Formatter(
-                '%(asctime)s %(levelname)s: %(message)s '
-                '[in %(pathname)s:%(lineno)d]'))
-            file_handler.setLevel(logging.INFO)
-            app.logger.addHandler(file_handler)
-
-        app.logger.setLevel(logging.INFO)
-        app.logger.info('erp-crm startup')
-
     return app
 
 
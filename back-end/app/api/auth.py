@@ -1,3 +1,4 @@
+from flask import g
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 from app.models import User
 from app.api.errors import error_response
@@ -20,6 +21,9 @@ def basic_auth_error(status):
 
 @token_auth.verify_token
 def verify_token(token):
+    if g.get('batch_user') is not None:
+        # sub-requests of a batch, authenticated once for the whole batch
+        return g.batch_user
     return User.check_token(token) if token else None
 
 
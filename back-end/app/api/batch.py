@@ -0,0 +1,110 @@
+from concurrent.futures import ThreadPoolExecutor
+import sys
+from flask import current_app, g, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.urls import url_unquote
+from app import db
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request, error_response
+from app.replicas import READ_ONLY_METHODS
+from app.serialization import json_response, RawJSON
+
+METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE')
+FORWARDED_HEADERS = ('Accept', 'Idempotency-Key')
+
+
+def is_batch(app, path):
+    """Whether path routes to this view, however it is spelled."""
+    try:
+        endpoint = app.url_map.bind('localhost').match(
+            url_unquote(path.split('?')[0]), 'POST')[0]
+    except HTTPException:
+        return False
+    return endpoint == 'api.batch'
+
+
+def run_request(app, item):
+    headers = {name: value for name, value in item.get('headers', {}).items()
+               if name in FORWARDED_HEADERS}
+    headers['Authorization'] = g.batch_authorization
+    with app.test_request_context(item['path'], method=item['method'],
+                                  json=item.get('body'), headers=headers):
+        try:
+            response = app.full_dispatch_request()
+        except Exception:
+            app.log_exception(sys.exc_info())
+            response = error_response(500)
+        body = response.get_data(as_text=True)
+    return {
+        'status': response.status_code,
+        'headers': {name: value for name, value in response.headers
+                    if name != 'Content-Length'},
+        'body': RawJSON(body) if response.is_json and body else body or None
+    }
+
+
+def run_in_context(app, user, authorization, item):
+    """Run a request with its own app context and database session, so that
+    a request that fails half way leaves nothing behind for the next one."""
+    with app.app_context():
+        g.batch_user = db.session.merge(user, load=False)
+        g.batch_authorization = authorization
+        try:
+            return run_request(app, item)
+        finally:
+            db.session.remove()
+
+
+def run_parallel(app, user, authorization, items):
+    if len(items) == 1:
+        return [run_in_context(app, user, authorization, items[0])]
+    workers = min(len(items), app.config['BATCH_MAX_WORKERS'])
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(
+            lambda item: run_in_context(app, user, authorization, item),
+            items))
+
+
+@bp.route('/batch', methods=['POST'])
+@token_auth.login_required
+def batch():
+    """Run a list of API requests with a single authentication. Reads that
+    follow each other run in parallel, writes run one at a time in order."""
+    items = request.get_json()
+    if not isinstance(items, list) or not items:
+        return bad_request('must be a list of requests')
+    if len(items) > current_app.config['BATCH_MAX_REQUESTS']:
+        return bad_request('at most {} requests per batch'.format(
+            current_app.config['BATCH_MAX_REQUESTS']))
+    # requests of a batch see the g.batch_user of their batch
+    if g.get('batch_user') is not None:
+        return bad_request('batches can not be nested')
+    app = current_app._get_current_object()
+    for item in items:
+        if not isinstance(item, dict) or \
+                not str(item.get('path', '')).startswith('/api/'):
+            return bad_request('each request needs an /api/ path')
+        item['method'] = str(item.get('method', 'GET')).upper()
+        if item['method'] not in METHODS:
+            return bad_request('unsupported method ' + item['method'])
+        if is_batch(app, item['path']):
+            return bad_request('batches can not be nested')
+        if not isinstance(item.get('headers', {}), dict):
+            return bad_request('headers must be an object')
+
+    user = token_auth.current_user()
+    authorization = request.headers['Authorization']
+    results = []
+    reads = []
+    for item in items:
+        if item['method'] in READ_ONLY_METHODS:
+            reads.append(item)
+            continue
+        if reads:
+            results += run_parallel(app, user, authorization, reads)
+            reads = []
+        results.append(run_in_context(app, user, authorization, item))
+    if reads:
+        results += run_parallel(app, user, authorization, reads)
+    return json_response(results)
@@ -0,0 +1,194 @@
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from flask import request, url_for, abort
+from app import db
+from app.models import User, Board, BoardColumn, Card, PipelineRollup
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request
+from app.serialization import json_response
+
+
+def get_owned(model, id):
+    obj = model.query.get_or_404(id)
+    board = obj if isinstance(obj, Board) else obj.board
+    if board.owner_id != token_auth.current_user().id:
+        abort(403)
+    return obj
+
+
+def is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def validate_card(data):
+    for field in ('title', 'description'):
+        if data.get(field) is not None and not isinstance(data[field], str):
+            abort(bad_request('invalid ' + field))
+    try:
+        value = Decimal(str(data.get('value') or 0))
+    except InvalidOperation:
+        abort(bad_request('invalid value'))
+    # the value column holds up to 12 digits, 2 of them decimals
+    if not value.is_finite() or abs(value) >= 10 ** 10:
+        abort(bad_request('invalid value'))
+    if 'status' in data and data['status'] not in Card.STATUSES:
+        abort(bad_request('invalid status'))
+    if data.get('owner_id') is not None and (
+            not is_id(data['owner_id']) or
+            User.query.get(data['owner_id']) is None):
+        abort(bad_request('invalid owner_id'))
+
+
+def move_card(card, board, data):
+    """Place card as requested by the column_id, after_id and before_id
+    fields of data, within the given board."""
+    for field in ('column_id', 'after_id', 'before_id'):
+        if data.get(field) is not None and not is_id(data[field]):
+            abort(bad_request('invalid ' + field))
+    column = BoardColumn.query.get(data.get('column_id') or card.column_id)
+    if column is None or column.board_id != board.id:
+        abort(bad_request('invalid column'))
+    neighbours = {}
+    for field in ('after_id', 'before_id'):
+        if data.get(field) is not None:
+            neighbour = Card.query.get(data[field])
+            if neighbour is None or neighbour.column_id != column.id or \
+                    neighbour is card:
+                abort(bad_request('invalid ' + field))
+            neighbours[field[:-3]] = neighbour
+    try:
+        card.place(column, **neighbours)
+    except ValueError:
+        # the neighbours do not sort as they should, such as when they are
+        # moving in a concurrent request
+        abort(bad_request('invalid position'))
+
+
+@bp.route('/boards', methods=['GET'])
+@token_auth.login_required
+def get_boards():
+    boards = Board.query.filter_by(
+        owner_id=token_auth.current_user().id).order_by(Board.id)
+    return json_response({'items': [board.to_dict() for board in boards]})
+
+
+@bp.route('/boards', methods=['POST'])
+@token_auth.login_required
+def create_board():
+    data = request.get_json() or {}
+    if not data.get('name'):
+        return bad_request('must include name field')
+    board = Board(name=data['name'], owner_id=token_auth.current_user().id)
+    db.session.add(board)
+    for position, name in enumerate(data.get('columns') or []):
+        db.session.add(BoardColumn(board=board, name=name, position=position))
+    db.session.commit()
+    response = json_response(board.to_dict(Board.load(board.id)[1]), 201)
+    response.headers['Location'] = url_for('api.get_board', id=board.id)
+    return response
+
+
+@bp.route('/boards/<int:id>', methods=['GET'])
+@token_auth.login_required
+def get_board(id):
+    loaded = Board.load(id)
+    if loaded is None:
+        abort(404)
+    board, columns = loaded
+    if board.owner_id != token_auth.current_user().id:
+        abort(403)
+    return json_response(board.to_dict(columns))
+
+
+@bp.route('/boards/<int:id>/columns', methods=['POST'])
+@token_auth.login_required
+def create_column(id):
+    board = get_owned(Board, id)
+    data = request.get_json() or {}
+    if not data.get('name'):
+        return bad_request('must include name field')
+    position = db.session.query(db.func.max(BoardColumn.position)).filter(
+        BoardColumn.board_id == board.id).scalar()
+    column = BoardColumn(board=board, name=data['name'],
+                         position=0 if position is None else position + 1)
+    db.session.add(column)
+    db.session.commit()
+    return json_response(column.to_dict(), 201)
+
+
+@bp.route('/boards/<int:id>/cards', methods=['POST'])
+@token_auth.login_required
+def create_card(id):
+    board = get_owned(Board, id)
+    data = request.get_json() or {}
+    if not data.get('title') or not data.get('column_id'):
+        return bad_request('must include title and column_id fields')
+    validate_card(data)
+    card = Card(owner_id=token_auth.current_user().id)
+    card.from_dict(data)
+    if data.get('status', 'open') != 'open':
+        card.close(data['status'])
+    move_card(card, board, data)
+    db.session.add(card)
+    db.session.commit()
+    return json_response(card.to_dict(), 201)
+
+
+@bp.route('/cards/<int:id>', methods=['PUT'])
+@token_auth.login_required
+def update_card(id):
+    card = get_owned(Card, id)
+    data = request.get_json() or {}
+    validate_card(data)
+    card.from_dict(data)
+    if {'column_id', 'after_id', 'before_id'} & set(data):
+        move_card(card, card.board, data)
+    if 'status' in data and data['status'] != card.status:
+        card.close(data['status'])
+    db.session.commit()
+    return json_response(card.to_dict())
+
+
+@bp.route('/cards/<int:id>', methods=['DELETE'])
+@token_auth.login_required
+def delete_card(id):
+    db.session.delete(get_owned(Card, id))
+    db.session.commit()
+    return '', 204
+
+
+@bp.route('/boards/<int:id>/cards/move', methods=['POST'])
+@token_auth.login_required
+def move_cards(id):
+    """Apply a list of moves in order and in one transaction, such as the
+    ones a drag and drop of several cards makes."""
+    board = get_owned(Board, id)
+    moves = (request.get_json() or {}).get('moves')
+    if not isinstance(moves, list) or not moves or \
+            not all(isinstance(move, dict) and is_id(move.get('id'))
+                    for move in moves):
+        return bad_request('must include a list of moves')
+    cards = {card.id: card for card in Card.query.filter(
+        Card.board_id == board.id,
+        Card.id.in_([move.get('id') for move in moves]))}
+    for move in moves:
+        card = cards.get(move.get('id'))
+        if card is None:
+            return bad_request('invalid card {}'.format(move.get('id')))
+        move_card(card, board, move)
+        db.session.flush()
+    db.session.commit()
+    return json_response({'items': [cards[move['id']].to_dict()
+                                    for move in moves]})
+
+
+@bp.route('/boards/<int:id>/pipeline', methods=['GET'])
+@token_auth.login_required
+def get_pipeline(id):
+    board = get_owned(Board, id)
+    days = min(request.args.get('days', 30, type=int), 366)
+    since = datetime.utcnow().date() - timedelta(days=max(days, 1) - 1)
+    data = PipelineRollup.dashboard(board.id, since)
+    data['_links'] = {'board': url_for('api.get_board', id=board.id)}
+    return json_response(data)
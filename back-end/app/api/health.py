@@ -0,0 +1,11 @@
+from flask import jsonify
+from app.api import bp
+from app.resilience import breaker_status
+
+
+@bp.route('/health', methods=['GET'])
+def health():
+    breakers = breaker_status()
+    status = 'degraded' if any(b['state'] != 'closed'
+                               for b in breakers.values()) else 'ok'
+    return jsonify({'status': status, 'breakers': breakers})
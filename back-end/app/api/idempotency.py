@@ -0,0 +1,89 @@
+from functools import wraps
+import hashlib
+import json
+from uuid import uuid4
+from flask import current_app, request
+from app.models import RELEASE_SCRIPT
+from app.api.auth import token_auth
+from app.api.errors import error_response
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADERS = ('Content-Type', 'Location')
+
+
+def replay(stored):
+    response = current_app.response_class(
+        stored['body'], status=stored['status'], headers=stored['headers'])
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(f):
+    """Store the first response to a request that has an Idempotency-Key
+    header and replay it when the request is retried with the same key.
+    A retry that comes while the first request is still running gets a 409
+    instead of running the view again.
+
+    Goes below the login_required decorator of the view, so that replays are
+    authenticated too and keys are scoped to the authenticated user."""
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        from redis.exceptions import RedisError
+        idempotency_key = request.headers.get(HEADER)
+        if not idempotency_key:
+            return f(*args, **kwargs)
+        if len(idempotency_key) > 255:
+            return error_response(400, 'idempotency key is too long')
+        # keys are scoped to the user and the endpoint; both HTTP auth
+        # schemes store the user they authenticate in the same place
+        user = token_auth.current_user()
+        key = 'idempotency:' + hashlib.sha256('\n'.join([
+            request.method, request.path,
+            str(user.id) if user is not None else '',
+            idempotency_key]).encode()).hexdigest()
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        redis = current_app.redis
+        timeout = current_app.config['IDEMPOTENCY_LOCK_TIMEOUT']
+        lock = uuid4().hex
+        try:
+            stored = redis.get(key)
+            if stored is None and not redis.set(
+                    key + ':lock', lock, nx=True, px=int(timeout * 1000)):
+                # the first request may have finished in the meantime
+                stored = redis.get(key)
+                if stored is None:
+                    return error_response(
+                        409, 'a request with this idempotency key is in '
+                        'progress')
+        except RedisError:
+            return f(*args, **kwargs)
+        if stored is not None:
+            stored = json.loads(stored.decode())
+            if stored['fingerprint'] != fingerprint:
+                return error_response(
+                    422, 'idempotency key reused with another request body')
+            return replay(stored)
+
+        try:
+            response = current_app.make_response(f(*args, **kwargs))
+            # server errors are not stored, so that a retry can succeed
+            if response.status_code < 500:
+                try:
+                    redis.set(key, json.dumps({
+                        'fingerprint': fingerprint,
+                        'status': response.status_code,
+                        'headers': {name: response.headers[name]
+                                    for name in REPLAYED_HEADERS
+                                    if name in response.headers},
+                        'body': response.get_data(as_text=True)
+                    }), ex=current_app.config['IDEMPOTENCY_TTL'])
+                except RedisError:
+                    pass
+            return response
+        finally:
+            try:
+                # unless it timed out and another request holds it now
+                redis.eval(RELEASE_SCRIPT, 1, key + ':lock', lock)
+            except RedisError:
+                pass
+    return wrapped
@@ -0,0 +1,40 @@
+from flask import jsonify, request, current_app
+from app import db
+from app.models import User
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request
+
+
+@bp.route('/messages/broadcast', methods=['POST'])
+@token_auth.login_required
+def broadcast_message():
+    from redis.exceptions import RedisError
+    data = request.get_json() or {}
+    if 'recipients' not in data or 'body' not in data:
+        return bad_request('must include recipients and body fields')
+    if not isinstance(data['recipients'], list) or \
+            not all(isinstance(id, int) for id in data['recipients']):
+        return bad_request('recipients must be a list of user ids')
+    if not isinstance(data['body'], str) or not data['body'] or \
+            len(data['body']) > 140:
+        return bad_request('body must have between 1 and 140 characters')
+    if len(data['recipients']) > \
+            current_app.config['BROADCAST_MAX_RECIPIENTS']:
+        return bad_request('too many recipients')
+    recipients = User.query.filter(User.id.in_(data['recipients'])).all() \
+        if data['recipients'] else []
+    if len(recipients) != len(set(data['recipients'])):
+        return bad_request('unknown recipients')
+    ids = token_auth.current_user().broadcast_message(recipients,
+                                                      data['body'])
+    db.session.commit()
+    try:
+        current_app.enqueue('app.tasks.notify_unread_messages', ids)
+    except RedisError:
+        # the messages are sent, only the notifications are lost
+        current_app.logger.warning('Could not notify %d broadcast recipients',
+                                   len(ids))
+    response = jsonify({'recipients': len(ids)})
+    response.status_code = 202
+    return response
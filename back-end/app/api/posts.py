@@ -0,0 +1,115 @@
+import base64
+from datetime import datetime
+import json
+from flask import Response, current_app, request, stream_with_context, \
+    url_for
+from app import db
+from app.models import User, Post
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request
+from app.serialization import dumps, json_response
+
+
+def encode_cursor(row):
+    data = json.dumps([row.timestamp.isoformat(), row.id]).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, id = json.loads(base64.urlsafe_b64decode(
+            cursor + '=' * (-len(cursor) % 4)).decode())
+        return datetime.strptime(
+            timestamp, '%Y-%m-%dT%H:%M:%S.%f' if '.' in timestamp
+            else '%Y-%m-%dT%H:%M:%S'), int(id)
+    except (ValueError, TypeError):
+        return None
+
+
+def after(query, cursor):
+    """Keyset condition for the rows that come after cursor, newest
+    first."""
+    if cursor is None:
+        return query
+    timestamp, id = cursor
+    return query.filter(db.or_(
+        Post.timestamp < timestamp,
+        db.and_(Post.timestamp == timestamp, Post.id < id)))
+
+
+def stream_ndjson(query, cursor):
+    # plain rows are not kept in the session, so memory use stays flat no
+    # matter how many batches are streamed
+    batch_size = current_app.config['API_STREAM_BATCH_SIZE']
+
+    def generate():
+        position = cursor
+        while True:
+            rows = after(query, position).order_by(
+                Post.timestamp.desc(), Post.id.desc()).limit(batch_size).all()
+            for row in rows:
+                data = Post.row_to_dict(row)
+                data['_cursor'] = encode_cursor(row)
+                yield dumps(data) + '\n'
+            if len(rows) < batch_size:
+                break
+            position = (rows[-1].timestamp, rows[-1].id)
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+def post_collection(criterion, endpoint, **kwargs):
+    """A page of posts, newest first, that continues from the cursor
+    argument. Clients asking for application/x-ndjson get every remaining
+    post streamed instead, one per line."""
+    query = Post.api_query()
+    if criterion is not None:
+        query = query.filter(criterion)
+    cursor = request.args.get('cursor')
+    if cursor:
+        cursor = decode_cursor(cursor)
+        if cursor is None:
+            return bad_request('invalid cursor')
+    if request.args.get('format') == 'ndjson' or \
+            request.accept_mimetypes.best == 'application/x-ndjson':
+        return stream_ndjson(query, cursor)
+    limit = max(min(request.args.get('limit', 20, type=int), 100), 1)
+    rows = after(query, cursor).order_by(
+        Post.timestamp.desc(), Post.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit \
+        else None
+    return json_response({
+        'items': [Post.row_to_dict(row) for row in rows[:limit]],
+        '_meta': {
+            'limit': limit,
+            'next_cursor': next_cursor
+        },
+        '_links': {
+            'self': url_for(endpoint, cursor=request.args.get('cursor'),
+                            limit=limit, **kwargs),
+            'next': url_for(endpoint, cursor=next_cursor, limit=limit,
+                            **kwargs) if next_cursor else None
+        }
+    })
+
+
+@bp.route('/posts', methods=['GET'])
+@token_auth.login_required
+def get_posts():
+    return post_collection(None, 'api.get_posts')
+
+
+@bp.route('/users/<int:id>/posts', methods=['GET'])
+@token_auth.login_required
+def get_user_posts(id):
+    User.query.get_or_404(id)
+    return post_collection(Post.user_id == id, 'api.get_user_posts', id=id)
+
+
+@bp.route('/feed', methods=['GET'])
+@token_auth.login_required
+def get_feed():
+    return post_collection(token_auth.current_user().feed_filter(),
+                           'api.get_feed')
@@ -2,10 +2,12 @@ from flask import jsonify
 from app import db
 from app.api import bp
 from app.api.auth import basic_auth, token_auth
+from app.api.idempotency import idempotent
 
 
 @bp.route('/tokens', methods=['POST'])
 @basic_auth.login_required
+@idempotent
 def get_token():
     token = basic_auth.current_user().get_token()
     db.session.commit()
@@ -1,61 +1,139 @@
-from flask import jsonify, request, url_for, abort
-from app import db
+from flask import current_app, jsonify, request, url_for, abort
+from sqlalchemy.exc import IntegrityError
+from app import db, directory, recommendations
 from app.models import User
 from app.api import bp
 from app.api.auth import token_auth
 from app.api.errors import bad_request
+from app.api.idempotency import idempotent
+from app.serialization import json_response
+
+
+def representation():
+    """Parse the fields and include arguments of the query string."""
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else None
+    include = request.args.get('include')
+    include = include.split(',') if include else []
+    unknown = (set(fields or ()) - set(User.API_FIELDS)) | \
+        (set(include) - set(User.API_INCLUDES))
+    if unknown:
+        abort(bad_request('unknown fields: ' + ', '.join(sorted(unknown))))
+    return fields, include
+
+
+def user_collection(query, endpoint, **kwargs):
+    fields, include = representation()
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    # a stable order, as the narrower column set can change the query plan
+    query = query.options(User.load_fields(fields)).order_by(User.id)
+    return User.to_collection_response(
+        query, page, per_page, endpoint,
+        serialize=lambda users: User.to_dict_many(users, fields, include),
+        fields=request.args.get('fields'),
+        include=request.args.get('include'), **kwargs)
 
 
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
-    return jsonify(User.query.get_or_404(id).to_dict())
+    fields, include = representation()
+    user = User.query.options(User.load_fields(fields)).get_or_404(id)
+    return json_response(User.to_dict_many([user], fields, include)[0])
 
 
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
 def get_users():
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(User.query, page, per_page, 'api.get_users')
-    return jsonify(data)
+    return user_collection(User.query, 'api.get_users')
+
+
+@bp.route('/users/autocomplete', methods=['GET'])
+@token_auth.login_required
+def autocomplete_users():
+    prefix = request.args.get('q', '')
+    limit = min(request.args.get('limit', 10, type=int), 20)
+    if not prefix:
+        return bad_request('must include q argument')
+    entries = directory.search(prefix, limit)
+    if entries is not None:
+        ids = [id for username, id in entries]
+    else:
+        # a plain range scan on the username index
+        pattern = prefix.replace('\\', '\\\\').replace(
+            '%', '\\%').replace('_', '\\_') + '%'
+        query = User.query.filter(User.username.like(pattern, escape='\\'))
+        ids = [row.id for row in query.with_entities(User.id).order_by(
+            User.username).limit(limit)]
+    # entries can be stale, so the database has the last word
+    users = {user.id: user for user in User.query.filter(User.id.in_(ids))}
+    return json_response({'items': [
+        {'id': id, 'username': users[id].username,
+         '_links': {'self': url_for('api.get_user', id=id)}}
+        for id in ids if id in users and users[id].username.lower()
+        .startswith(prefix.lower())]})
+
+
+@bp.route('/recommendations', methods=['GET'])
+@token_auth.login_required
+def get_recommendations():
+    """Who to follow, as precomputed by the recommendations jobs."""
+    from redis.exceptions import RedisError
+    count = min(request.args.get('count', 10, type=int),
+                current_app.config['RECOMMENDATIONS_COUNT'])
+    try:
+        suggestions = recommendations.get(token_auth.current_user().id,
+                                          max(count, 1))
+    except RedisError:
+        suggestions = []
+    return json_response({'items': [
+        {'id': id, 'score': score,
+         '_links': {'user': url_for('api.get_user', id=id)}}
+        for id, score in suggestions]})
 
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
 @token_auth.login_required
 def get_followers(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(user.followers, page, per_page,
-                                   'api.get_followers', id=id)
-    return jsonify(data)
+    return user_collection(user.followers, 'api.get_followers', id=id)
 
 
 @bp.route('/users/<int:id>/followed', methods=['GET'])
 @token_auth.login_required
 def get_followed(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(user.followed, page, per_page,
-                                   'api.get_followed', id=id)
-    return jsonify(data)
+    return user_collection(user.followed, 'api.get_followed', id=id)
+
+
+def taken_error(data, id=None):
+    """The error for a username or email address that the unique indexes
+    turned down after the directory let it through."""
+    if 'username' in data and User.query.filter(
+            User.username == data['username'], User.id != id).first():
+        return bad_request('please use a different username')
+    return bad_request('please use a different email address')
 
 
 @bp.route('/users', methods=['POST'])
+@idempotent
 def create_user():
     data = request.get_json() or {}
     if 'username' not in data or 'email' not in data or 'password' not in data:
         return bad_request('must include username, email and password fields')
-    if User.query.filter_by(username=data['username']).first():
+    if User.username_taken(data['username']):
         return bad_request('please use a different username')
-    if User.query.filter_by(email=data['email']).first():
+    if User.email_taken(data['email']):
         return bad_request('please use a different email address')
     user = User()
     user.from_dict(data, new_user=True)
     db.session.add(user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return taken_error(data)
     response = jsonify(user.to_dict())
     response.status_code = 201
     response.headers['Location'] = url_for('api.get_user', id=user.id)
@@ -64,17 +142,22 @@ def create_user():
 
 @bp.route('/users/<int:id>', methods=['PUT'])
 @token_auth.login_required
+@idempotent
 def update_user(id):
     if token_auth.current_user().id != id:
         abort(403)
     user = User.query.get_or_404(id)
     data = request.get_json() or {}
     if 'username' in data and data['username'] != user.username and \
-            User.query.filter_by(username=data['username']).first():
+            User.username_taken(data['username']):
         return bad_request('please use a different username')
     if 'email' in data and data['email'] != user.email and \
-            User.query.filter_by(email=data['email']).first():
+            User.email_taken(data['email']):
         return bad_request('please use a different email address')
     user.from_dict(data, new_user=False)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return taken_error(data, id)
     return jsonify(user.to_dict())
@@ -0,0 +1,106 @@
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+import shutil
+import brotli
+from flask import current_app, url_for
+
+COMPRESSIBLE = ('.css', '.js', '.json', '.map', '.svg', '.txt', '.html',
+                '.eot', '.ttf', '.otf', '.xml')
+CSS_URL_RE = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+URL_SUFFIX_RE = re.compile(r'([^?#]*)(.*)')
+
+
+def hashed_name(path, content):
+    digest = hashlib.md5(content).hexdigest()[:12]
+    root, ext = posixpath.splitext(path)
+    return '{}.{}{}'.format(root, digest, ext)
+
+
+def rewrite_css(path, content, manifest, prefix):
+    """Point the url() references of a stylesheet to the hashed files."""
+    directory = posixpath.dirname(path)
+
+    def replace(match):
+        quote, url = match.groups()
+        target, suffix = URL_SUFFIX_RE.match(url).groups()
+        if '://' in target or target.startswith(('/', 'data:')):
+            return match.group(0)
+        name = posixpath.normpath(posixpath.join(directory, target))
+        if name not in manifest:
+            return match.group(0)
+        hashed = posixpath.relpath(manifest[name],
+                                   posixpath.join(prefix, directory))
+        return 'url({0}{1}{2}{0})'.format(quote, hashed, suffix)
+    return CSS_URL_RE.sub(replace, content.decode(
+        'utf-8', 'surrogateescape')).encode('utf-8', 'surrogateescape')
+
+
+def write(path, content, min_size, level):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    if not path.endswith(COMPRESSIBLE) or len(content) < min_size:
+        return
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(content, level))
+    with open(path + '.br', 'wb') as f:
+        f.write(brotli.compress(content))
+
+
+def build(static_folder, output, manifest_path, min_size=1024, level=9):
+    """Copy the static files into output under names that include a hash
+    of their content, with gzip and brotli variants next to them, and
+    write a manifest that maps the original names to the hashed ones.
+    Stylesheets go last so that their references can be rewritten."""
+    output = os.path.join(static_folder, output)
+    prefix = posixpath.relpath(output, static_folder).replace(os.sep, '/')
+    files = []
+    for root, dirs, names in os.walk(static_folder):
+        if os.path.abspath(root) == os.path.abspath(output):
+            dirs[:] = []
+            continue
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            files.append(posixpath.relpath(path, static_folder).replace(
+                os.sep, '/'))
+    files.sort(key=lambda name: name.endswith('.css'))
+    if os.path.exists(output):
+        shutil.rmtree(output)
+    manifest = {}
+    for name in files:
+        with open(os.path.join(static_folder, name), 'rb') as f:
+            content = f.read()
+        if name.endswith('.css'):
+            content = rewrite_css(name, content, manifest, prefix)
+        hashed = hashed_name(name, content)
+        write(os.path.join(output, hashed), content, min_size, level)
+        manifest[name] = posixpath.join(prefix, hashed)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+    return manifest
+
+
+class Assets(object):
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        manifest = {}
+        path = app.config['ASSETS_MANIFEST']
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+        app.extensions['assets'] = manifest
+        app.add_template_global(asset_url)
+
+
+def asset_url(filename):
+    """URL of a static file, the hashed copy when the assets are built."""
+    filename = current_app.extensions['assets'].get(filename, filename)
+    return url_for('static', filename=filename)
@@ -22,13 +22,11 @@ class RegistrationForm(FlaskForm):
     submit = SubmitField(_l('Register'))
 
     def validate_username(self, username):
-        user = User.query.filter_by(username=username.data).first()
-        if user is not None:
+        if User.username_taken(username.data):
             raise ValidationError(_('Please use a different username.'))
 
     def validate_email(self, email):
-        user = User.query.filter_by(email=email.data).first()
-        if user is not None:
+        if User.email_taken(email.data):
             raise ValidationError(_('Please use a different email address.'))
 
 
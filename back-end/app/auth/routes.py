@@ -1,5 +1,6 @@
 from flask import render_template, redirect, url_for, flash, request
 from werkzeug.urls import url_parse
+from sqlalchemy.exc import IntegrityError
 from flask_login import login_user, logout_user, current_user
 from flask_babel import _
 from app import db
@@ -43,7 +44,19 @@ def register():
         user = User(username=form.username.data, email=form.email.data)
         user.set_password(form.password.data)
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # taken by a user that the directory did not know about yet
+            db.session.rollback()
+            if User.query.filter_by(username=form.username.data).first():
+                form.username.errors.append(
+                    _('Please use a different username.'))
+            else:
+                form.email.errors.append(
+                    _('Please use a different email address.'))
+            return render_template('auth/register.html',
+                                   title=_('Register'), form=form)
         flash(_('Congratulations, you are now a registered user!'))
         return redirect(url_for('auth.login'))
     return render_template('auth/register.html', title=_('Register'),
@@ -0,0 +1,236 @@
+from collections import OrderedDict
+import json
+import os
+import pickle
+from threading import Lock
+from time import sleep, time
+from flask import abort, current_app
+from jinja2 import BytecodeCache, FileSystemBytecodeCache
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from werkzeug.urls import url_encode
+
+
+class RedisBytecodeCache(BytecodeCache):
+    def __init__(self, app, prefix='jinja2:', timeout=None):
+        self.app = app
+        self.prefix = prefix
+        self.timeout = timeout
+
+    def load_bytecode(self, bucket):
+        from redis.exceptions import RedisError
+        try:
+            code = self.app.redis.get(self.prefix + bucket.key)
+        except RedisError:
+            return
+        if code is not None:
+            bucket.bytecode_from_string(code)
+
+    def dump_bytecode(self, bucket):
+        from redis.exceptions import RedisError
+        try:
+            self.app.redis.set(self.prefix + bucket.key,
+                               bucket.bytecode_to_string(), ex=self.timeout)
+        except RedisError:
+            pass
+
+
+def bytecode_cache(app):
+    kind = app.config['TEMPLATE_CACHE']
+    if kind == 'filesystem':
+        directory = app.config['TEMPLATE_CACHE_DIR']
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        return FileSystemBytecodeCache(directory)
+    elif kind == 'redis':
+        return RedisBytecodeCache(app,
+                                  timeout=app.config['TEMPLATE_CACHE_TIMEOUT'])
+    elif kind:
+        raise ValueError('Unknown TEMPLATE_CACHE: {}'.format(kind))
+
+
+def single_flight(key, ttl, compute, stale_ttl=None, lock_timeout=10):
+    """Return the JSON-serializable value cached under key.
+
+    Once the value is older than ttl seconds a single caller acquires a lock
+    and recomputes it while everybody else keeps getting the stale copy for up
+    to stale_ttl more seconds. Without any copy to serve, callers wait for the
+    lock holder instead of all hitting the database at once.
+    """
+    from redis.exceptions import RedisError
+    redis = current_app.redis
+    if stale_ttl is None:
+        stale_ttl = current_app.config['CACHE_STALE_TTL']
+    key = 'cache:' + key
+    try:
+        entry = redis.get(key)
+        entry = json.loads(entry.decode('utf-8')) if entry else None
+        if entry and entry['expires'] > time():
+            return entry['value']
+        lock = redis.lock(key + ':lock', timeout=lock_timeout)
+        if not lock.acquire(blocking=False):
+            if entry:
+                return entry['value']
+            deadline = time() + lock_timeout
+            while time() < deadline and redis.exists(key + ':lock'):
+                sleep(0.05)
+            entry = redis.get(key)
+            if entry:
+                return json.loads(entry.decode('utf-8'))['value']
+            return compute()
+    except RedisError:
+        return compute()
+    try:
+        value = compute()
+        try:
+            redis.set(key, json.dumps({'expires': time() + ttl,
+                                       'value': value}),
+                      ex=int(ttl + stale_ttl))
+        except RedisError:
+            pass
+        return value
+    finally:
+        try:
+            lock.release()
+        except RedisError:
+            pass
+
+
+class LRUCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.pop(key, None)
+            if value is not None:
+                self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def discard(self, match):
+        with self.lock:
+            for key in [k for k, v in self.data.items() if match(v)]:
+                del self.data[key]
+
+
+class QueryCache(object):
+    """Two-tier cache of model lookups tagged with the rows they returned.
+
+    Entries live in a per-process LRU and in Redis. Each one records when
+    its query started, and each tag records when it was last invalidated,
+    so an entry is only served while none of its tags changed after it
+    was read. Bulk updates invalidate the table name, which is a tag of
+    every entry for that model.
+
+    The entries are pickled, so anyone who can write to the Redis server
+    can run code in the application: it must only be reachable by trusted
+    clients. The columns listed in the __cache_exclude__ attribute of a
+    model, such as credentials, are not stored and load from the database
+    when they are accessed.
+    """
+
+    def __init__(self, app=None, db=None):
+        self.db = db
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db=None):
+        if db is not None:
+            self.db = db
+        app.extensions['query_cache'] = LRUCache(
+            app.config['QUERY_CACHE_SIZE'])
+
+    @staticmethod
+    def tag(model, id):
+        return '{}:{}'.format(model.__tablename__, id)
+
+    def first(self, model, **filters):
+        key = 'qc:{}:{}'.format(model.__tablename__,
+                                url_encode(filters, sort=True))
+        entry = self._get(key)
+        if entry is not None:
+            return self._load(model, entry['value'])
+        fetched_at = time()
+        if self.db.session().replica is not None:
+            fetched_at -= current_app.config['REPLICA_MAX_LAG']
+        obj = model.query.filter_by(**filters).first()
+        if obj is not None:
+            self._set(key, {'fetched_at': fetched_at,
+                            'tags': [model.__tablename__,
+                                     self.tag(model, obj.id)],
+                            'value': self._dump(obj)})
+        return obj
+
+    def first_or_404(self, model, **filters):
+        obj = self.first(model, **filters)
+        if obj is None:
+            abort(404)
+        return obj
+
+    def invalidate(self, *tags):
+        from redis.exceptions import RedisError
+        if not tags:
+            return
+        now = time()
+        tags = set(tags)
+        current_app.extensions['query_cache'].discard(
+            lambda entry: tags.intersection(entry['tags']))
+        try:
+            pipe = current_app.redis.pipeline(transaction=False)
+            for tag in tags:
+                pipe.set('qc:tag:' + tag, now,
+                         ex=current_app.config['QUERY_CACHE_TTL'] + 60)
+            pipe.execute()
+        except RedisError:
+            current_app.logger.warning('Could not invalidate %s', tags)
+
+    def _get(self, key):
+        from redis.exceptions import RedisError
+        local = current_app.extensions['query_cache']
+        entry = local.get(key)
+        try:
+            if entry is None:
+                entry = current_app.redis.get(key)
+                if entry is None:
+                    return
+                entry = pickle.loads(entry)
+            invalidated = current_app.redis.mget(
+                ['qc:tag:' + tag for tag in entry['tags']])
+        except RedisError:
+            return
+        skew = current_app.config['QUERY_CACHE_CLOCK_SKEW']
+        if any(t is not None and float(t) + skew >= entry['fetched_at']
+               for t in invalidated):
+            return
+        local.set(key, entry)
+        return entry
+
+    def _set(self, key, entry):
+        from redis.exceptions import RedisError
+        current_app.extensions['query_cache'].set(key, entry)
+        try:
+            current_app.redis.set(key, pickle.dumps(entry),
+                                  ex=current_app.config['QUERY_CACHE_TTL'])
+        except RedisError:
+            pass
+
+    @staticmethod
+    def _dump(obj):
+        exclude = getattr(obj, '__cache_exclude__', ())
+        return {attr.key: getattr(obj, attr.key)
+                for attr in inspect(obj).mapper.column_attrs
+                if attr.key not in exclude}
+
+    def _load(self, model, data):
+        obj = model(**data)
+        make_transient_to_detached(obj)
+        return self.db.session.merge(obj, load=False)
@@ -1,4 +1,8 @@
+from datetime import datetime
 import os
+import re
+import subprocess
+import sys
 import click
 
 
@@ -33,3 +37,206 @@ def register(app):
         """Compile all languages."""
         if os.system('pybabel compile -d app/translations'):
             raise RuntimeError('compile command failed')
+
+    @app.cli.group()
+    def templates():
+        """Template cache commands."""
+        pass
+
+    @templates.command('compile')
+    def compile_templates():
+        """Compile all templates into the bytecode cache."""
+        if app.jinja_env.bytecode_cache is None:
+            click.echo('TEMPLATE_CACHE is not configured, nothing to do')
+            return
+        names = app.jinja_env.list_templates()
+        for name in names:
+            app.jinja_env.get_template(name)
+        click.echo('{} templates compiled'.format(len(names)))
+
+    @app.cli.group()
+    def assets():
+        """Static asset commands."""
+        pass
+
+    @assets.command('build')
+    def build_assets():
+        """Write fingerprinted and precompressed copies of the static
+        files."""
+        from app.assets import build
+        manifest = build(app.static_folder, app.config['ASSETS_OUTPUT'],
+                         app.config['ASSETS_MANIFEST'])
+        click.echo('{} assets built'.format(len(manifest)))
+
+    @app.cli.group()
+    def directory():
+        """User directory commands."""
+        pass
+
+    @directory.command('rebuild')
+    def rebuild_directory():
+        """Load the username and email directory from the database."""
+        from app.directory import rebuild
+        count = rebuild()
+        if count is None:
+            raise click.ClickException('the directory could not be updated '
+                                       'during the rebuild, run it again')
+        click.echo('{} users loaded'.format(count))
+
+    @app.cli.group()
+    def recommendations():
+        """Follow recommendation commands."""
+        pass
+
+    @recommendations.command('rebuild')
+    def rebuild_recommendations():
+        """Recompute the follow suggestions of all the users."""
+        from app.recommendations import refresh
+        click.echo('{} users updated'.format(refresh()))
+
+    @app.cli.group()
+    def messages():
+        """Private message commands."""
+        pass
+
+    @messages.command()
+    def rebuild():
+        """Rebuild unread counters and conversation summaries."""
+        from app import db
+        from app.models import Conversation
+        Conversation.rebuild()
+        db.session.commit()
+
+    @app.cli.group()
+    def crm():
+        """CRM commands."""
+        pass
+
+    @crm.group()
+    def rollups():
+        """Pipeline rollup commands."""
+        pass
+
+    @rollups.command('rebuild')
+    def rebuild_rollups():
+        """Recompute the pipeline rollups from the cards."""
+        from app import db
+        from app.models import PipelineRollup
+        PipelineRollup.rebuild()
+        db.session.commit()
+
+    @app.cli.group()
+    def maintenance():
+        """Data retention and archival commands."""
+        pass
+
+    @maintenance.command('run')
+    def run_maintenance():
+        """Apply the retention policies and archive old messages."""
+        from app import maintenance
+        for name, count in maintenance.run().items():
+            click.echo('{}: {}'.format(name, count))
+
+    @maintenance.command('restore-messages')
+    @click.argument('month')
+    def restore_messages(month):
+        """Restore the archived messages of a month (YYYY-MM)."""
+        from app import maintenance
+        try:
+            count = maintenance.restore_messages(month)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        click.echo('{} messages restored'.format(count))
+
+    @app.cli.group()
+    def scheduler():
+        """Periodic job scheduler commands."""
+        pass
+
+    @scheduler.command('run')
+    def run_scheduler():
+        """Run the scheduler that enqueues the periodic jobs."""
+        from app.scheduler import Scheduler
+        Scheduler(app).run()
+
+    @scheduler.command('status')
+    def scheduler_status():
+        """Show the schedule and the last run of each periodic job."""
+        from app.scheduler import status
+        for name, data in status().items():
+            click.echo('{} [{}]'.format(name, data.pop('schedule')))
+            for key, value in sorted(data.items()):
+                if key != 'last_status':
+                    value = datetime.utcfromtimestamp(value).isoformat() \
+                        if key != 'last_duration' else \
+                        '{:.2f}s'.format(value)
+                click.echo('    {}: {}'.format(key, value))
+
+    @app.cli.command()
+    @click.argument('queues', nargs=-1)
+    @click.option('--burst', is_flag=True,
+                  help='Exit once all queues are empty.')
+    @click.option('--fork/--no-fork', default=True,
+                  help='Run each job in a forked work horse (default) or '
+                       'in the worker process itself.')
+    def worker(queues, burst, fork):
+        """Run a task worker with the application preloaded."""
+        from app.worker import run_worker
+        run_worker(app, queues or app.config['TASK_QUEUES'], burst=burst,
+                   fork=fork)
+
+    @app.cli.command('import-time')
+    @click.option('--budget', type=int,
+                  help='Maximum import time in milliseconds.')
+    @click.option('--top', default=10, help='Number of modules to list.')
+    def import_time(budget, top):
+        """Measure how long it takes to import the application."""
+        budget = budget or app.config['IMPORT_TIME_BUDGET']
+        proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import app'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, cwd=os.path.dirname(app.root_path))
+        timings = []
+        for line in proc.stderr.splitlines():
+            m = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)',
+                         line)
+            if m:
+                timings.append((int(m.group(2)), len(m.group(3)),
+                                m.group(4)))
+        if proc.returncode:
+            raise click.ClickException('could not import the application')
+        total = next((cumulative for cumulative, depth, module in timings
+                      if depth == 0 and module == 'app'), None)
+        if total is None:
+            raise click.ClickException(
+                'could not measure the import time of app')
+        total //= 1000
+        for cumulative, depth, module in sorted(timings, reverse=True)[:top]:
+            click.echo('{:8d} ms  {}'.format(cumulative // 1000, module))
+        click.echo('total: {} ms (budget {} ms)'.format(total, budget))
+        if total > budget:
+            raise click.ClickException('import time budget exceeded')
+
+    @app.cli.group()
+    def profile():
+        """Sampling profiler commands."""
+        pass
+
+    @profile.command()
+    @click.option('--format', 'fmt', type=click.Choice(['folded',
+                                                         'speedscope']),
+                  default='folded', help='Output format.')
+    @click.option('--output', '-o', type=click.File('w'), default='-',
+                  help='Output file.')
+    def dump(fmt, output):
+        """Write the stacks collected by all the workers."""
+        from app.profiler import get_stacks, folded, speedscope
+        stacks = get_stacks()
+        output.write(folded(stacks) if fmt == 'folded'
+                     else speedscope(stacks))
+
+    @profile.command()
+    def reset():
+        """Discard the collected stacks."""
+        from app.profiler import reset
+        reset()
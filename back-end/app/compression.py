@@ -0,0 +1,85 @@
+import gzip
+import zlib
+import brotli
+from flask import current_app, request
+
+
+def gzip_stream(chunks, level, flush):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if flush:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def brotli_stream(chunks, level, flush):
+    compressor = brotli.Compressor(quality=level)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compressor.process(chunk)
+        if flush:
+            data += compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+class Compression(object):
+    """Compress the responses with gzip or brotli, as negotiated with the
+    Accept-Encoding header of the request.
+
+    Streamed responses are compressed as they go. Server-sent events are
+    flushed after every chunk so that they are not held back, other streams
+    come out in blocks as the compressor fills them."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config['COMPRESS_ENABLED']:
+            app.after_request(self.compress)
+
+    def compress(self, response):
+        config = current_app.config
+        if response.mimetype not in config['COMPRESS_MIMETYPES']:
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.status_code < 200 or response.status_code in (204, 304) \
+                or response.direct_passthrough or \
+                'Content-Encoding' in response.headers:
+            return response
+        encoding = request.accept_encodings.best_match(['br', 'gzip'])
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            flush = response.mimetype in config['COMPRESS_FLUSH_MIMETYPES']
+            if encoding == 'br':
+                response.response = brotli_stream(
+                    response.response, config['COMPRESS_BR_LEVEL'], flush)
+            else:
+                response.response = gzip_stream(
+                    response.response, config['COMPRESS_LEVEL'], flush)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < config['COMPRESS_MIN_SIZE']:
+                return response
+            if encoding == 'br':
+                data = brotli.compress(data,
+                                       quality=config['COMPRESS_BR_LEVEL'])
+            else:
+                data = gzip.compress(data, config['COMPRESS_LEVEL'])
+            response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
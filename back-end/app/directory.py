@@ -0,0 +1,142 @@
+from flask import current_app
+
+# every entry is the lowercased value, the value and the user id, in sorted
+# sets where all the scores are zero so that they are ordered by the entry
+KEYS = {'username': 'directory:usernames', 'email': 'directory:emails'}
+READY_KEY = 'directory:ready'
+# set while a rebuild runs, updates then go to the rebuilt sets as well
+REBUILD_KEY = 'directory:rebuilding'
+SEPARATOR = '\0'
+
+
+def entry(value, id):
+    return SEPARATOR.join([value.lower(), value, str(id)])
+
+
+def parse(member):
+    lower, value, id = member.decode().split(SEPARATOR)
+    return value, int(id)
+
+
+def lookup(field, value):
+    """The (value, id) entries that match value without regard to case, or
+    None when the directory is not complete or can't be reached."""
+    from redis.exceptions import RedisError
+    prefix = (value.lower() + SEPARATOR).encode()
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        pipe.exists(READY_KEY)
+        pipe.zrangebylex(KEYS[field], b'[' + prefix, b'[' + prefix + b'\xff')
+        ready, members = pipe.execute()
+    except RedisError:
+        return None
+    if not ready:
+        return None
+    return [parse(member) for member in members]
+
+
+def may_exist(field, value):
+    """False only when the directory says for sure that no user has this
+    value in any case, so that the database does not need to be asked. The
+    database decides whether a different case is the same value."""
+    entries = lookup(field, value)
+    return entries is None or bool(entries)
+
+
+def search(prefix, limit=10):
+    """(username, id) of the users whose username starts with prefix, or
+    None when the directory is not complete or can't be reached."""
+    from redis.exceptions import RedisError
+    prefix = prefix.lower().encode()
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        pipe.exists(READY_KEY)
+        pipe.zrangebylex(KEYS['username'], b'[' + prefix,
+                         b'[' + prefix + b'\xff', 0, limit)
+        ready, members = pipe.execute()
+    except RedisError:
+        return None
+    if not ready:
+        return None
+    return [parse(member) for member in members]
+
+
+def is_ready():
+    return bool(current_app.redis.exists(READY_KEY))
+
+
+def update(changes):
+    """Apply a list of (field, old entry, new entry) changes, where either
+    entry can be None."""
+    from redis.exceptions import RedisError
+    try:
+        keys = [KEYS]
+        if current_app.redis.exists(REBUILD_KEY):
+            keys.append(rebuild_keys())
+        pipe = current_app.redis.pipeline()
+        for field, old, new in changes:
+            for key in keys:
+                if old is not None:
+                    pipe.zrem(key[field], old)
+                if new is not None:
+                    pipe.zadd(key[field], {new: 0})
+        pipe.execute()
+    except RedisError:
+        current_app.logger.warning('Could not update the user directory')
+        try:
+            # a directory with missing entries can't answer negative checks,
+            # and neither can the one being rebuilt
+            current_app.redis.delete(READY_KEY, REBUILD_KEY)
+        except RedisError:
+            pass
+
+
+def rebuild_keys():
+    return {field: key + ':rebuild' for field, key in KEYS.items()}
+
+
+def rebuild(batch_size=1000):
+    """Load the directory from the users table. Negative checks are off
+    until it completes, and the changes committed in the meantime are
+    applied to the new directory as well as to the old one. Returns None
+    when an update failed during the rebuild, which has to run again."""
+    from redis.exceptions import WatchError
+    from app.models import User
+    redis = current_app.redis
+    temporary = rebuild_keys()
+    redis.delete(READY_KEY, *temporary.values())
+    redis.set(REBUILD_KEY, 1)
+    query = User.query.with_entities(User.id, User.username, User.email)
+    last_id = 0
+    count = 0
+    while True:
+        rows = query.filter(User.id > last_id).order_by(User.id).limit(
+            batch_size).all()
+        if not rows:
+            break
+        pipe = redis.pipeline(transaction=False)
+        for id, username, email in rows:
+            pipe.zadd(temporary['username'], {entry(username, id): 0})
+            if email:
+                pipe.zadd(temporary['email'], {entry(email, id): 0})
+        pipe.execute()
+        last_id = rows[-1].id
+        count += len(rows)
+    with redis.pipeline() as pipe:
+        try:
+            # a failed update removes the key, as its changes are missing
+            pipe.watch(REBUILD_KEY)
+            if not pipe.exists(REBUILD_KEY):
+                return None
+            built = [field for field in KEYS if pipe.exists(temporary[field])]
+            pipe.multi()
+            for field, key in KEYS.items():
+                pipe.delete(key)
+                if field in built:
+                    pipe.rename(temporary[field], key)
+            pipe.delete(REBUILD_KEY)
+            pipe.set(READY_KEY, 1)
+            pipe.execute()
+        except WatchError:
+            return None
+    return count
@@ -2,10 +2,16 @@ from threading import Thread
 from flask import current_app
 from flask_mail import Message
 from app import mail
+from app.resilience import breaker
 
 
 def send_async_email(app, msg):
     with app.app_context():
+        _send(msg)
+
+
+def _send(msg):
+    with breaker('mail'):
         mail.send(msg)
 
 
@@ -18,7 +24,7 @@ def send_email(subject, sender, recipients, text_body, html_body,
         for attachment in attachments:
             msg.attach(*attachment)
     if sync:
-        mail.send(msg)
+        _send(msg)
     else:
         Thread(target=send_async_email,
             args=(current_app._get_current_object(), msg)).start()
@@ -1,4 +1,4 @@
-from flask import render_template, request
+from flask import make_response, render_template, request
 from app import db
 from app.errors import bp
 from app.api.errors import error_response as api_error_response
@@ -16,6 +16,17 @@ def not_found_error(error):
     return render_template('errors/404.html'), 404
 
 
+@bp.app_errorhandler(429)
+def too_many_requests_error(error):
+    if request.blueprint == 'api' or wants_json_response():
+        response = api_error_response(429)
+    else:
+        response = make_response(render_template('errors/429.html'), 429)
+    if getattr(error, 'retry_after', None):
+        response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
 @bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
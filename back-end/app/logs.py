@@ -0,0 +1,218 @@
+import atexit
+import copy
+from datetime import datetime
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener, SMTPHandler, \
+    RotatingFileHandler
+import os
+from queue import Queue
+import re
+import threading
+from time import time
+from uuid import uuid4
+from flask import g, has_request_context, request
+from flask.logging import default_handler
+
+REQUEST_ID_RE = re.compile(r'^[\w.:-]{1,64}$')
+RESERVED = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            'time': datetime.utcfromtimestamp(record.created).isoformat() +
+            'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'location': '{}:{}'.format(record.pathname, record.lineno)
+        }
+        for key, value in vars(record).items():
+            if key not in RESERVED and value is not None:
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = g.get('request_id') \
+            if has_request_context() else None
+        return True
+
+
+class LogQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # keep the traceback as text so that the handlers on the other side
+        # of the queue can still format it their own way
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+        record.exc_info = None
+        return record
+
+
+class RateLimitedSMTPHandler(SMTPHandler):
+    """Email the first error right away and collect the ones that follow
+    within interval seconds into a single digest, which a timer sends once
+    the interval is over."""
+
+    def __init__(self, *args, interval=300, capacity=50, **kwargs):
+        super(RateLimitedSMTPHandler, self).__init__(*args, **kwargs)
+        self.interval = interval
+        self.capacity = capacity
+        self.buffer = []
+        self.dropped = 0
+        self.last_sent = 0
+        self.timer = None
+
+    def emit(self, record):
+        if len(self.buffer) < self.capacity:
+            self.buffer.append(record)
+        else:
+            self.dropped += 1
+        wait = self.last_sent + self.interval - time()
+        if wait <= 0:
+            self.flush()
+        elif self.timer is None or not self.timer.is_alive():
+            # threads do not survive a fork, hence the is_alive() check
+            self.timer = threading.Timer(wait, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.timer is not None and \
+                    self.timer is not threading.current_thread():
+                self.timer.cancel()
+            self.timer = None
+            if not self.buffer:
+                return
+            body = '\n\n'.join(self.format(record) for record in self.buffer)
+            if self.dropped:
+                body += '\n\n... and {} more errors'.format(self.dropped)
+            digest = logging.makeLogRecord({
+                'msg': body, 'levelno': logging.ERROR, 'levelname': 'ERROR',
+                'errors': len(self.buffer) + self.dropped})
+            self.buffer = []
+            self.dropped = 0
+            self.last_sent = time()
+            self.send(digest)
+        finally:
+            self.release()
+
+    def send(self, record):
+        SMTPHandler.emit(self, record)
+
+    def close(self):
+        self.flush()
+        super(RateLimitedSMTPHandler, self).close()
+
+    def getSubject(self, record):
+        errors = getattr(record, 'errors', 1)
+        if errors > 1:
+            return '{} ({} errors)'.format(self.subject, errors)
+        return self.subject
+
+
+def start_request():
+    request_id = request.headers.get('X-Request-ID', '')
+    g.request_id = request_id if REQUEST_ID_RE.match(request_id) \
+        else uuid4().hex
+    g.request_start = time()
+
+
+def finish_request(response):
+    from flask import current_app
+    # a hook that ran before start_request may have ended the request
+    if 'request_id' not in g:
+        start_request()
+    response.headers['X-Request-ID'] = g.request_id
+    if current_app.extensions.get('log_listener') is not None:
+        duration = (time() - g.request_start) * 1000
+        current_app.logger.info(
+            '%s %s %s %.1fms', request.method, request.path,
+            response.status_code, duration, extra={
+                'method': request.method, 'path': request.path,
+                'status': response.status_code,
+                'duration_ms': round(duration, 1),
+                'remote_addr': request.remote_addr})
+    return response
+
+
+def init_app(app):
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    if app.debug or app.testing:
+        return
+
+    handlers = []
+    if app.config['MAIL_SERVER']:
+        auth = None
+        if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
+            auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+        secure = None
+        if app.config['MAIL_USE_TLS']:
+            secure = ()
+        mail_handler = RateLimitedSMTPHandler(
+            mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
+            fromaddr='no-reply@' + app.config['MAIL_SERVER'],
+            toaddrs=app.config['ADMINS'], subject='erp-crm Failure',
+            credentials=auth, secure=secure,
+            interval=app.config['MAIL_ERROR_INTERVAL'])
+        mail_handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s: %(message)s '
+            '[in %(pathname)s:%(lineno)d, request %(request_id)s]'))
+        mail_handler.setLevel(logging.ERROR)
+        handlers.append(mail_handler)
+
+    if app.config['LOG_TO_STDOUT']:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(JSONFormatter())
+        stream_handler.setLevel(logging.INFO)
+        handlers.append(stream_handler)
+    else:
+        if not os.path.exists('logs'):
+            os.mkdir('logs')
+        file_handler = RotatingFileHandler(
+            'logs/erp-crm.log', maxBytes=app.config['LOG_MAX_BYTES'],
+            backupCount=10, delay=True)
+        file_handler.setFormatter(JSONFormatter())
+        file_handler.setLevel(logging.INFO)
+        handlers.append(file_handler)
+
+    # requests only put records on the queue, a background thread does the
+    # formatting and the I/O
+    log_queue = Queue(-1)
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    app.extensions['log_listener'] = listener
+    app.logger.removeHandler(default_handler)
+    app.logger.addHandler(queue_handler)
+    app.logger.setLevel(logging.INFO)
+    app.logger.info('erp-crm startup')
+
+
+def after_fork(app):
+    """The listener thread does not survive a fork, so forked processes log
+    through the handlers directly."""
+    listener = app.extensions.get('log_listener')
+    if listener is None:
+        return
+    for handler in list(app.logger.handlers):
+        if isinstance(handler, LogQueueHandler):
+            app.logger.removeHandler(handler)
+    for handler in listener.handlers:
+        handler.addFilter(RequestIdFilter())
+        app.logger.addHandler(handler)
@@ -1,4 +1,5 @@
-from flask import request
+import re
+from flask import current_app, request
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, TextAreaField
 from wtforms.validators import ValidationError, DataRequired, Length
@@ -17,10 +18,9 @@ class EditProfileForm(FlaskForm):
         self.original_username = original_username
 
     def validate_username(self, username):
-        if username.data != self.original_username:
-            user = User.query.filter_by(username=self.username.data).first()
-            if user is not None:
-                raise ValidationError(_('Please use a different username.'))
+        if username.data != self.original_username and \
+                User.username_taken(self.username.data):
+            raise ValidationError(_('Please use a different username.'))
 
 
 class EmptyForm(FlaskForm):
@@ -47,3 +47,20 @@ class MessageForm(FlaskForm):
     message = TextAreaField(_l('Message'), validators=[
         DataRequired(), Length(min=1, max=140)])
     submit = SubmitField(_l('Submit'))
+
+
+class BroadcastForm(FlaskForm):
+    recipients = TextAreaField(_l('Recipients'), validators=[DataRequired()])
+    message = TextAreaField(_l('Message'), validators=[
+        DataRequired(), Length(min=1, max=140)])
+    submit = SubmitField(_l('Submit'))
+
+    def validate_recipients(self, recipients):
+        usernames = set(re.split(r'[\s,;]+', recipients.data)) - {''}
+        if len(usernames) > current_app.config['BROADCAST_MAX_RECIPIENTS']:
+            raise ValidationError(_('Too many recipients.'))
+        self.users = User.query.filter(User.username.in_(usernames)).all()
+        unknown = usernames - set(user.username for user in self.users)
+        if unknown:
+            raise ValidationError(_('Unknown users: %(usernames)s',
+                                    usernames=', '.join(sorted(unknown))))
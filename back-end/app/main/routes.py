@@ -1,14 +1,17 @@
 from datetime import datetime
 from flask import render_template, flash, redirect, url_for, request, g, \
-    jsonify, current_app
+    jsonify, current_app, abort, Response
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
-from guess_language import guess_language
+from sqlalchemy.exc import IntegrityError
 from app import db
+from app.cache import single_flight
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm, \
-    MessageForm
-from app.models import User, Post, Message, Notification
-from app.translate import translate
+    MessageForm, BroadcastForm
+from app.models import User, Post, Message, Notification, Conversation, \
+    Task
+from app.replicas import use_primary
+from app.serialization import json_response, RawJSON
 from app.main import bp
 
 
@@ -27,6 +30,7 @@ def before_request():
 def index():
     form = PostForm()
     if form.validate_on_submit():
+        from guess_language import guess_language
         language = guess_language(form.post.data)
         if language == 'UNKNOWN' or len(language) > 5:
             language = ''
@@ -45,21 +49,36 @@ def index():
 @login_required
 def explore():
     page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
-        if posts.has_prev else None
+    if page <= current_app.config['EXPLORE_CACHE_PAGES']:
+        data = single_flight('explore:{}'.format(page),
+                             current_app.config['EXPLORE_CACHE_TTL'],
+                             lambda: explore_page(page))
+    else:
+        data = explore_page(page)
+    posts = Post.query.filter(Post.id.in_(data['ids'])).order_by(
+        Post.timestamp.desc()).all() if data['ids'] else []
+    next_url = url_for('main.explore', page=data['next_num']) \
+        if data['next_num'] else None
+    prev_url = url_for('main.explore', page=data['prev_num']) \
+        if data['prev_num'] else None
     return render_template('index.html', title=_('Explore'),
-                           posts=posts.items, next_url=next_url,
+                           posts=posts, next_url=next_url,
                            prev_url=prev_url)
 
 
+def explore_page(page):
+    posts = Post.query.with_entities(Post.id).order_by(
+        Post.timestamp.desc()).paginate(
+            page, current_app.config['POSTS_PER_PAGE'], False)
+    return {'ids': [post.id for post in posts.items],
+            'next_num': posts.next_num if posts.has_next else None,
+            'prev_num': posts.prev_num if posts.has_prev else None}
+
+
 @bp.route('/user/<username>')
 @login_required
 def user(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = User.first_cached_or_404(username=username)
     page = request.args.get('page', 1, type=int)
     posts = user.posts.order_by(Post.timestamp.desc()).paginate(
         page, current_app.config['POSTS_PER_PAGE'], False)
@@ -75,7 +94,7 @@ def user(username):
 @bp.route('/user/<username>/popup')
 @login_required
 def user_popup(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = User.first_cached_or_404(username=username)
     form = EmptyForm()
     return render_template('user_popup.html', user=user, form=form)
 
@@ -87,7 +106,14 @@ def edit_profile():
     if form.validate_on_submit():
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # taken by a user that the directory did not know about yet
+            db.session.rollback()
+            form.username.errors.append(_('Please use a different username.'))
+            return render_template('edit_profile.html',
+                                   title=_('Edit Profile'), form=form)
         flash(_('Your changes have been saved.'))
         return redirect(url_for('main.edit_profile'))
     elif request.method == 'GET':
@@ -102,7 +128,7 @@ def edit_profile():
 def follow(username):
     form = EmptyForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(username=username).first()
+        user = User.first_cached(username=username)
         if user is None:
             flash(_('User %(username)s not found.', username=username))
             return redirect(url_for('main.index'))
@@ -122,7 +148,7 @@ def follow(username):
 def unfollow(username):
     form = EmptyForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(username=username).first()
+        user = User.first_cached(username=username)
         if user is None:
             flash(_('User %(username)s not found.', username=username))
             return redirect(url_for('main.index'))
@@ -140,6 +166,7 @@ def unfollow(username):
 @bp.route('/translate', methods=['POST'])
 @login_required
 def translate_text():
+    from app.translate import translate
     return jsonify({'text': translate(request.form['text'],
                                       request.form['source_language'],
                                       request.form['dest_language'])})
@@ -164,12 +191,10 @@ def search():
 @bp.route('/send_message/<recipient>', methods=['GET', 'POST'])
 @login_required
 def send_message(recipient):
-    user = User.query.filter_by(username=recipient).first_or_404()
+    user = User.first_cached_or_404(username=recipient)
     form = MessageForm()
     if form.validate_on_submit():
-        msg = Message(author=current_user, recipient=user,
-                      body=form.message.data)
-        db.session.add(msg)
+        current_user.send_message(user, form.message.data)
         user.add_notification('unread_message_count', user.new_messages())
         db.session.commit()
         flash(_('Your message has been sent.'))
@@ -178,10 +203,31 @@ def send_message(recipient):
                            form=form, recipient=recipient)
 
 
+@bp.route('/broadcast', methods=['GET', 'POST'])
+@login_required
+def broadcast():
+    form = BroadcastForm()
+    if form.validate_on_submit():
+        from redis.exceptions import RedisError
+        ids = current_user.broadcast_message(form.users, form.message.data)
+        db.session.commit()
+        try:
+            current_app.enqueue('app.tasks.notify_unread_messages', ids)
+        except RedisError:
+            # the messages are sent, only the notifications are lost
+            current_app.logger.warning('Could not notify %d broadcast '
+                                       'recipients', len(ids))
+        flash(_('Your message has been sent to %(count)d users.',
+                count=len(ids)))
+        return redirect(url_for('main.inbox'))
+    return render_template('broadcast.html', title=_('Broadcast Message'),
+                           form=form)
+
+
 @bp.route('/messages')
 @login_required
 def messages():
-    current_user.last_message_read_time = datetime.utcnow()
+    current_user.read_messages()
     current_user.add_notification('unread_message_count', 0)
     db.session.commit()
     page = request.args.get('page', 1, type=int)
@@ -196,14 +242,32 @@ def messages():
                            next_url=next_url, prev_url=prev_url)
 
 
+@bp.route('/inbox')
+@login_required
+def inbox():
+    page = request.args.get('page', 1, type=int)
+    conversations = current_user.conversations.options(
+        db.joinedload(Conversation.peer),
+        db.joinedload(Conversation.last_message)).order_by(
+            Conversation.last_timestamp.desc()).paginate(
+                page, current_app.config['POSTS_PER_PAGE'], False)
+    next_url = url_for('main.inbox', page=conversations.next_num) \
+        if conversations.has_next else None
+    prev_url = url_for('main.inbox', page=conversations.prev_num) \
+        if conversations.has_prev else None
+    return render_template('inbox.html', title=_('Inbox'),
+                           conversations=conversations.items,
+                           next_url=next_url, prev_url=prev_url)
+
+
 @bp.route('/export_posts')
 @login_required
+@use_primary
 def export_posts():
-    if current_user.get_task_in_progress('export_posts'):
-        flash(_('An export task is currently in progress'))
-    else:
-        current_user.launch_task('export_posts', _('Exporting posts...'))
+    if current_user.launch_task('export_posts', _('Exporting posts...')):
         db.session.commit()
+    else:
+        flash(_('An export task is currently in progress'))
     return redirect(url_for('main.user', username=current_user.username))
 
 
@@ -213,8 +277,36 @@ def notifications():
     since = request.args.get('since', 0.0, type=float)
     notifications = current_user.notifications.filter(
         Notification.timestamp > since).order_by(Notification.timestamp.asc())
-    return jsonify([{
+    return json_response([{
         'name': n.name,
-        'data': n.get_data(),
+        'data': RawJSON(n.payload_json or 'null'),
         'timestamp': n.timestamp
     } for n in notifications])
+
+
+@bp.route('/tasks')
+@login_required
+def tasks():
+    tasks = current_user.get_tasks_in_progress()
+    progress = Task.get_progress_many(tasks)
+    return jsonify([{
+        'id': task.id,
+        'name': task.name,
+        'description': task.description,
+        'progress': progress[task.id]
+    } for task in tasks])
+
+
+@bp.route('/admin/profile')
+@login_required
+def admin_profile():
+    from app.profiler import get_stacks, folded, speedscope
+    if not current_user.is_admin:
+        abort(403)
+    stacks = get_stacks()
+    if request.args.get('format') == 'speedscope':
+        response = Response(speedscope(stacks), mimetype='application/json')
+        response.headers['Content-Disposition'] = \
+            'attachment; filename=profile.speedscope.json'
+        return response
+    return Response(folded(stacks), mimetype='text/plain')
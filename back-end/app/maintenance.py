@@ -0,0 +1,128 @@
+from datetime import datetime, timedelta
+import gzip
+import json
+import os
+from time import sleep, time
+from flask import current_app
+from app import db
+from app.models import Conversation, Message, Notification, Task
+
+
+def purge(model, criterion):
+    """Delete the rows matching criterion in small, separately committed
+    batches so that no transaction holds its locks for long."""
+    batch_size = current_app.config['RETENTION_BATCH_SIZE']
+    deleted = 0
+    while True:
+        ids = [row[0] for row in db.session.query(model.id).filter(
+            criterion).order_by(model.id).limit(batch_size)]
+        if not ids:
+            break
+        deleted += model.query.filter(model.id.in_(ids)).delete(
+            synchronize_session=False)
+        db.session.commit()
+        sleep(current_app.config['RETENTION_BATCH_PAUSE'])
+    return deleted
+
+
+def purge_notifications():
+    cutoff = time() - current_app.config['NOTIFICATION_RETENTION_DAYS'] * \
+        24 * 3600
+    return purge(Notification, Notification.timestamp < cutoff)
+
+
+def purge_tasks():
+    cutoff = time() - current_app.config['TASK_RETENTION_DAYS'] * 24 * 3600
+    return purge(Task, db.and_(Task.complete.is_(True),
+                               Task.timestamp < cutoff))
+
+
+def archive_path(month):
+    return os.path.join(current_app.config['MESSAGE_ARCHIVE_DIR'],
+                        'messages-{}.ndjson.gz'.format(month))
+
+
+def archive_messages():
+    """Move messages older than MESSAGE_ARCHIVE_DAYS into one gzipped
+    NDJSON file per month. Messages still shown as the last message of a
+    conversation stay in the database."""
+    cutoff = datetime.utcnow() - timedelta(
+        days=current_app.config['MESSAGE_ARCHIVE_DAYS'])
+    directory = current_app.config['MESSAGE_ARCHIVE_DIR']
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    criterion = db.and_(Message.timestamp < cutoff, ~db.exists().where(
+        Conversation.last_message_id == Message.id))
+    batch_size = current_app.config['RETENTION_BATCH_SIZE']
+    archived = 0
+    while True:
+        messages = Message.query.filter(criterion).order_by(
+            Message.id).limit(batch_size).all()
+        if not messages:
+            break
+        months = {}
+        for message in messages:
+            month = message.timestamp.strftime('%Y-%m')
+            months.setdefault(month, []).append(message)
+        for month, batch in months.items():
+            # appending creates a new gzip member, which readers handle
+            # transparently
+            with gzip.open(archive_path(month), 'at', encoding='utf-8') as f:
+                for message in batch:
+                    f.write(json.dumps({
+                        'id': message.id,
+                        'sender_id': message.sender_id,
+                        'recipient_id': message.recipient_id,
+                        'body': message.body,
+                        'timestamp': message.timestamp.isoformat()
+                    }) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        archived += Message.query.filter(
+            Message.id.in_([message.id for message in messages])).delete(
+                synchronize_session=False)
+        db.session.commit()
+        sleep(current_app.config['RETENTION_BATCH_PAUSE'])
+    return archived
+
+
+def restore_messages(month):
+    """Insert the archived messages of a month (YYYY-MM) back into the
+    database, skipping the ones that are already there."""
+    path = archive_path(month)
+    if not os.path.exists(path):
+        raise ValueError('No archive for {}'.format(month))
+    batch_size = current_app.config['RETENTION_BATCH_SIZE']
+    restored = 0
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        batch = []
+        for line in f:
+            batch.append(json.loads(line))
+            if len(batch) >= batch_size:
+                restored += _restore_batch(batch)
+                batch = []
+        if batch:
+            restored += _restore_batch(batch)
+    return restored
+
+
+def _restore_batch(rows):
+    rows = {row['id']: row for row in rows}
+    existing = set(row[0] for row in db.session.query(Message.id).filter(
+        Message.id.in_(list(rows))))
+    missing = [dict(row, timestamp=datetime.strptime(
+        row['timestamp'], '%Y-%m-%dT%H:%M:%S.%f' if '.' in row['timestamp']
+        else '%Y-%m-%dT%H:%M:%S'))
+        for id, row in rows.items() if id not in existing]
+    if missing:
+        db.session.execute(Message.__table__.insert(), missing)
+    db.session.commit()
+    return len(missing)
+
+
+def run():
+    return {
+        'notifications': purge_notifications(),
+        'tasks': purge_tasks(),
+        'messages': archive_messages()
+    }
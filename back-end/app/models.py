@@ -1,17 +1,21 @@
 import base64
 from datetime import datetime, timedelta
+from decimal import Decimal
 from hashlib import md5
 import json
 import os
+import pickle
 from time import time
+from uuid import uuid4
 from flask import current_app, url_for
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
-import redis
-import rq
-from app import db, login
+from app import db, login, query_cache
+from app import directory, recommendations
 from app.search import add_to_index, remove_from_index, query_index
+from app.ranks import rank_between, spread
+from app.serialization import stream_json
 
 
 class SearchableMixin(object):
@@ -57,29 +61,126 @@ db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
 
 
+class CachedQueryMixin(object):
+    # columns that are never written to the cache
+    __cache_exclude__ = ()
+    # cached columns that change too often to invalidate the cache for; the
+    # cached value can be up to QUERY_CACHE_TTL seconds old
+    __cache_volatile__ = ()
+
+    @classmethod
+    def first_cached(cls, **filters):
+        return query_cache.first(cls, **filters)
+
+    @classmethod
+    def first_cached_or_404(cls, **filters):
+        return query_cache.first_or_404(cls, **filters)
+
+    @classmethod
+    def expire_cached(cls, *ids):
+        # for bulk statements that bypass the unit of work; the tags are
+        # invalidated once the transaction commits
+        tags = db.session.info.setdefault('query_cache_tags', set())
+        if ids:
+            tags.update(query_cache.tag(cls, id) for id in ids)
+        else:
+            tags.add(cls.__tablename__)
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        tags = session.info.setdefault('query_cache_tags', set())
+        for obj in list(session.new) + list(session.deleted):
+            if isinstance(obj, CachedQueryMixin):
+                tags.add(query_cache.tag(obj, obj.id))
+        for obj in session.dirty:
+            if isinstance(obj, CachedQueryMixin) and obj.cache_changed():
+                tags.add(query_cache.tag(obj, obj.id))
+
+    def cache_changed(self):
+        ignore = set(self.__cache_exclude__) | set(self.__cache_volatile__)
+        state = db.inspect(self)
+        return any(state.attrs[attr.key].history.has_changes()
+                   for attr in state.mapper.column_attrs
+                   if attr.key not in ignore)
+
+    @classmethod
+    def after_commit(cls, session):
+        tags = session.info.pop('query_cache_tags', None)
+        if tags:
+            query_cache.invalidate(*tags)
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('query_cache_tags', None)
+
+
+db.event.listen(db.session, 'after_flush', CachedQueryMixin.after_flush)
+db.event.listen(db.session, 'after_commit', CachedQueryMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', CachedQueryMixin.after_rollback)
+
+
+def has_window_functions(engine):
+    dialect = engine.dialect
+    if dialect.server_version_info is None:
+        # the version is only known once a connection has been made
+        engine.connect().close()
+    version = dialect.server_version_info or ()
+    if dialect.name == 'mysql':
+        if getattr(dialect, '_is_mariadb', False):
+            if version[:3] == (5, 5, 5):
+                # reported as 5.5.5-10.x.y-MariaDB by older servers
+                version = version[3:]
+            return version >= (10, 2)
+        return version >= (8,)
+    if dialect.name == 'sqlite':
+        return version >= (3, 25)
+    return True
+
+
 class PaginatedAPIMixin(object):
     @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
-        resources = query.paginate(page, per_page, False)
-        data = {
-            'items': [item.to_dict() for item in resources.items],
+    def collection_meta(page, per_page, total, endpoint, **kwargs):
+        pages = -(-total // per_page) if per_page > 0 else 0
+        return {
             '_meta': {
                 'page': page,
                 'per_page': per_page,
-                'total_pages': resources.pages,
-                'total_items': resources.total
+                'total_pages': pages,
+                'total_items': total
             },
             '_links': {
                 'self': url_for(endpoint, page=page, per_page=per_page,
                                 **kwargs),
                 'next': url_for(endpoint, page=page + 1, per_page=per_page,
-                                **kwargs) if resources.has_next else None,
+                                **kwargs) if page < pages else None,
                 'prev': url_for(endpoint, page=page - 1, per_page=per_page,
-                                **kwargs) if resources.has_prev else None
+                                **kwargs) if page > 1 else None
             }
         }
+
+    @staticmethod
+    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+        resources = query.paginate(page, per_page, False)
+        data = PaginatedAPIMixin.collection_meta(
+            page, per_page, resources.total, endpoint, **kwargs)
+        data['items'] = [item.to_dict() for item in resources.items]
         return data
 
+    @staticmethod
+    def to_collection_response(query, page, per_page, endpoint,
+                               serialize=None, **kwargs):
+        """Same document as to_collection_dict, where the items of the page
+        are loaded together and the JSON is encoded one item at a time as
+        the response streams. serialize turns the list of items of the page
+        into dicts, so that it can batch the queries they need."""
+        page, per_page = max(page, 1), max(per_page, 1)
+        meta = PaginatedAPIMixin.collection_meta(
+            page, per_page, query.order_by(None).count(), endpoint, **kwargs)
+        items = query.limit(per_page).offset((page - 1) * per_page).all()
+        if serialize is None:
+            return stream_json(meta, items, lambda item: item.to_dict())
+        return stream_json(meta, serialize(items), lambda data: data)
+
 
 followers = db.Table(
     'followers',
@@ -88,7 +189,9 @@ followers = db.Table(
 )
 
 
-class User(UserMixin, PaginatedAPIMixin, db.Model):
+class User(UserMixin, CachedQueryMixin, PaginatedAPIMixin, db.Model):
+    __cache_exclude__ = ('password_hash', 'token', 'token_expiration')
+    __cache_volatile__ = ('last_seen',)
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
@@ -110,6 +213,10 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
                                         foreign_keys='Message.recipient_id',
                                         backref='recipient', lazy='dynamic')
     last_message_read_time = db.Column(db.DateTime)
+    unread_messages = db.Column(db.Integer, default=0, server_default='0')
+    conversations = db.relationship('Conversation',
+                                    foreign_keys='Conversation.user_id',
+                                    backref='user', lazy='dynamic')
     notifications = db.relationship('Notification', backref='user',
                                     lazy='dynamic')
     tasks = db.relationship('Task', backref='user', lazy='dynamic')
@@ -123,6 +230,64 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    @property
+    def is_admin(self):
+        return self.id in current_app.config['ADMIN_USER_IDS']
+
+    @staticmethod
+    def username_taken(username):
+        if not directory.may_exist('username', username):
+            return False
+        return User.query.filter_by(username=username).first() is not None
+
+    @staticmethod
+    def email_taken(email):
+        if not directory.may_exist('email', email):
+            return False
+        return User.query.filter_by(email=email).first() is not None
+
+    @staticmethod
+    def directory_after_flush(session, context):
+        changes = session.info.setdefault('directory_changes', [])
+        for obj in session.new:
+            if isinstance(obj, User):
+                for field in directory.KEYS:
+                    if getattr(obj, field):
+                        changes.append((field, None, directory.entry(
+                            getattr(obj, field), obj.id)))
+        for obj in session.dirty:
+            if isinstance(obj, User):
+                state = db.inspect(obj)
+                for field in directory.KEYS:
+                    history = state.attrs[field].history
+                    if not history.has_changes():
+                        continue
+                    old = history.deleted[0] if history.deleted else None
+                    new = getattr(obj, field)
+                    changes.append((
+                        field, directory.entry(old, obj.id) if old else None,
+                        directory.entry(new, obj.id) if new else None))
+        for obj in session.deleted:
+            if isinstance(obj, User):
+                for field in directory.KEYS:
+                    if getattr(obj, field):
+                        changes.append((field, directory.entry(
+                            getattr(obj, field), obj.id), None))
+
+    @staticmethod
+    def sync_after_commit(session):
+        changes = session.info.pop('directory_changes', None)
+        if changes:
+            directory.update(changes)
+        follows = session.info.pop('follow_changes', None)
+        if follows:
+            recommendations.record_follows(follows)
+
+    @staticmethod
+    def sync_after_rollback(session):
+        session.info.pop('directory_changes', None)
+        session.info.pop('follow_changes', None)
+
     def avatar(self, size):
         digest = md5(self.email.lower().encode('utf-8')).hexdigest()
         return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
@@ -147,6 +312,12 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
         own = Post.query.filter_by(user_id=self.id)
         return followed.union(own).order_by(Post.timestamp.desc())
 
+    def feed_filter(self):
+        """The followed_posts() criterion, without the union."""
+        followed = db.select([followers.c.followed_id]).where(
+            followers.c.follower_id == self.id)
+        return db.or_(Post.user_id.in_(followed), Post.user_id == self.id)
+
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
             {'reset_password': self.id, 'exp': time() + expires_in},
@@ -163,21 +334,70 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
         return User.query.get(id)
 
     def new_messages(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return Message.query.filter_by(recipient=self).filter(
-            Message.timestamp > last_read_time).count()
+        return self.unread_messages or 0
+
+    def send_message(self, recipient, body):
+        msg = Message(author=self, recipient=recipient, body=body,
+                      timestamp=datetime.utcnow())
+        db.session.add(msg)
+        recipient.unread_messages = User.unread_messages + 1
+        db.session.flush()
+        if recipient != self:
+            Conversation.record(self, recipient, msg)
+        Conversation.record(recipient, self, msg, unread=1)
+        return msg
+
+    def broadcast_message(self, recipients, body):
+        ids = sorted(set(user.id for user in recipients) - {self.id})
+        batch_size = current_app.config['BROADCAST_BATCH_SIZE']
+        timestamp = datetime.utcnow()
+        for i in range(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
+            # the new messages are the ones after this id, as their
+            # timestamps may not compare equal once stored
+            after_id = db.session.query(db.func.max(Message.id)).scalar()
+            db.session.execute(Message.__table__.insert(), [
+                {'sender_id': self.id, 'recipient_id': id, 'body': body,
+                 'timestamp': timestamp} for id in batch])
+            db.session.execute(User.__table__.update().where(
+                User.id.in_(batch)).values(
+                    unread_messages=User.unread_messages + 1))
+            Conversation.record_broadcast(self, batch, timestamp,
+                                          after_id or 0)
+        User.expire_cached(*ids)
+        return ids
+
+    def read_messages(self):
+        self.last_message_read_time = datetime.utcnow()
+        self.unread_messages = 0
+        self.conversations.filter(Conversation.unread_count > 0).update(
+            {'unread_count': 0}, synchronize_session=False)
 
     def add_notification(self, name, data):
-        self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
+        n = self.notifications.filter_by(name=name).first()
+        if n is None:
+            n = Notification(name=name, user=self)
+            db.session.add(n)
+        n.payload_json = json.dumps(data)
+        n.timestamp = time()
         return n
 
     def launch_task(self, name, description, *args, **kwargs):
-        rq_job = current_app.task_queue.enqueue('app.tasks.' + name, self.id,
-                                                *args, **kwargs)
-        task = Task(id=rq_job.get_id(), name=name, description=description,
-                    user=self)
+        """Enqueue a task, unless this user already has one with the same
+        name in flight, in which case None is returned."""
+        job_id = str(uuid4())
+        key = Task.lock_key(self.id, name)
+        if not current_app.redis.set(
+                key, job_id, nx=True,
+                ex=current_app.config['TASK_LOCK_TIMEOUT']):
+            return None
+        try:
+            current_app.enqueue('app.tasks.' + name, self.id, *args,
+                                job_id=job_id, **kwargs)
+        except Exception:
+            current_app.redis.delete(key)
+            raise
+        task = Task(id=job_id, name=name, description=description, user=self)
         db.session.add(task)
         return task
 
@@ -188,22 +408,125 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
         return Task.query.filter_by(name=name, user=self,
                                     complete=False).first()
 
-    def to_dict(self, include_email=False):
-        data = {
-            'id': self.id,
-            'username': self.username,
-            'last_seen': self.last_seen.isoformat() + 'Z',
-            'about_me': self.about_me,
-            'post_count': self.posts.count(),
-            'follower_count': self.followers.count(),
-            'followed_count': self.followed.count(),
-            '_links': {
+    # API fields and the columns they need, id is always loaded
+    API_FIELDS = {
+        'id': (),
+        'username': ('username',),
+        'last_seen': ('last_seen',),
+        'about_me': ('about_me',),
+        'post_count': (),
+        'follower_count': (),
+        'followed_count': (),
+        '_links': ('email',)
+    }
+    API_INCLUDES = ('followers', 'followed')
+
+    @staticmethod
+    def load_fields(fields=None, include_email=False):
+        """Query option that loads only the columns the fields need."""
+        columns = set()
+        for field in fields or User.API_FIELDS:
+            columns.update(User.API_FIELDS[field])
+        if include_email:
+            columns.add('email')
+        return db.load_only(*(['id'] + sorted(columns)))
+
+    @staticmethod
+    def count_many(field, ids):
+        if field == 'post_count':
+            column = Post.user_id
+        elif field == 'follower_count':
+            column = followers.c.followed_id
+        else:
+            column = followers.c.follower_id
+        return dict(db.session.query(column, db.func.count()).filter(
+            column.in_(ids)).group_by(column))
+
+    @staticmethod
+    def related_many(name, ids, limit, fields=None):
+        """Up to limit followers or followed users of each of the given
+        users, loaded in a single query. Databases without window functions
+        get a union of one limited select per user instead."""
+        owner, related = followers.c.followed_id, followers.c.follower_id
+        if name == 'followed':
+            owner, related = related, owner
+        if not ids:
+            return {}
+        if has_window_functions(db.get_engine()):
+            ranked = db.select([
+                owner.label('owner'), related.label('related'),
+                db.func.row_number().over(partition_by=owner,
+                                          order_by=related).label('rank')
+            ]).where(owner.in_(ids)).alias()
+            selected = db.select([ranked.c.owner, ranked.c.related]).where(
+                ranked.c.rank <= limit)
+        else:
+            selected = db.union_all(*[db.select(
+                [db.select([owner.label('owner'), related.label('related')])
+                 .where(owner == id).order_by(related).limit(limit).alias()])
+                for id in ids])
+        selected = selected.alias()
+        rows = db.session.query(selected.c.owner, User).join(
+            User, User.id == selected.c.related).order_by(
+                selected.c.owner, selected.c.related).options(
+                    User.load_fields(fields))
+        result = {}
+        for owner_id, user in rows:
+            result.setdefault(owner_id, []).append(user)
+        return result
+
+    @staticmethod
+    def to_dict_many(users, fields=None, include=(), include_email=False):
+        """Serialize a list of users with one query per requested count or
+        embedded collection instead of several queries per user."""
+        ids = [user.id for user in users]
+        counts = {}
+        for field in ('post_count', 'follower_count', 'followed_count'):
+            if ids and (fields is None or field in fields):
+                counts[field] = User.count_many(field, ids)
+        embedded = {}
+        for name in include:
+            related = User.related_many(
+                name, ids, current_app.config['API_INCLUDE_LIMIT'], fields)
+            unique = {user.id: user for group in related.values()
+                      for user in group}
+            data = dict(zip(unique, User.to_dict_many(list(unique.values()),
+                                                      fields)))
+            embedded[name] = {id: [data[user.id] for user in group]
+                              for id, group in related.items()}
+        return [user.to_dict(
+            include_email, fields,
+            {field: counts[field].get(user.id, 0) for field in counts},
+            {name: embedded[name].get(user.id, []) for name in embedded})
+            for user in users]
+
+    def to_dict(self, include_email=False, fields=None, counts=None,
+                embedded=None):
+        fields = fields or self.API_FIELDS
+        data = {}
+        if 'id' in fields:
+            data['id'] = self.id
+        if 'username' in fields:
+            data['username'] = self.username
+        if 'last_seen' in fields:
+            data['last_seen'] = self.last_seen.isoformat() + 'Z'
+        if 'about_me' in fields:
+            data['about_me'] = self.about_me
+        for field, query in (('post_count', self.posts),
+                             ('follower_count', self.followers),
+                             ('followed_count', self.followed)):
+            if field in fields:
+                data[field] = counts[field] if counts is not None \
+                    else query.count()
+        if '_links' in fields:
+            data['_links'] = {
                 'self': url_for('api.get_user', id=self.id),
                 'followers': url_for('api.get_followers', id=self.id),
                 'followed': url_for('api.get_followed', id=self.id),
                 'avatar': self.avatar(128)
             }
-        }
+        if embedded:
+            data['_embedded'] = embedded
         if include_email:
             data['email'] = self.email
         return data
@@ -235,6 +558,24 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
         return user
 
 
+db.event.listen(db.session, 'after_flush', User.directory_after_flush)
+db.event.listen(db.session, 'after_commit', User.sync_after_commit)
+db.event.listen(db.session, 'after_rollback', User.sync_after_rollback)
+
+
+def record_follow(following):
+    def listener(user, followed, initiator):
+        session = db.session.object_session(user)
+        if session is not None and user.id is not None:
+            session.info.setdefault('follow_changes', []).append(
+                (user.id, followed.id, following))
+    return listener
+
+
+db.event.listen(User.followed, 'append', record_follow(True))
+db.event.listen(User.followed, 'remove', record_follow(False))
+
+
 @login.user_loader
 def load_user(id):
     return User.query.get(int(id))
@@ -247,10 +588,31 @@ class Post(SearchableMixin, db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     language = db.Column(db.String(5))
+    __table_args__ = (db.Index('ix_post_user_id_timestamp',
+                               'user_id', 'timestamp'),)
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
+    @staticmethod
+    def api_query():
+        """Plain rows instead of Post instances, for the API listings."""
+        return db.session.query(Post.id, Post.body, Post.timestamp,
+                                Post.user_id, Post.language)
+
+    @staticmethod
+    def row_to_dict(row):
+        return {
+            'id': row.id,
+            'body': row.body,
+            'timestamp': row.timestamp.isoformat() + 'Z',
+            'user_id': row.user_id,
+            'language': row.language,
+            '_links': {
+                'author': url_for('api.get_user', id=row.user_id)
+            }
+        }
+
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -263,6 +625,124 @@ class Message(db.Model):
         return '<Message {}>'.format(self.body)
 
 
+class Conversation(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        primary_key=True)
+    peer_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        primary_key=True)
+    last_message_id = db.Column(db.Integer, db.ForeignKey('message.id'))
+    last_timestamp = db.Column(db.DateTime)
+    unread_count = db.Column(db.Integer, default=0)
+    peer = db.relationship('User', foreign_keys=[peer_id])
+    last_message = db.relationship('Message')
+    __table_args__ = (db.Index('ix_conversation_user_id_last_timestamp',
+                               'user_id', 'last_timestamp'),)
+
+    def __repr__(self):
+        return '<Conversation {} {}>'.format(self.user_id, self.peer_id)
+
+    @staticmethod
+    def record(user, peer, message, unread=0):
+        updated = Conversation.query.filter_by(
+            user_id=user.id, peer_id=peer.id).update({
+                'last_message_id': message.id,
+                'last_timestamp': message.timestamp,
+                'unread_count': Conversation.unread_count + unread
+            }, synchronize_session=False)
+        if not updated:
+            db.session.add(Conversation(
+                user_id=user.id, peer_id=peer.id, last_message_id=message.id,
+                last_timestamp=message.timestamp, unread_count=unread))
+
+    @staticmethod
+    def record_broadcast(sender, recipient_ids, timestamp, after_id):
+        """Point the conversations of a broadcast to its messages, which are
+        the ones from sender with an id greater than after_id."""
+        message = Message.__table__
+        conversation = Conversation.__table__
+        existing = conversation.alias()
+        sent = db.and_(message.c.sender_id == sender.id,
+                       message.c.id > after_id)
+        last_id = db.func.max(message.c.id)
+
+        # the recipients' side of each conversation
+        db.session.execute(conversation.update().where(db.and_(
+            conversation.c.peer_id == sender.id,
+            conversation.c.user_id.in_(recipient_ids))).values(
+                last_message_id=db.select([last_id]).where(db.and_(
+                    sent, message.c.recipient_id == conversation.c.user_id
+                )).as_scalar(),
+                last_timestamp=timestamp,
+                unread_count=conversation.c.unread_count + 1))
+        db.session.execute(conversation.insert().from_select(
+            ['user_id', 'peer_id', 'last_message_id', 'last_timestamp',
+             'unread_count'],
+            db.select([message.c.recipient_id, db.literal(sender.id),
+                       last_id, db.literal(timestamp),
+                       db.literal(1)]).where(db.and_(
+                sent, message.c.recipient_id.in_(recipient_ids),
+                ~db.exists().where(db.and_(
+                    existing.c.user_id == message.c.recipient_id,
+                    existing.c.peer_id == sender.id)))).group_by(
+                message.c.recipient_id)))
+
+        # and the sender's side
+        db.session.execute(conversation.update().where(db.and_(
+            conversation.c.user_id == sender.id,
+            conversation.c.peer_id.in_(recipient_ids))).values(
+                last_message_id=db.select([last_id]).where(db.and_(
+                    sent, message.c.recipient_id == conversation.c.peer_id
+                )).as_scalar(),
+                last_timestamp=timestamp))
+        db.session.execute(conversation.insert().from_select(
+            ['user_id', 'peer_id', 'last_message_id', 'last_timestamp',
+             'unread_count'],
+            db.select([db.literal(sender.id), message.c.recipient_id,
+                       last_id, db.literal(timestamp),
+                       db.literal(0)]).where(db.and_(
+                sent, message.c.recipient_id.in_(recipient_ids),
+                ~db.exists().where(db.and_(
+                    existing.c.user_id == sender.id,
+                    existing.c.peer_id == message.c.recipient_id)))).group_by(
+                message.c.recipient_id)))
+
+    @staticmethod
+    def rebuild():
+        message = Message.__table__
+        user = User.__table__
+        conversation = Conversation.__table__
+        last_read = db.func.coalesce(user.c.last_message_read_time,
+                                     datetime(1900, 1, 1))
+        unread = db.select([db.func.count(message.c.id)]).where(
+            db.and_(message.c.recipient_id == user.c.id,
+                    message.c.timestamp > last_read)).as_scalar()
+        db.session.execute(user.update().values(unread_messages=unread))
+
+        received = db.select([
+            message.c.recipient_id.label('user_id'),
+            message.c.sender_id.label('peer_id'),
+            message.c.id, message.c.timestamp,
+            db.case([(message.c.timestamp > last_read, 1)],
+                    else_=0).label('unread')]).select_from(
+                message.join(user, user.c.id == message.c.recipient_id))
+        sent = db.select([
+            message.c.sender_id.label('user_id'),
+            message.c.recipient_id.label('peer_id'),
+            message.c.id, message.c.timestamp,
+            db.literal(0).label('unread')]).where(
+                message.c.sender_id != message.c.recipient_id)
+        pairs = db.union_all(received, sent).alias()
+        db.session.execute(conversation.delete())
+        db.session.execute(conversation.insert().from_select(
+            ['user_id', 'peer_id', 'last_message_id', 'last_timestamp',
+             'unread_count'],
+            db.select([pairs.c.user_id, pairs.c.peer_id,
+                       db.func.max(pairs.c.id), db.func.max(pairs.c.timestamp),
+                       db.func.sum(pairs.c.unread)]).group_by(
+                pairs.c.user_id, pairs.c.peer_id)))
+        User.expire_cached()
+
+
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), index=True)
@@ -273,6 +753,36 @@ class Notification(db.Model):
     def get_data(self):
         return json.loads(str(self.payload_json))
 
+    @staticmethod
+    def set_many(name, payloads):
+        notification = Notification.__table__
+        now = time()
+        existing = set(row[0] for row in db.session.execute(
+            db.select([notification.c.user_id]).where(db.and_(
+                notification.c.name == name,
+                notification.c.user_id.in_(list(payloads))))))
+        if existing:
+            db.session.execute(notification.update().where(db.and_(
+                notification.c.name == name,
+                notification.c.user_id == db.bindparam('uid'))).values(
+                    payload_json=db.bindparam('payload'), timestamp=now), [
+                {'uid': id, 'payload': json.dumps(payloads[id])}
+                for id in existing])
+        missing = [id for id in payloads if id not in existing]
+        if missing:
+            db.session.execute(notification.insert(), [
+                {'name': name, 'user_id': id, 'timestamp': now,
+                 'payload_json': json.dumps(payloads[id])} for id in missing])
+
+
+# delete a task lock only while it still belongs to the given job
+RELEASE_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+'''
+
 
 class Task(db.Model):
     id = db.Column(db.String(36), primary_key=True)
@@ -280,8 +790,11 @@ class Task(db.Model):
     description = db.Column(db.String(128))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     complete = db.Column(db.Boolean, default=False)
+    timestamp = db.Column(db.Float, index=True, default=time)
 
     def get_rq_job(self):
+        import redis
+        import rq
         try:
             rq_job = rq.job.Job.fetch(self.id, connection=current_app.redis)
         except (redis.exceptions.RedisError, rq.exceptions.NoSuchJobError):
@@ -291,3 +804,345 @@ class Task(db.Model):
     def get_progress(self):
         job = self.get_rq_job()
         return job.meta.get('progress', 0) if job is not None else 100
+
+    @staticmethod
+    def get_progress_many(tasks):
+        """Like get_progress, with one round trip for all the tasks. The job
+        hashes are read directly, as rq 1.0 can only fetch jobs one by
+        one."""
+        import redis
+        import rq
+        try:
+            pipe = current_app.redis.pipeline(transaction=False)
+            for task in tasks:
+                pipe.hmget(rq.job.Job.key_for(task.id), 'created_at', 'meta')
+            jobs = pipe.execute()
+        except redis.exceptions.RedisError:
+            jobs = [(None, None)] * len(tasks)
+        progress = {}
+        for task, (created_at, meta) in zip(tasks, jobs):
+            if created_at is None:
+                # the job has expired, or was never saved
+                progress[task.id] = 100
+            else:
+                meta = pickle.loads(meta) if meta else {}
+                progress[task.id] = meta.get('progress', 0)
+        return progress
+
+    @staticmethod
+    def lock_key(user_id, name):
+        return 'task:lock:{}:{}'.format(user_id, name)
+
+    def release_lock(self):
+        current_app.redis.eval(RELEASE_SCRIPT, 1,
+                               Task.lock_key(self.user_id, self.name),
+                               self.id)
+
+
+class ReplicaHeartbeat(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.Float, default=time)
+
+
+class Board(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64))
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    columns = db.relationship('BoardColumn', backref='board', lazy='dynamic')
+
+    def __repr__(self):
+        return '<Board {}>'.format(self.name)
+
+    @staticmethod
+    def load(id):
+        """The board with its columns and their cards in order, fetched with
+        a single query. Returns None or the board and a list of (column,
+        cards) pairs."""
+        rows = db.session.query(Board, BoardColumn, Card).outerjoin(
+            BoardColumn, BoardColumn.board_id == Board.id).outerjoin(
+            Card, Card.column_id == BoardColumn.id).filter(
+            Board.id == id).order_by(BoardColumn.position, BoardColumn.id,
+                                     Card.rank, Card.id).all()
+        if not rows:
+            return None
+        columns = []
+        for board, column, card in rows:
+            if column is None:
+                continue
+            if not columns or columns[-1][0] is not column:
+                columns.append((column, []))
+            if card is not None:
+                columns[-1][1].append(card)
+        return rows[0][0], columns
+
+    def to_dict(self, columns=None):
+        data = {
+            'id': self.id,
+            'name': self.name,
+            'owner_id': self.owner_id,
+            'timestamp': self.timestamp.isoformat() + 'Z',
+            '_links': {
+                'self': url_for('api.get_board', id=self.id)
+            }
+        }
+        if columns is not None:
+            data['columns'] = [column.to_dict(cards)
+                               for column, cards in columns]
+        return data
+
+
+class BoardColumn(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    board_id = db.Column(db.Integer, db.ForeignKey('board.id'), index=True)
+    name = db.Column(db.String(64))
+    position = db.Column(db.Integer, default=0)
+    cards = db.relationship('Card', backref='column', lazy='dynamic')
+
+    def __repr__(self):
+        return '<BoardColumn {}>'.format(self.name)
+
+    def rebalance(self):
+        """Spread the ranks of the cards evenly again, once repeated moves
+        to the same spot have made them long."""
+        card = Card.__table__
+        ids = [row[0] for row in db.session.query(Card.id).filter(
+            Card.column_id == self.id).order_by(Card.rank, Card.id)]
+        if ids:
+            db.session.execute(card.update().where(
+                card.c.id == db.bindparam('card_id')).values(
+                    rank=db.bindparam('new_rank')), [
+                {'card_id': id, 'new_rank': rank}
+                for id, rank in zip(ids, spread(len(ids)))])
+        db.session.expire_all()
+
+    def to_dict(self, cards=None):
+        data = {
+            'id': self.id,
+            'name': self.name,
+            'position': self.position
+        }
+        if cards is not None:
+            data['cards'] = [card.to_dict() for card in cards]
+        return data
+
+
+class Card(db.Model):
+    MAX_RANK_LENGTH = 32
+    STATUSES = ('open', 'won', 'lost')
+    id = db.Column(db.Integer, primary_key=True)
+    board_id = db.Column(db.Integer, db.ForeignKey('board.id'), index=True)
+    # the previous values of the columns that the pipeline rollups depend on
+    # are loaded when they change, so the rollups can be adjusted on flush
+    column_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('board_column.id')),
+        active_history=True)
+    rank = db.Column(db.String(64))
+    title = db.Column(db.String(140))
+    description = db.Column(db.Text)
+    owner_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('user.id')), active_history=True)
+    value = db.column_property(db.Column(db.Numeric(12, 2), default=0),
+                               active_history=True)
+    status = db.column_property(db.Column(db.String(8), default='open'),
+                                active_history=True)
+    closed_at = db.column_property(db.Column(db.DateTime),
+                                   active_history=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    board = db.relationship('Board')
+    __table_args__ = (db.Index('ix_card_column_id_rank',
+                               'column_id', 'rank'),)
+
+    def __repr__(self):
+        return '<Card {}>'.format(self.title)
+
+    def place(self, column, after=None, before=None):
+        """Move the card into column, right below the card after or right
+        above the card before, or to the bottom when neither is given. Only
+        this card's rank changes."""
+        ranks = db.session.query(Card.rank).filter(
+            Card.column_id == column.id, Card.id != self.id)
+        if after is not None:
+            low = after.rank
+            high = ranks.filter(Card.rank > low).order_by(
+                Card.rank).limit(1).scalar()
+        elif before is not None:
+            high = before.rank
+            low = ranks.filter(Card.rank < high).order_by(
+                Card.rank.desc()).limit(1).scalar()
+        else:
+            low = ranks.order_by(Card.rank.desc()).limit(1).scalar()
+            high = None
+        self.board_id = column.board_id
+        self.column_id = column.id
+        self.rank = rank_between(low, high)
+        if len(self.rank) > self.MAX_RANK_LENGTH:
+            db.session.add(self)
+            db.session.flush()
+            column.rebalance()
+
+    def close(self, status):
+        self.status = status
+        self.closed_at = datetime.utcnow() if status != 'open' else None
+
+    def rollup_keys(self, previous=False):
+        """The board, the value and the (dimension, key) pairs of the
+        pipeline rollups the card counts towards, as of its current values
+        or the ones it had before the changes in the session."""
+        state = db.inspect(self)
+
+        def get(name):
+            history = state.attrs[name].history
+            if previous and history.deleted:
+                return history.deleted[0]
+            if previous and history.added:
+                return None
+            return getattr(self, name)
+
+        status = get('status') or 'open'
+        keys = [('stage', get('column_id')), ('status', status),
+                ('created', self.timestamp.date().isoformat())]
+        if status == 'open':
+            keys.append(('owner', get('owner_id')))
+        elif get('closed_at') is not None:
+            keys.append((status, get('closed_at').date().isoformat()))
+        return self.board_id, get('value') or 0, [
+            (dimension, str(key)) for dimension, key in keys
+            if key is not None]
+
+    def from_dict(self, data):
+        for field in ['title', 'description', 'owner_id']:
+            if field in data:
+                setattr(self, field, data[field])
+        if 'value' in data:
+            self.value = Decimal(str(data['value'] or 0))
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'board_id': self.board_id,
+            'column_id': self.column_id,
+            'rank': self.rank,
+            'title': self.title,
+            'description': self.description,
+            'owner_id': self.owner_id,
+            'value': self.value,
+            'status': self.status,
+            'closed_at': self.closed_at.isoformat() + 'Z'
+            if self.closed_at else None,
+            'timestamp': self.timestamp.isoformat() + 'Z'
+        }
+
+
+class PipelineRollup(db.Model):
+    """Deal count and value of a board by stage, status, owner of the open
+    deals, and by day of creation and of closing, kept up to date as cards
+    change so that the dashboard never has to aggregate the cards."""
+    board_id = db.Column(db.Integer, db.ForeignKey('board.id'),
+                         primary_key=True)
+    dimension = db.Column(db.String(16), primary_key=True)
+    key = db.Column(db.String(32), primary_key=True)
+    count = db.Column(db.Integer, default=0)
+    value = db.Column(db.Numeric(14, 2), default=0)
+
+    def __repr__(self):
+        return '<PipelineRollup {} {}>'.format(self.dimension, self.key)
+
+    @staticmethod
+    def before_flush(session, context, instances):
+        deltas = {}
+
+        def add(keys, sign):
+            board_id, value, pairs = keys
+            if board_id is None:
+                return
+            for dimension, key in pairs:
+                delta = deltas.setdefault((board_id, dimension, key), [0, 0])
+                delta[0] += sign
+                delta[1] += sign * value
+
+        with session.no_autoflush:
+            for obj in session.new:
+                if isinstance(obj, Card):
+                    if obj.timestamp is None:
+                        obj.timestamp = datetime.utcnow()
+                    add(obj.rollup_keys(), 1)
+            for obj in session.dirty:
+                if isinstance(obj, Card) and session.is_modified(obj):
+                    add(obj.rollup_keys(previous=True), -1)
+                    add(obj.rollup_keys(), 1)
+            for obj in session.deleted:
+                if isinstance(obj, Card):
+                    add(obj.rollup_keys(previous=True), -1)
+        PipelineRollup.apply(session, {key: delta for key, delta in
+                                       deltas.items() if any(delta)})
+
+    @staticmethod
+    def apply(session, deltas):
+        rollup = PipelineRollup.__table__
+        for (board_id, dimension, key), (count, value) in \
+                sorted(deltas.items()):
+            updated = session.execute(rollup.update().where(db.and_(
+                rollup.c.board_id == board_id,
+                rollup.c.dimension == dimension,
+                rollup.c.key == key)).values(
+                    count=rollup.c.count + count,
+                    value=rollup.c.value + value)).rowcount
+            if not updated:
+                session.execute(rollup.insert().values(
+                    board_id=board_id, dimension=dimension, key=key,
+                    count=count, value=value))
+
+    @staticmethod
+    def rebuild():
+        card = Card.__table__
+        rollup = PipelineRollup.__table__
+
+        def key(column):
+            return db.cast(column, db.String(32))
+
+        day = key(db.func.date(card.c.timestamp))
+        closed_day = key(db.func.date(card.c.closed_at))
+        # dimension, key, filter and extra grouping of each kind of rollup
+        groups = [
+            (db.literal('stage'), key(card.c.column_id), None, []),
+            (db.literal('status'), card.c.status, None, []),
+            (db.literal('owner'), key(card.c.owner_id),
+             db.and_(card.c.status == 'open', card.c.owner_id.isnot(None)),
+             []),
+            (db.literal('created'), day, None, []),
+            (card.c.status, closed_day,
+             db.and_(card.c.status != 'open', card.c.closed_at.isnot(None)),
+             [card.c.status])]
+        db.session.execute(rollup.delete())
+        for dimension, column, where, group_by in groups:
+            select = db.select([
+                card.c.board_id, dimension, column, db.func.count(card.c.id),
+                db.func.coalesce(db.func.sum(card.c.value), 0)]).where(
+                    card.c.board_id.isnot(None)).group_by(
+                        card.c.board_id, column, *group_by)
+            if where is not None:
+                select = select.where(where)
+            db.session.execute(rollup.insert().from_select(
+                ['board_id', 'dimension', 'key', 'count', 'value'], select))
+
+    @staticmethod
+    def dashboard(board_id, since):
+        """The rollups of a board, with the daily ones from the since
+        date on."""
+        daily = ('created', 'won', 'lost')
+        rows = PipelineRollup.query.filter(
+            PipelineRollup.board_id == board_id, db.or_(
+                ~PipelineRollup.dimension.in_(daily),
+                PipelineRollup.key >= since.isoformat())).order_by(
+            PipelineRollup.dimension, PipelineRollup.key)
+        data = {dimension: {} for dimension in
+                ('stage', 'status', 'owner') + daily}
+        for row in rows:
+            if row.count:
+                data[row.dimension][row.key] = {'count': row.count,
+                                                'value': row.value}
+        return data
+
+
+db.event.listen(db.session, 'before_flush', PipelineRollup.before_flush)
@@ -0,0 +1,158 @@
+from collections import Counter
+import json
+import os
+import sys
+import threading
+from time import sleep, time
+from flask import current_app
+
+REDIS_KEY = 'profile:stacks'
+
+
+class SamplingProfiler(object):
+    """Statistical profiler that periodically records the Python stacks of
+    the threads that are handling a request or a job. Samples are counted
+    per folded stack and flushed to Redis, where the stacks of all the web
+    and task worker processes add up."""
+
+    def __init__(self, app, interval=0.01, flush_interval=10, max_depth=64):
+        self.app = app
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.max_depth = max_depth
+        self.root = os.path.dirname(app.root_path) + os.sep
+        self.active = set()
+        self.stacks = Counter()
+        self.names = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        if self.pid == os.getpid():
+            return
+        if self.pid is not None:
+            # a forked process inherits the samples but not the thread
+            self.active = set()
+            self.stacks = Counter()
+            self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='profiler')
+        self.thread.start()
+
+    def track(self):
+        self.active.add(threading.get_ident())
+
+    def untrack(self):
+        self.active.discard(threading.get_ident())
+
+    def frame_name(self, code):
+        name = self.names.get(code)
+        if name is None:
+            filename = code.co_filename
+            if filename.startswith(self.root):
+                filename = filename[len(self.root):]
+            elif 'site-packages' + os.sep in filename:
+                filename = filename.split('site-packages' + os.sep)[-1]
+            name = self.names[code] = '{} ({}:{})'.format(
+                code.co_name, filename, code.co_firstlineno).replace(';', ',')
+        return name
+
+    def sample(self):
+        frames = sys._current_frames()
+        for ident in list(self.active):
+            frame = frames.get(ident)
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                stack.append(self.frame_name(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                with self.lock:
+                    self.stacks[';'.join(reversed(stack))] += 1
+
+    def flush(self):
+        from redis.exceptions import RedisError
+        with self.lock:
+            stacks, self.stacks = self.stacks, Counter()
+        if not stacks:
+            return
+        try:
+            pipe = self.app.redis.pipeline(transaction=False)
+            for stack, count in stacks.items():
+                pipe.hincrby(REDIS_KEY, stack, count)
+            pipe.execute()
+        except RedisError:
+            pass
+
+    def run(self):
+        last_flush = time()
+        while True:
+            sleep(self.interval)
+            if self.active:
+                self.sample()
+            if time() - last_flush >= self.flush_interval:
+                self.flush()
+                last_flush = time()
+
+
+class Profiler(object):
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config['PROFILER_ENABLED']:
+            app.extensions['profiler'] = None
+            return
+        profiler = app.extensions['profiler'] = SamplingProfiler(
+            app, app.config['PROFILER_INTERVAL'],
+            app.config['PROFILER_FLUSH_INTERVAL'])
+        app.before_first_request(profiler.start)
+        app.before_request(profiler.track)
+        app.teardown_request(lambda exc: profiler.untrack())
+
+
+def get_stacks():
+    return {stack.decode(): int(count) for stack, count in
+            current_app.redis.hgetall(REDIS_KEY).items()}
+
+
+def reset():
+    current_app.redis.delete(REDIS_KEY)
+
+
+def folded(stacks):
+    return ''.join('{} {}\n'.format(stack, count)
+                   for stack, count in sorted(stacks.items()))
+
+
+def speedscope(stacks, name='erp-crm'):
+    frames = []
+    index = {}
+    samples = []
+    weights = []
+    for stack, count in sorted(stacks.items()):
+        sample = []
+        for frame in stack.split(';'):
+            if frame not in index:
+                index[frame] = len(frames)
+                frames.append({'name': frame})
+            sample.append(index[frame])
+        samples.append(sample)
+        weights.append(count)
+    return json.dumps({
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': name,
+            'unit': 'none',
+            'startValue': 0,
+            'endValue': sum(weights),
+            'samples': samples,
+            'weights': weights
+        }],
+        'name': name,
+        'exporter': 'erp-crm'
+    })
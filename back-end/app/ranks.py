@@ -0,0 +1,49 @@
+# lexicographic ranks for ordered lists such as the cards of a kanban column,
+# a rank can always be made up between two neighbours so moving an item only
+# rewrites its own rank
+
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+BASE = len(DIGITS)
+
+
+def rank_between(before=None, after=None):
+    """A rank that sorts after before and ahead of after, where None stands
+    for the start or the end of the list."""
+    before = before or ''
+    if after is not None and before >= after:
+        raise ValueError('{!r} does not sort ahead of {!r}'.format(
+            before, after))
+    return _midpoint(before, after)
+
+
+def _midpoint(a, b):
+    # ranks never end in the zero digit, so there is always room between two
+    if b is not None:
+        n = 0
+        while n < len(b) and (a[n] if n < len(a) else DIGITS[0]) == b[n]:
+            n += 1
+        if n > 0:
+            return b[:n] + _midpoint(a[n:], b[n:])
+    low = DIGITS.index(a[0]) if a else 0
+    high = DIGITS.index(b[0]) if b is not None else BASE
+    if high - low > 1:
+        return DIGITS[(low + high) // 2]
+    if b is not None and len(b) > 1:
+        return b[0]
+    return DIGITS[low] + _midpoint(a[1:], None)
+
+
+def spread(count):
+    """count evenly spaced ranks, as short as they can be."""
+    width = 1
+    while BASE ** width <= count:
+        width += 1
+    ranks = []
+    for i in range(1, count + 1):
+        value = i * BASE ** width // (count + 1)
+        digits = ''
+        for _ in range(width):
+            value, digit = divmod(value, BASE)
+            digits = DIGITS[digit] + digits
+        ranks.append(digits.rstrip(DIGITS[0]))
+    return ranks
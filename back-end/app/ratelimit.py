@@ -0,0 +1,133 @@
+import math
+from threading import Lock
+from time import time
+from flask import current_app, request
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 24 * 3600}
+
+# refill the bucket for the time elapsed since the last request, then take a
+# token if there is one, all in one round trip
+TOKEN_BUCKET_SCRIPT = '''
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'time')
+local tokens = tonumber(bucket[1]) or capacity
+local last = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - last) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('hset', KEYS[1], 'tokens', tostring(tokens))
+redis.call('hset', KEYS[1], 'time', tostring(now))
+redis.call('expire', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+'''
+
+
+def parse_limit(limit):
+    """Turn '10/minute' into a bucket capacity and a refill rate in tokens
+    per second."""
+    count, period = limit.split('/')
+    return int(count), int(count) / PERIODS[period]
+
+
+class LocalBuckets(object):
+    """Per-process token buckets, used while Redis is not available."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.buckets = {}
+        self.lock = Lock()
+
+    def take(self, key, capacity, rate, now):
+        with self.lock:
+            if key not in self.buckets and \
+                    len(self.buckets) >= self.maxsize:
+                self.buckets.clear()
+            tokens, last = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + max(0, now - last) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            return wait
+
+
+class RateLimiter(object):
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['ratelimiter'] = {'local': LocalBuckets(),
+                                         'script': None}
+        app.before_request(self.check)
+
+    @staticmethod
+    def get_limit():
+        """The limit for the request: one configured for the method and
+        endpoint, for the endpoint or else for the blueprint."""
+        limits = current_app.config['RATELIMITS']
+        for name in ('{} {}'.format(request.method, request.endpoint),
+                     request.endpoint, request.blueprint):
+            if name in limits:
+                return name, limits[name]
+        return None, None
+
+    @staticmethod
+    def get_identity():
+        if current_user.is_authenticated:
+            return 'user:{}'.format(current_user.id)
+        auth = request.headers.get('Authorization', '')
+        if auth.startswith('Bearer '):
+            # only a valid token identifies a user, any other string would
+            # get a bucket of its own
+            from app.models import User
+            user = User.check_token(auth[len('Bearer '):].strip())
+            if user is not None:
+                return 'user:{}'.format(user.id)
+        # proxies append the address they see to X-Forwarded-For, so the
+        # client is the entry added by the outermost trusted proxy
+        proxies = current_app.config['RATELIMIT_PROXIES']
+        route = request.access_route
+        if proxies and len(route) >= proxies:
+            return 'ip:{}'.format(route[-proxies])
+        return 'ip:{}'.format(request.remote_addr)
+
+    @staticmethod
+    def hit(key, capacity, rate):
+        """Take a token from the bucket, returning 0 when there was one or
+        else the number of seconds until there will be one."""
+        from redis.exceptions import RedisError
+        state = current_app.extensions['ratelimiter']
+        now = time()
+        try:
+            if state['script'] is None:
+                state['script'] = current_app.redis.register_script(
+                    TOKEN_BUCKET_SCRIPT)
+            return float(state['script'](keys=['ratelimit:' + key],
+                                         args=[capacity, rate, now]))
+        except RedisError:
+            return state['local'].take(key, capacity, rate, now)
+
+    def check(self):
+        if not current_app.config['RATELIMIT_ENABLED']:
+            return
+        name, limit = self.get_limit()
+        if limit is None:
+            return
+        capacity, rate = parse_limit(limit)
+        wait = self.hit('{}:{}'.format(name, self.get_identity()), capacity,
+                        rate)
+        if wait > 0:
+            error = TooManyRequests()
+            error.retry_after = int(math.ceil(wait))
+            raise error
@@ -0,0 +1,133 @@
+from flask import current_app
+from app import db
+
+KEY = 'recommendations:{}'
+DIRTY_KEY = 'recommendations:dirty'
+
+
+def load_graph():
+    """The follow graph as a sparse matrix, where row i has a one in column j
+    when the user at index i follows the one at index j, and the array of
+    the user ids at each index."""
+    import numpy as np
+    from scipy import sparse
+    from app.models import User, followers
+    ids = np.array([row[0] for row in db.session.query(User.id).order_by(
+        User.id)], dtype=np.int64)
+    if not len(ids):
+        return sparse.csr_matrix((0, 0), dtype=np.float32), ids
+    edges = np.array(db.session.execute(db.select([
+        followers.c.follower_id, followers.c.followed_id])).fetchall(),
+        dtype=np.int64).reshape(-1, 2)
+    index = np.searchsorted(ids, edges).clip(0, len(ids) - 1)
+    index = index[(ids[index] == edges).all(axis=1)]
+    matrix = sparse.csr_matrix(
+        (np.ones(len(index), dtype=np.float32), (index[:, 0], index[:, 1])),
+        shape=(len(ids), len(ids)))
+    # duplicated rows in the followers table count once
+    matrix.data[:] = 1
+    return matrix, ids
+
+
+def suggest(matrix, ids, rows, count, cofollow_weight):
+    """Top suggestions for the users at the given indexes, as a dict of user
+    id to a list of (user id, score) pairs. The score of a candidate is the
+    number of followed users that follow it (friends of friends), plus the
+    weighted number of times it is followed by the users that follow the
+    same people (co-follows)."""
+    import numpy as np
+    from scipy import sparse
+    batch = matrix[rows]
+    similar = (batch * matrix.T).tocoo()
+    # a user is not similar to itself
+    keep = similar.col != rows[similar.row]
+    similar = sparse.csr_matrix(
+        (similar.data[keep], (similar.row[keep], similar.col[keep])),
+        shape=similar.shape)
+    scores = (batch * matrix + cofollow_weight * (similar * matrix)).tocsr()
+
+    suggestions = {}
+    for i, row in enumerate(rows):
+        start, end = scores.indptr[i], scores.indptr[i + 1]
+        columns, values = scores.indices[start:end], scores.data[start:end]
+        followed = batch.indices[batch.indptr[i]:batch.indptr[i + 1]]
+        keep = (values > 0) & (columns != row) & \
+            ~np.isin(columns, followed)
+        columns, values = columns[keep], values[keep]
+        if len(columns) > count:
+            top = np.argpartition(-values, count)[:count]
+            columns, values = columns[top], values[top]
+        order = np.lexsort((ids[columns], -values))
+        suggestions[int(ids[row])] = [
+            (int(ids[column]), float(value))
+            for column, value in zip(columns[order], values[order])]
+    return suggestions
+
+
+def store(suggestions):
+    pipe = current_app.redis.pipeline()
+    for user_id, users in suggestions.items():
+        key = KEY.format(user_id)
+        pipe.delete(key)
+        if users:
+            pipe.zadd(key, {str(id): score for id, score in users})
+            pipe.expire(key, current_app.config['RECOMMENDATIONS_TTL'])
+    pipe.execute()
+
+
+def refresh(user_ids=None):
+    """Recompute the suggestions of the given users, or of everyone, in
+    batches of rows of the follow graph."""
+    import numpy as np
+    config = current_app.config
+    matrix, ids = load_graph()
+    if user_ids is None:
+        rows = np.arange(len(ids))
+    else:
+        user_ids = np.array(sorted(user_ids), dtype=np.int64)
+        if not len(ids):
+            return 0
+        rows = np.searchsorted(ids, user_ids).clip(0, len(ids) - 1)
+        rows = rows[ids[rows] == user_ids]
+    batch_size = config['RECOMMENDATIONS_BATCH_SIZE']
+    for start in range(0, len(rows), batch_size):
+        store(suggest(matrix, ids, rows[start:start + batch_size],
+                      config['RECOMMENDATIONS_COUNT'],
+                      config['RECOMMENDATIONS_COFOLLOW_WEIGHT']))
+    return len(rows)
+
+
+def refresh_dirty(limit=10000):
+    """Recompute the suggestions of the users that followed or unfollowed
+    someone since the last refresh. The users are taken off the dirty set
+    before the follow graph is read, so that changes made during the
+    refresh mark them again, and they are put back if the refresh fails."""
+    members = current_app.redis.spop(DIRTY_KEY, limit)
+    if members:
+        try:
+            refresh([int(id) for id in members])
+        except Exception:
+            current_app.redis.sadd(DIRTY_KEY, *members)
+            raise
+    return len(members)
+
+
+def record_follows(changes):
+    """Take note of (follower id, followed id, following) changes. A newly
+    followed user is dropped from the suggestions right away, the rest is
+    left for the next refresh."""
+    from redis.exceptions import RedisError
+    try:
+        pipe = current_app.redis.pipeline()
+        for follower_id, followed_id, following in changes:
+            if following:
+                pipe.zrem(KEY.format(follower_id), str(followed_id))
+            pipe.sadd(DIRTY_KEY, follower_id)
+        pipe.execute()
+    except RedisError:
+        current_app.logger.warning('Could not record follow changes')
+
+
+def get(user_id, count):
+    return [(int(id), score) for id, score in current_app.redis.zrevrange(
+        KEY.format(user_id), 0, count - 1, withscores=True)]
@@ -0,0 +1,162 @@
+import hashlib
+import random
+from time import time
+from flask import current_app, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+READ_ONLY_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def use_primary(f):
+    f.use_primary = True
+    return f
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        SignallingSession.__init__(self, db, **options)
+        self.replica = None
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.replica is not None and not self._flushing and \
+                isinstance(clause, sa.sql.Select):
+            return self.replica
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class ReplicaPool(object):
+    def __init__(self, uris, max_lag, check_interval):
+        self.uris = uris
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.last_check = 0
+        self.lag = {}
+        self._engines = None
+        self._healthy = []
+
+    @property
+    def engines(self):
+        if self._engines is None:
+            self._engines = [sa.create_engine(uri) for uri in self.uris]
+        return self._engines
+
+    def get_engine(self):
+        if not self.uris:
+            return None
+        if time() - self.last_check >= self.check_interval:
+            self.check()
+        return random.choice(self._healthy) if self._healthy else None
+
+    @staticmethod
+    def heartbeat():
+        """Write the current time to the heartbeat row of the primary, from
+        where it replicates. The scheduler calls this, requests only read
+        it."""
+        from app.models import ReplicaHeartbeat
+        heartbeat = ReplicaHeartbeat.__table__
+        primary = current_app.extensions['sqlalchemy'].db.engine
+        now = time()
+        with primary.begin() as conn:
+            if conn.execute(heartbeat.update().where(
+                    heartbeat.c.id == 1).values(timestamp=now)).rowcount == 0:
+                conn.execute(heartbeat.insert().values(id=1, timestamp=now))
+
+    def check(self):
+        """Measure the lag of each replica as how far its heartbeat is
+        behind the one of the primary. Without a heartbeat on the primary
+        the lag is unknown and no replica is used."""
+        from app.models import ReplicaHeartbeat
+        heartbeat = ReplicaHeartbeat.__table__
+        query = sa.select([heartbeat.c.timestamp]).where(heartbeat.c.id == 1)
+        primary = current_app.extensions['sqlalchemy'].db.engine
+        now = time()
+        with primary.connect() as conn:
+            primary_time = conn.execute(query).scalar()
+        healthy = []
+        for engine in self.engines:
+            try:
+                with engine.connect() as conn:
+                    replica_time = conn.execute(query).scalar()
+            except sa.exc.SQLAlchemyError:
+                replica_time = None
+            if replica_time is None or primary_time is None:
+                self.lag[engine.url] = None
+                continue
+            self.lag[engine.url] = max(primary_time - replica_time, 0)
+            if self.lag[engine.url] <= self.max_lag:
+                healthy.append(engine)
+        self._healthy = healthy
+        self.last_check = now
+        return healthy
+
+
+class Replicas(object):
+    def __init__(self, app=None, db=None):
+        self.db = db
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db=None):
+        if db is not None:
+            self.db = db
+        app.extensions['replicas'] = ReplicaPool(
+            app.config['SQLALCHEMY_REPLICA_URIS'],
+            app.config['REPLICA_MAX_LAG'],
+            app.config['REPLICA_CHECK_INTERVAL'])
+        app.before_request(self.route_request)
+        app.after_request(self.record_write)
+
+    @staticmethod
+    def sticky_key():
+        """Redis key that keeps the API clients, which authenticate with a
+        header instead of the session cookie, on the primary after they
+        write."""
+        authorization = request.headers.get('Authorization')
+        if authorization:
+            return 'primary_until:' + hashlib.sha256(
+                authorization.encode()).hexdigest()
+
+    def is_sticky(self):
+        from redis.exceptions import RedisError
+        if session.get('_primary_until', 0) > time():
+            return True
+        key = self.sticky_key()
+        if key is None:
+            return False
+        try:
+            return bool(current_app.redis.exists(key))
+        except RedisError:
+            # can't tell, so read from the primary to be safe
+            return True
+
+    def route_request(self):
+        pool = current_app.extensions['replicas']
+        if not pool.uris or request.method not in READ_ONLY_METHODS:
+            return
+        view = current_app.view_functions.get(request.endpoint)
+        if getattr(view, 'use_primary', False) or self.is_sticky():
+            return
+        self.db.session().replica = pool.get_engine()
+
+    def record_write(self, response):
+        from redis.exceptions import RedisError
+        if request.method not in READ_ONLY_METHODS and \
+                current_app.extensions['replicas'].uris:
+            seconds = current_app.config['REPLICA_STICKY_SECONDS']
+            key = self.sticky_key()
+            if key is None:
+                session['_primary_until'] = time() + seconds
+            else:
+                try:
+                    current_app.redis.set(key, 1, ex=seconds)
+                except RedisError:
+                    current_app.logger.warning('Could not keep the client '
+                                               'on the primary')
+        return response
@@ -0,0 +1,134 @@
+import smtplib
+from threading import Lock
+from time import time
+from flask import current_app
+import flask_mail
+
+DEPENDENCIES = ('elasticsearch', 'translator', 'redis', 'mail')
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """Fail fast after threshold consecutive failures. Once reset_timeout
+    seconds have passed a single trial call is let through, and its outcome
+    closes the circuit or opens it again.
+
+    Used as a context manager around the calls to the dependency, where only
+    exceptions that are instances of failures count as failures."""
+
+    def __init__(self, name, threshold=5, reset_timeout=30,
+                 failures=(Exception,)):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = failures
+        self.lock = Lock()
+        self.failure_count = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.trial or time() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def __enter__(self):
+        with self.lock:
+            state = self.state
+            if state == 'open':
+                raise CircuitOpenError('{} is unavailable'.format(self.name))
+            if state == 'half-open':
+                self.trial = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        with self.lock:
+            self.trial = False
+            if exc_type is None or not issubclass(exc_type, self.failures):
+                if self.opened_at is not None:
+                    current_app.logger.warning('Circuit for %s closed',
+                                               self.name)
+                self.failure_count = 0
+                self.opened_at = None
+                return False
+            self.failure_count += 1
+            if self.opened_at is not None or \
+                    self.failure_count >= self.threshold:
+                if self.opened_at is None:
+                    current_app.logger.warning(
+                        'Circuit for %s opened after %d failures',
+                        self.name, self.failure_count)
+                self.opened_at = time()
+        return False
+
+    def to_dict(self):
+        return {
+            'state': self.state,
+            'failures': self.failure_count,
+            'opened_at': self.opened_at
+        }
+
+
+class Breakers(object):
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['breakers'] = {
+            name: CircuitBreaker(name, app.config['BREAKER_THRESHOLD'],
+                                 app.config['BREAKER_RESET_TIMEOUT'])
+            for name in DEPENDENCIES}
+
+
+def breaker(name):
+    return current_app.extensions['breakers'][name]
+
+
+def breaker_status():
+    return {name: b.to_dict()
+            for name, b in current_app.extensions['breakers'].items()}
+
+
+def guarded_redis(url, breaker, **kwargs):
+    """Redis client whose commands go through the given breaker. An open
+    circuit raises a ConnectionError, so the callers that already degrade
+    when Redis is down handle it the same way."""
+    from redis import Redis
+    from redis.exceptions import ConnectionError, TimeoutError
+    breaker.failures = (ConnectionError, TimeoutError)
+
+    class GuardedRedis(Redis):
+        def execute_command(self, *args, **options):
+            try:
+                with breaker:
+                    return Redis.execute_command(self, *args, **options)
+            except CircuitOpenError as e:
+                raise ConnectionError(str(e))
+
+    return GuardedRedis.from_url(url, **kwargs)
+
+
+class Connection(flask_mail.Connection):
+    def configure_host(self):
+        smtp = smtplib.SMTP_SSL if self.mail.use_ssl else smtplib.SMTP
+        host = smtp(self.mail.server, self.mail.port,
+                    timeout=current_app.config['MAIL_TIMEOUT'])
+        host.set_debuglevel(int(self.mail.debug))
+        if self.mail.use_tls:
+            host.starttls()
+        if self.mail.username and self.mail.password:
+            host.login(self.mail.username, self.mail.password)
+        return host
+
+
+class Mail(flask_mail.Mail):
+    def connect(self):
+        app = getattr(self, 'app', None) or current_app
+        return Connection(app.extensions['mail'])
@@ -0,0 +1,180 @@
+from datetime import datetime
+import os
+import socket
+import sys
+from time import sleep, time
+from flask import current_app
+
+jobs = {}
+
+# take or keep the leadership: succeeds if the key is free or already ours
+ELECT_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+if redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+'''
+
+
+class CronSchedule(object):
+    """Standard five field cron expression (minute, hour, day of month,
+    month, day of week with 0 as Sunday), evaluated in UTC. As in cron, when
+    both day fields are restricted a day matching either of them runs."""
+
+    ranges = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError('Invalid cron expression: ' + expression)
+        self.expression = expression
+        self.fields = [self._parse(field, low, high) for field, (low, high)
+                       in zip(fields, self.ranges)]
+        self.any_day = fields[2] == '*' or fields[4] == '*'
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/')
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = [int(value) for value in part.split('-')]
+            else:
+                start = end = int(part)
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError('Invalid cron field: ' + field)
+            values.update(range(start, end + 1, step))
+        return values
+
+    def matches(self, dt):
+        day = dt.day in self.fields[2]
+        weekday = (dt.weekday() + 1) % 7 in self.fields[4]
+        return dt.minute in self.fields[0] and dt.hour in self.fields[1] and \
+            dt.month in self.fields[3] and \
+            ((day and weekday) if self.any_day else (day or weekday))
+
+
+class PeriodicJob(object):
+    def __init__(self, name, func, schedule, timeout):
+        self.name = name
+        self.func = func
+        self.schedule = schedule
+        self.timeout = timeout
+
+
+def periodic(cron, name=None, timeout=3600):
+    def decorator(f):
+        job_name = name or f.__name__
+        jobs[job_name] = PeriodicJob(job_name, f, CronSchedule(cron), timeout)
+        return f
+    return decorator
+
+
+def run_job(name):
+    from app.tasks import get_app
+    app = get_app()
+    job = jobs[name]
+    key = 'scheduler:job:' + name
+    start = time()
+    app.redis.hset(key, 'last_start', start)
+    status = 'failed'
+    try:
+        job.func()
+        status = 'ok'
+    except Exception:
+        app.logger.error('Periodic job %s failed', name,
+                         exc_info=sys.exc_info())
+    finally:
+        pipe = app.redis.pipeline()
+        pipe.hset(key, 'last_end', time())
+        pipe.hset(key, 'last_duration', time() - start)
+        pipe.hset(key, 'last_status', status)
+        pipe.delete('scheduler:running:' + name)
+        pipe.execute()
+
+
+class Scheduler(object):
+    def __init__(self, app, interval=1, leader_ttl=10):
+        self.app = app
+        self.interval = interval
+        self.leader_ttl = leader_ttl
+        self.node = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.last_tick = None
+        self._elect = app.redis.register_script(ELECT_SCRIPT)
+
+    def elect(self):
+        return bool(self._elect(keys=['scheduler:leader'],
+                                args=[self.node, self.leader_ttl * 1000]))
+
+    def tick(self, now):
+        minute = int(now // 60) * 60
+        if self.last_tick is None or self.last_tick < minute - 600:
+            self.last_tick = minute - 60
+        while self.last_tick < minute:
+            self.last_tick += 60
+            dt = datetime.utcfromtimestamp(self.last_tick)
+            for job in jobs.values():
+                if job.schedule.matches(dt):
+                    self.fire(job, self.last_tick)
+
+    def fire(self, job, tick):
+        redis = self.app.redis
+        if not redis.set('scheduler:fired:{}:{}'.format(job.name, tick),
+                         self.node, nx=True, ex=3600):
+            return False
+        key = 'scheduler:job:' + job.name
+        if not redis.set('scheduler:running:' + job.name, tick, nx=True,
+                         ex=job.timeout):
+            redis.hset(key, 'last_skipped', tick)
+            self.app.logger.warning('Skipping %s, previous run still in '
+                                    'progress', job.name)
+            return False
+        redis.hset(key, 'last_scheduled', tick)
+        self.app.enqueue('app.scheduler.run_job', job.name,
+                         job_timeout=job.timeout)
+        return True
+
+    def heartbeat(self):
+        """Keep the replica heartbeat going, so that the lag of the read
+        replicas can be measured without writes from the requests."""
+        from sqlalchemy.exc import SQLAlchemyError
+        pool = self.app.extensions['replicas']
+        if not pool.uris:
+            return
+        try:
+            pool.heartbeat()
+        except SQLAlchemyError:
+            self.app.logger.exception('Replica heartbeat failed')
+
+    def run(self):
+        from redis.exceptions import RedisError
+        from app import tasks  # noqa: F401 -- registers the periodic jobs
+        while True:
+            try:
+                if self.elect():
+                    self.heartbeat()
+                    self.tick(time())
+                else:
+                    self.last_tick = None
+            except RedisError:
+                self.app.logger.exception('Scheduler tick failed')
+            sleep(self.interval)
+
+
+def status():
+    from app import tasks  # noqa: F401
+    result = {}
+    for name, job in sorted(jobs.items()):
+        data = current_app.redis.hgetall('scheduler:job:' + name)
+        result[name] = dict({'schedule': job.schedule.expression},
+                            **{k.decode(): float(v) if k != b'last_status'
+                               else v.decode() for k, v in data.items()})
+    return result
@@ -1,4 +1,5 @@
 from flask import current_app
+from app.resilience import breaker, CircuitOpenError
 
 
 def add_to_index(index, model):
@@ -7,21 +8,44 @@ def add_to_index(index, model):
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    try:
+        with breaker('elasticsearch'):
+            current_app.elasticsearch.index(index=index, id=model.id,
+                                            body=payload)
+    except CircuitOpenError:
+        pass
+    except Exception:
+        current_app.logger.warning('Could not index %s %s', index, model.id)
 
 
 def remove_from_index(index, model):
     if not current_app.elasticsearch:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    try:
+        with breaker('elasticsearch'):
+            current_app.elasticsearch.delete(index=index, id=model.id,
+                                             ignore=404)
+    except CircuitOpenError:
+        pass
+    except Exception:
+        current_app.logger.warning('Could not remove %s %s from the index',
+                                   index, model.id)
 
 
 def query_index(index, query, page, per_page):
     if not current_app.elasticsearch:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
+    try:
+        with breaker('elasticsearch'):
+            search = current_app.elasticsearch.search(
+                index=index,
+                body={'query': {'multi_match': {'query': query,
+                                                'fields': ['*']}},
+                      'from': (page - 1) * per_page, 'size': per_page})
+    except CircuitOpenError:
+        return [], 0
+    except Exception:
+        current_app.logger.warning('Search in %s failed', index)
+        return [], 0
     ids = [int(hit['_id']) for hit in search['hits']['hits']]
     return ids, search['hits']['total']['value']
@@ -0,0 +1,95 @@
+from datetime import date, datetime
+from decimal import Decimal
+import json
+from uuid import uuid4
+from flask import Response, current_app, stream_with_context
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+class RawJSON(object):
+    """A value that is already encoded as JSON, such as a stored payload,
+    and goes into the output as it is."""
+
+    def __init__(self, text):
+        self.text = text
+
+
+def default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat() + 'Z'
+    if isinstance(obj, date):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        # as a string, so that no precision is lost to a float
+        return str(obj)
+    if hasattr(obj, '__html__'):
+        return str(obj.__html__())
+    raise TypeError('{} is not JSON serializable'.format(type(obj).__name__))
+
+
+def _encode(encoder, obj):
+    """Encode obj with encoder(obj, default), replacing each RawJSON value
+    with a unique placeholder string that is then swapped for its text."""
+    raw = []
+    nonce = uuid4().hex
+
+    def _default(obj):
+        if isinstance(obj, RawJSON):
+            raw.append(obj.text)
+            return '\0{}:{}'.format(nonce, len(raw) - 1)
+        return default(obj)
+
+    text = encoder(obj, _default)
+    for i, value in enumerate(raw):
+        text = text.replace(json.dumps('\0{}:{}'.format(nonce, i)), value, 1)
+    return text
+
+
+def dumps_orjson(obj):
+    # datetimes go through default() so that both backends format them alike
+    return _encode(lambda obj, default: orjson.dumps(
+        obj, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME |
+        orjson.OPT_NON_STR_KEYS).decode(), obj)
+
+
+def dumps_stdlib(obj):
+    return _encode(lambda obj, default: json.dumps(
+        obj, default=default, separators=(',', ':')), obj)
+
+
+BACKENDS = {'stdlib': dumps_stdlib}
+# RawJSON does not rely on orjson.Fragment, which needs Python 3.8
+if orjson is not None and hasattr(orjson, 'OPT_NON_STR_KEYS'):
+    BACKENDS['orjson'] = dumps_orjson
+
+
+def dumps(obj):
+    """Encode obj with the JSON_BACKEND configured for the application,
+    orjson when it is installed, falling back to the standard library."""
+    backend = current_app.config['JSON_BACKEND']
+    if backend not in BACKENDS:
+        backend = 'orjson' if 'orjson' in BACKENDS else 'stdlib'
+    return BACKENDS[backend](obj)
+
+
+def json_response(data, status=200):
+    return Response(dumps(data), status=status, mimetype='application/json')
+
+
+def stream_json(envelope, items, encode, key='items'):
+    """Stream an object made of envelope plus a key holding the given items,
+    encoding one item at a time instead of building the whole document."""
+    def generate():
+        yield dumps(envelope)[:-1]
+        yield '{}{}:['.format(',' if envelope else '', dumps(key))
+        separator = ''
+        for item in items:
+            yield separator + dumps(encode(item))
+            separator = ','
+        yield ']}'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
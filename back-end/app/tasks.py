@@ -1,14 +1,22 @@
 import json
 import sys
 import time
-from flask import render_template
+from flask import current_app, has_app_context, render_template
 from rq import get_current_job
 from app import create_app, db
-from app.models import User, Post, Task
+from app.models import User, Post, Task, Notification, Conversation
 from app.email import send_email
+from app.scheduler import periodic
 
-app = create_app()
-app.app_context().push()
+
+def get_app():
+    # jobs run by the preloading `flask worker` already have an app context;
+    # plain `rq worker` processes create the application on first use
+    if has_app_context():
+        return current_app._get_current_object()
+    app = create_app()
+    app.app_context().push()
+    return app
 
 
 def _set_task_progress(progress):
@@ -22,9 +30,12 @@ def _set_task_progress(progress):
         if progress >= 100:
             task.complete = True
         db.session.commit()
+        if task.complete:
+            task.release_lock()
 
 
 def export_posts(user_id):
+    app = get_app()
     try:
         user = User.query.get(user_id)
         _set_task_progress(0)
@@ -49,3 +60,52 @@ def export_posts(user_id):
     except:
         _set_task_progress(100)
         app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+def notify_unread_messages(user_ids):
+    app = get_app()
+    batch_size = app.config['BROADCAST_BATCH_SIZE']
+    for i in range(0, len(user_ids), batch_size):
+        counts = db.session.query(User.id, User.unread_messages).filter(
+            User.id.in_(user_ids[i:i + batch_size]))
+        Notification.set_many('unread_message_count', dict(counts))
+        db.session.commit()
+
+
+@periodic('30 3 * * *')
+def run_maintenance():
+    app = get_app()
+    from app import maintenance
+    app.logger.info('Maintenance: %s', maintenance.run())
+
+
+@periodic('*/15 * * * *')
+def repair_directory():
+    """Rebuild the user directory when it is off, because it was never built
+    or because an update failed."""
+    app = get_app()
+    from app import directory
+    if not directory.is_ready():
+        app.logger.info('Directory: %s users', directory.rebuild())
+
+
+@periodic('0 4 * * 0')
+def reconcile_message_counters():
+    get_app()
+    Conversation.rebuild()
+    db.session.commit()
+
+
+@periodic('*/5 * * * *')
+def refresh_recommendations():
+    get_app()
+    from app import recommendations
+    recommendations.refresh_dirty()
+
+
+@periodic('0 5 * * *')
+def rebuild_recommendations():
+    app = get_app()
+    from app import recommendations
+    app.logger.info('Recommendations: %d users',
+                    recommendations.refresh())
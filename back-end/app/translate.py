@@ -1,7 +1,7 @@
-import json
 import requests
 from flask import current_app
 from flask_babel import _
+from app.resilience import breaker, CircuitOpenError
 
 
 def translate(text, source_language, dest_language):
@@ -11,11 +11,21 @@ def translate(text, source_language, dest_language):
     auth = {
         'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
         'Ocp-Apim-Subscription-Region': 'westus2'}
-    r = requests.post(
-        'https://api.cognitive.microsofttranslator.com'
-        '/translate?api-version=3.0&from={}&to={}'.format(
-            source_language, dest_language), headers=auth, json=[
-                {'Text': text}])
+    try:
+        with breaker('translator'):
+            r = requests.post(
+                'https://api.cognitive.microsofttranslator.com'
+                '/translate?api-version=3.0&from={}&to={}'.format(
+                    source_language, dest_language), headers=auth, json=[
+                        {'Text': text}],
+                timeout=current_app.config['TRANSLATOR_TIMEOUT'])
+            # only server errors say something about the service's health
+            if r.status_code >= 500:
+                r.raise_for_status()
+    except CircuitOpenError:
+        return _('Error: the translation service is not available.')
+    except requests.RequestException:
+        return _('Error: the translation service failed.')
     if r.status_code != 200:
         return _('Error: the translation service failed.')
     return r.json()[0]['translations'][0]['text']
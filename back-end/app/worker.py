@@ -0,0 +1,44 @@
+import rq
+from flask import current_app
+from app import db, logs
+
+
+class AppWorkerMixin(object):
+    def perform_job(self, *args, **kwargs):
+        profiler = current_app.extensions['profiler']
+        if profiler is not None:
+            profiler.start()
+            profiler.track()
+        try:
+            return super(AppWorkerMixin, self).perform_job(*args, **kwargs)
+        finally:
+            db.session.remove()
+            if profiler is not None:
+                # work horses exit without running any cleanup
+                profiler.untrack()
+                profiler.flush()
+
+
+class AppWorker(AppWorkerMixin, rq.Worker):
+    def main_work_horse(self, *args, **kwargs):
+        # the forked work horse must not share pooled connections with the
+        # parent process
+        db.engine.dispose()
+        logs.after_fork(current_app)
+        return super(AppWorker, self).main_work_horse(*args, **kwargs)
+
+
+class AppSimpleWorker(AppWorkerMixin, rq.SimpleWorker):
+    pass
+
+
+def run_worker(app, queues, burst=False, fork=True):
+    from app import tasks  # noqa: F401 -- preload job functions
+    from redis import Redis
+    worker_class = AppWorker if fork else AppSimpleWorker
+    # blocking dequeues need a connection without the short socket timeout
+    # of app.redis
+    connection = Redis.from_url(app.config['REDIS_URL'])
+    with app.app_context():
+        worker = worker_class(queues, connection=connection)
+        return worker.work(burst=burst)
@@ -10,4 +10,5 @@ while true; do
     sleep 5
 done
 flask translate compile
+flask templates compile
 exec gunicorn -b :5000 --access-logfile - --error-logfile - erp-crm:app
@@ -10,15 +10,108 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_REPLICA_URIS = [
+        uri for uri in
+        (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',') if uri]
+    REPLICA_STICKY_SECONDS = int(
+        os.environ.get('REPLICA_STICKY_SECONDS') or 10)
+    REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG') or 5)
+    REPLICA_CHECK_INTERVAL = int(os.environ.get('REPLICA_CHECK_INTERVAL') or 5)
     LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
+    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES') or 10 * 1024 * 1024)
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    MAIL_TIMEOUT = int(os.environ.get('MAIL_TIMEOUT') or 10)
+    MAIL_ERROR_INTERVAL = int(os.environ.get('MAIL_ERROR_INTERVAL') or 300)
     ADMINS = ['your-email@example.com']
+    # ids of the users allowed into the admin pages; ADMINS only receive mail,
+    # as anyone can change their email address to one of them
+    ADMIN_USER_IDS = [
+        int(id) for id in
+        (os.environ.get('ADMIN_USER_IDS') or '').split(',') if id]
     LANGUAGES = ['en', 'es']
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    TRANSLATOR_TIMEOUT = float(os.environ.get('TRANSLATOR_TIMEOUT') or 5)
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    ELASTICSEARCH_TIMEOUT = float(os.environ.get('ELASTICSEARCH_TIMEOUT') or 2)
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+    REDIS_TIMEOUT = float(os.environ.get('REDIS_TIMEOUT') or 1)
+    IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL') or 24 * 3600)
+    # how long a request holds its idempotency key, should it never finish
+    IDEMPOTENCY_LOCK_TIMEOUT = int(
+        os.environ.get('IDEMPOTENCY_LOCK_TIMEOUT') or 30)
+    BREAKER_THRESHOLD = int(os.environ.get('BREAKER_THRESHOLD') or 5)
+    BREAKER_RESET_TIMEOUT = int(os.environ.get('BREAKER_RESET_TIMEOUT') or 30)
     POSTS_PER_PAGE = 25
+    JSON_BACKEND = os.environ.get('JSON_BACKEND')
+    API_INCLUDE_LIMIT = 10
+    API_STREAM_BATCH_SIZE = 1000
+    BATCH_MAX_REQUESTS = 20
+    BATCH_MAX_WORKERS = 4
+    RATELIMIT_ENABLED = os.environ.get('RATELIMIT_DISABLED') is None
+    RATELIMIT_PROXIES = int(os.environ.get('RATELIMIT_PROXIES') or 0)
+    # by 'METHOD endpoint', endpoint or blueprint, the first match applies
+    RATELIMITS = {
+        'POST auth.login': '10/minute',
+        'api.get_token': '10/minute',
+        'main.translate_text': '30/minute',
+        'api': '600/minute'
+    }
+    RECOMMENDATIONS_COUNT = 20
+    RECOMMENDATIONS_BATCH_SIZE = int(
+        os.environ.get('RECOMMENDATIONS_BATCH_SIZE') or 1000)
+    RECOMMENDATIONS_COFOLLOW_WEIGHT = 0.5
+    RECOMMENDATIONS_TTL = 2 * 24 * 3600
+    COMPRESS_ENABLED = os.environ.get('COMPRESS_DISABLED') is None
+    COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL') or 6)
+    COMPRESS_BR_LEVEL = int(os.environ.get('COMPRESS_BR_LEVEL') or 4)
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE') or 500)
+    COMPRESS_MIMETYPES = ['text/html', 'text/css', 'text/plain', 'text/xml',
+                          'text/csv', 'text/event-stream', 'application/json',
+                          'application/javascript', 'application/x-ndjson']
+    # streams of these types are flushed after every chunk
+    COMPRESS_FLUSH_MIMETYPES = ['text/event-stream']
+    ASSETS_OUTPUT = 'dist'
+    ASSETS_MANIFEST = os.path.join(basedir, 'app', 'static', ASSETS_OUTPUT,
+                                   'manifest.json')
+    ASSETS_MAX_AGE = 365 * 24 * 3600
+    TEMPLATE_CACHE = os.environ.get('TEMPLATE_CACHE')
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR') or \
+        os.path.join(basedir, 'template-cache')
+    TEMPLATE_CACHE_TIMEOUT = int(
+        os.environ.get('TEMPLATE_CACHE_TIMEOUT') or 7 * 24 * 3600)
+    CACHE_STALE_TTL = int(os.environ.get('CACHE_STALE_TTL') or 60)
+    EXPLORE_CACHE_TTL = int(os.environ.get('EXPLORE_CACHE_TTL') or 10)
+    EXPLORE_CACHE_PAGES = int(os.environ.get('EXPLORE_CACHE_PAGES') or 3)
+    QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE') or 1024)
+    QUERY_CACHE_TTL = int(os.environ.get('QUERY_CACHE_TTL') or 300)
+    QUERY_CACHE_CLOCK_SKEW = float(
+        os.environ.get('QUERY_CACHE_CLOCK_SKEW') or 1)
+    BROADCAST_BATCH_SIZE = 500
+    BROADCAST_MAX_RECIPIENTS = int(
+        os.environ.get('BROADCAST_MAX_RECIPIENTS') or 5000)
+    NOTIFICATION_RETENTION_DAYS = int(
+        os.environ.get('NOTIFICATION_RETENTION_DAYS') or 30)
+    TASK_RETENTION_DAYS = int(os.environ.get('TASK_RETENTION_DAYS') or 7)
+    MESSAGE_ARCHIVE_DAYS = int(os.environ.get('MESSAGE_ARCHIVE_DAYS') or 365)
+    MESSAGE_ARCHIVE_DIR = os.environ.get('MESSAGE_ARCHIVE_DIR') or \
+        os.path.join(basedir, 'archive')
+    RETENTION_BATCH_SIZE = 500
+    RETENTION_BATCH_PAUSE = 0.1
+    # queues in priority order, workers drain them from left to right
+    TASK_QUEUES = ['erp-crm-tasks-high', 'erp-crm-tasks', 'erp-crm-tasks-low']
+    TASK_DEFAULT_QUEUE = 'erp-crm-tasks'
+    TASK_ROUTES = {
+        'app.tasks.notify_unread_messages': 'erp-crm-tasks-high',
+        'app.tasks.export_posts': 'erp-crm-tasks-low',
+        'app.scheduler.run_job': 'erp-crm-tasks-low'
+    }
+    TASK_LOCK_TIMEOUT = int(os.environ.get('TASK_LOCK_TIMEOUT') or 3600)
+    PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED') is not None
+    PROFILER_INTERVAL = float(os.environ.get('PROFILER_INTERVAL') or 0.01)
+    PROFILER_FLUSH_INTERVAL = int(
+        os.environ.get('PROFILER_FLUSH_INTERVAL') or 10)
+    IMPORT_TIME_BUDGET = int(os.environ.get('IMPORT_TIME_BUDGET') or 1500)
@@ -1,8 +1,39 @@
 #!/usr/bin/env python
+import base64
 from datetime import datetime, timedelta
+from decimal import Decimal
+import gzip
+import json
+import logging
+import os
+import pickle
+import queue
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import time
 import unittest
-from app import create_app, db
-from app.models import User, Post
+from unittest import mock
+import zlib
+import brotli
+import fakeredis
+from flask import render_template, session
+import requests
+import sqlalchemy as sa
+from app import create_app, db, cli, logs
+from app import directory, recommendations
+from app.api.idempotency import idempotent
+from app.assets import asset_url, build as build_assets
+from app import scheduler
+from app.cache import single_flight
+from app import maintenance, profiler, resilience, serialization
+from app.ranks import rank_between, spread
+from app.search import query_index
+from app.translate import translate
+from app.models import User, Post, Message, Conversation, Notification, \
+    Task, ReplicaHeartbeat, Board, Card, PipelineRollup
 from config import Config
 
 
@@ -10,6 +41,21 @@ class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     ELASTICSEARCH_URL = None
+    RATELIMIT_ENABLED = False
+
+
+class RecordingQueue(object):
+    def __init__(self):
+        self.jobs = []
+
+    def enqueue(self, name, *args, **kwargs):
+        self.jobs.append((name, args))
+
+
+def record_jobs(app):
+    app.task_queues = {name: RecordingQueue()
+                       for name in app.config['TASK_QUEUES']}
+    return app.task_queues
 
 
 class UserModelCase(unittest.TestCase):
@@ -98,5 +144,1910 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f4, [p4])
 
 
+class MessageCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.susan = User(username='susan', email='susan@example.com')
+        self.mary = User(username='mary', email='mary@example.com')
+        db.session.add_all([self.john, self.susan, self.mary])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def summary(self, user):
+        return [(c.peer.username, c.last_message.body, c.unread_count)
+                for c in user.conversations.order_by(
+                    Conversation.last_timestamp.desc())]
+
+    def test_unread_counter(self):
+        self.john.send_message(self.susan, 'hi susan')
+        self.mary.send_message(self.susan, 'hi from mary')
+        self.john.send_message(self.susan, 'are you there?')
+        db.session.commit()
+        self.assertEqual(self.susan.new_messages(), 3)
+        self.assertEqual(self.john.new_messages(), 0)
+        self.assertEqual(self.summary(self.susan),
+                         [('john', 'are you there?', 2),
+                          ('mary', 'hi from mary', 1)])
+        self.assertEqual(self.summary(self.john),
+                         [('susan', 'are you there?', 0)])
+
+        self.susan.read_messages()
+        db.session.commit()
+        self.assertEqual(self.susan.new_messages(), 0)
+        self.assertEqual([c[2] for c in self.summary(self.susan)], [0, 0])
+
+    def test_rebuild(self):
+        self.john.send_message(self.susan, 'one')
+        self.susan.send_message(self.john, 'two')
+        self.susan.read_messages()
+        db.session.commit()
+        self.mary.send_message(self.susan, 'three')
+        self.mary.send_message(self.mary, 'note to self')
+        db.session.commit()
+        expected = {u.username: (u.new_messages(), self.summary(u))
+                    for u in User.query}
+        db.session.execute(User.__table__.update().values(unread_messages=0))
+        db.session.execute(Conversation.__table__.delete())
+        Conversation.rebuild()
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual({u.username: (u.new_messages(), self.summary(u))
+                          for u in User.query}, expected)
+
+    def test_broadcast(self):
+        self.mary.send_message(self.susan, 'earlier')
+        db.session.commit()
+        others = [User(username='user{}'.format(i),
+                       email='user{}@example.com'.format(i))
+                  for i in range(600)]
+        db.session.add_all(others)
+        db.session.commit()
+        ids = self.mary.broadcast_message(
+            others + [self.susan, self.john, self.mary], 'hello all')
+        db.session.commit()
+        self.assertEqual(len(ids), 602)
+        self.assertEqual(Message.query.filter_by(body='hello all').count(),
+                         602)
+        self.assertEqual(self.susan.new_messages(), 2)
+        self.assertEqual(others[-1].new_messages(), 1)
+        self.assertEqual(self.summary(self.susan),
+                         [('mary', 'hello all', 2)])
+        self.assertEqual(self.mary.conversations.count(), 602)
+        self.assertEqual(self.mary.conversations.filter(
+            Conversation.unread_count > 0).count(), 0)
+
+        from app.tasks import notify_unread_messages
+        self.susan.add_notification('unread_message_count', 1)
+        db.session.commit()
+        notify_unread_messages(ids)
+        self.assertEqual(Notification.query.count(), 602)
+        self.assertEqual(self.susan.notifications.one().get_data(), 2)
+
+    def test_broadcast_api(self):
+        queues = record_jobs(self.app)
+        token = self.john.get_token()
+        db.session.commit()
+        client = self.app.test_client()
+        headers = {'Authorization': 'Bearer ' + token}
+        rv = client.post('/api/messages/broadcast', headers=headers, json={
+            'recipients': [self.susan.id, self.mary.id], 'body': 'hi'})
+        self.assertEqual(rv.status_code, 202)
+        self.assertEqual(rv.get_json(), {'recipients': 2})
+        self.assertEqual(queues['erp-crm-tasks-high'].jobs,
+                         [('app.tasks.notify_unread_messages',
+                           ([self.susan.id, self.mary.id],))])
+        rv = client.post('/api/messages/broadcast', headers=headers, json={
+            'recipients': [self.susan.id, 999], 'body': 'hi'})
+        self.assertEqual(rv.status_code, 400)
+        rv = client.post('/api/messages/broadcast', headers=headers, json={
+            'recipients': [self.susan.id], 'body': ['hi']})
+        self.assertEqual(rv.status_code, 400)
+
+    def test_broadcast_when_the_queue_is_down(self):
+        self.app.task_queues = {name: BrokenRedis()
+                                for name in self.app.config['TASK_QUEUES']}
+        token = self.john.get_token()
+        db.session.commit()
+        rv = self.app.test_client().post(
+            '/api/messages/broadcast',
+            headers={'Authorization': 'Bearer ' + token},
+            json={'recipients': [self.susan.id], 'body': 'hi'})
+        self.assertEqual(rv.status_code, 202)
+        self.assertEqual(self.susan.new_messages(), 1)
+
+    def test_broadcast_with_second_precision(self):
+        # like a MySQL DATETIME column, drop the fractional seconds
+        DATETIME_RE = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.')
+
+        def truncate(conn, cursor, statement, parameters, context,
+                     executemany):
+            if executemany:
+                parameters = [tuple(
+                    p[:19] if isinstance(p, str) and
+                    DATETIME_RE.match(p) else p for p in row)
+                    for row in parameters]
+            return statement, parameters
+
+        sa.event.listen(db.engine, 'before_cursor_execute', truncate,
+                        retval=True)
+        self.addCleanup(sa.event.remove, db.engine, 'before_cursor_execute',
+                        truncate)
+        self.mary.broadcast_message([self.susan, self.john], 'hello')
+        db.session.commit()
+        message = Message.query.filter_by(recipient_id=self.susan.id).one()
+        self.assertEqual(message.timestamp.microsecond, 0)
+        self.assertEqual(self.summary(self.susan), [('mary', 'hello', 1)])
+        self.assertEqual(self.mary.conversations.filter(
+            Conversation.last_message_id.isnot(None)).count(), 2)
+
+    def test_notification_is_updated_in_place(self):
+        n1 = self.susan.add_notification('unread_message_count', 1)
+        db.session.commit()
+        n2 = self.susan.add_notification('unread_message_count', 2)
+        db.session.commit()
+        self.assertEqual(n1.id, n2.id)
+        self.assertEqual(Notification.query.one().get_data(), 2)
+
+
+class MaintenanceCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        class MaintenanceConfig(TestConfig):
+            MESSAGE_ARCHIVE_DIR = self.tmpdir
+            RETENTION_BATCH_SIZE = 2
+            RETENTION_BATCH_PAUSE = 0
+
+        self.app = create_app(MaintenanceConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_purge(self):
+        old = time() - 365 * 24 * 3600
+        for i in range(5):
+            db.session.add(Notification(name='n', user=self.john,
+                                        timestamp=old, payload_json='1'))
+            db.session.add(Task(id=str(i), name='t', user=self.john,
+                                complete=i < 3, timestamp=old))
+        db.session.add(Notification(name='n', user=self.john,
+                                    payload_json='1'))
+        db.session.add(Task(id='new', name='t', user=self.john,
+                            complete=True))
+        db.session.commit()
+        self.assertEqual(maintenance.run(), {'notifications': 5, 'tasks': 3,
+                                             'messages': 0})
+        self.assertEqual(Notification.query.count(), 1)
+        self.assertEqual(sorted(t.id for t in Task.query), ['3', '4', 'new'])
+
+    def test_archive_and_restore(self):
+        for month in (1, 1, 2, 3):
+            self.john.send_message(self.susan, 'month {}'.format(month))
+            db.session.flush()
+        Message.query.update({'timestamp': db.case(
+            [(Message.body == 'month 1', datetime(2001, 1, 15, 10, 30)),
+             (Message.body == 'month 2', datetime(2001, 2, 1))],
+            else_=datetime(2001, 3, 1))}, synchronize_session=False)
+        db.session.commit()
+        self.assertEqual(maintenance.archive_messages(), 3)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['messages-2001-01.ndjson.gz',
+                          'messages-2001-02.ndjson.gz'])
+        self.assertEqual(Message.query.count(), 1)  # last in conversation
+
+        self.assertEqual(maintenance.restore_messages('2001-01'), 2)
+        self.assertEqual(maintenance.restore_messages('2001-01'), 0)
+        self.assertEqual(Message.query.filter_by(body='month 1').count(), 2)
+        self.assertEqual(Message.query.first().timestamp,
+                         datetime(2001, 1, 15, 10, 30))
+        with self.assertRaises(ValueError):
+            maintenance.restore_messages('1999-01')
+
+
+class ReplicaRoutingCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        primary = os.path.join(self.tmpdir, 'primary.db')
+        replica = os.path.join(self.tmpdir, 'replica.db')
+
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + primary
+            SQLALCHEMY_REPLICA_URIS = ['sqlite:///' + replica]
+
+        self.app = create_app(ReplicaConfig)
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.replica = sa.create_engine('sqlite:///' + replica)
+        db.metadata.create_all(self.replica)
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        self.pool = self.app.extensions['replicas']
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.replica.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def sync_replica(self, lag=0):
+        self.pool.heartbeat()
+        primary_time = ReplicaHeartbeat.query.get(1).timestamp
+        db.session.remove()
+        with self.replica.begin() as conn:
+            conn.execute(User.__table__.delete())
+            conn.execute(ReplicaHeartbeat.__table__.delete())
+            conn.execute(User.__table__.insert().values(
+                id=2, username='replica', email='replica@example.com'))
+            conn.execute(ReplicaHeartbeat.__table__.insert().values(
+                id=1, timestamp=primary_time - lag))
+        self.pool.last_check = 0
+
+    def test_reads_go_to_replica(self):
+        self.sync_replica()
+        self.pool.check()
+        with self.app.test_request_context('/explore'):
+            self.app.preprocess_request()
+            self.assertEqual([u.username for u in User.query.all()],
+                             ['replica'])
+
+    def test_writes_go_to_primary(self):
+        self.sync_replica()
+        self.pool.check()
+        with self.app.test_request_context('/explore'):
+            self.app.preprocess_request()
+            db.session.add(User(username='susan', email='susan@example.com'))
+            db.session.commit()
+        db.session.remove()
+        self.assertEqual(User.query.count(), 2)
+
+    def test_write_requests_stay_on_primary(self):
+        self.sync_replica()
+        with self.app.test_request_context('/follow/john', method='POST'):
+            self.app.preprocess_request()
+            self.assertEqual(User.query.first().username, 'john')
+            self.app.process_response(self.app.response_class())
+            self.assertGreater(session['_primary_until'], time())
+
+    def test_read_your_writes(self):
+        self.sync_replica()
+        with self.app.test_request_context('/explore'):
+            session['_primary_until'] = time() + 10
+            self.app.preprocess_request()
+            self.assertEqual(User.query.first().username, 'john')
+
+    def test_api_read_your_writes(self):
+        john = User.query.first()
+        token = john.get_token()
+        db.session.commit()
+        id = john.id
+        self.sync_replica()
+        with self.replica.begin() as conn:
+            conn.execute(User.__table__.insert().values(
+                id=id, username='john-replica', email='j@example.com',
+                token=token, token_expiration=datetime.utcnow() +
+                timedelta(hours=1)))
+        # give each request its own app context and session, as in production
+        self.app_context.pop()
+        try:
+            client = self.app.test_client(use_cookies=False)
+            headers = {'Authorization': 'Bearer ' + token}
+            url = '/api/users/{}'.format(id)
+            self.assertEqual(client.get(url, headers=headers)
+                             .get_json()['username'], 'john-replica')
+            rv = client.put(url, headers=headers, json={'about_me': 'hi'})
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(client.get(url, headers=headers).get_json(),
+                             rv.get_json())
+            # other clients keep reading from the replica
+            self.assertEqual(client.get(url, headers={
+                'Authorization': 'Bearer x' + token}).status_code, 401)
+        finally:
+            self.app_context.push()
+
+    def test_lagging_replica_is_skipped(self):
+        self.sync_replica(lag=60)
+        self.assertEqual(self.pool.check(), [])
+        with self.app.test_request_context('/explore'):
+            self.app.preprocess_request()
+            self.assertEqual(User.query.first().username, 'john')
+
+    def test_requests_do_not_write_the_heartbeat(self):
+        with self.app.test_request_context('/explore'):
+            self.app.preprocess_request()
+            self.assertEqual(User.query.first().username, 'john')
+        self.assertEqual(self.pool.lag, {self.replica.url: None})
+        self.assertIsNone(ReplicaHeartbeat.query.get(1))
+
+
+class StartupCase(unittest.TestCase):
+    def test_clients_are_created_on_first_use(self):
+        app = create_app(TestConfig)
+        for name in ('elasticsearch', 'redis', 'task_queues'):
+            self.assertNotIn(name, app.__dict__)
+        self.assertIsNone(app.elasticsearch)
+        for queue in app.task_queues.values():
+            self.assertIs(queue.connection, app.redis)
+
+    def test_import_does_not_load_client_libraries(self):
+        out = subprocess.check_output(
+            [sys.executable, '-c',
+             'import sys, app; print(" ".join(m for m in ("elasticsearch", '
+             '"redis", "rq", "requests", "guess_language") '
+             'if m in sys.modules))'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            universal_newlines=True)
+        self.assertEqual(out.strip(), '')
+
+    def test_import_time_without_timings(self):
+        app = create_app(TestConfig)
+        cli.register(app)
+        proc = subprocess.CompletedProcess([], 0, '', '')
+        with mock.patch('subprocess.run', return_value=proc):
+            result = app.test_cli_runner().invoke(args=['import-time'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('could not measure the import time of app',
+                      result.output)
+
+
+class MigrationCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        class MigrationConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+                self.tmpdir, 'app.db')
+
+        self.app = create_app(MigrationConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.directory = os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), 'migrations')
+
+    def tearDown(self):
+        db.session.remove()
+        self.app_context.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_message_counters_are_backfilled(self):
+        from flask_migrate import upgrade
+        upgrade(directory=self.directory, revision='934375773d89')
+        db.session.execute(sa.table(
+            'user', sa.column('id'), sa.column('username'),
+            sa.column('email'),
+            sa.column('last_message_read_time', sa.DateTime)).insert(), [
+            {'id': 1, 'username': 'john', 'email': 'john@example.com',
+             'last_message_read_time': None},
+            {'id': 2, 'username': 'susan', 'email': 'susan@example.com',
+             'last_message_read_time': datetime(2020, 1, 1, 12)}])
+        db.session.execute(sa.table(
+            'message', sa.column('id'), sa.column('sender_id'),
+            sa.column('recipient_id'), sa.column('body'),
+            sa.column('timestamp', sa.DateTime)).insert(), [
+            {'id': 1, 'sender_id': 1, 'recipient_id': 2, 'body': 'a',
+             'timestamp': datetime(2020, 1, 1)},
+            {'id': 2, 'sender_id': 1, 'recipient_id': 2, 'body': 'b',
+             'timestamp': datetime(2020, 1, 2)},
+            {'id': 3, 'sender_id': 2, 'recipient_id': 1, 'body': 'c',
+             'timestamp': datetime(2020, 1, 3)}])
+        db.session.commit()
+        upgrade(directory=self.directory)
+        self.assertEqual([u.new_messages() for u in
+                          User.query.order_by(User.id)], [1, 1])
+        self.assertEqual(
+            [(c.user_id, c.peer_id, c.last_message_id, c.unread_count)
+             for c in Conversation.query.order_by(Conversation.user_id)],
+            [(1, 2, 3, 1), (2, 1, 3, 1)])
+
+
+class TemplateCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_app(self, kind):
+        class CacheConfig(TestConfig):
+            TEMPLATE_CACHE = kind
+            TEMPLATE_CACHE_DIR = os.path.join(self.tmpdir, 'templates')
+
+        return create_app(CacheConfig)
+
+    def test_no_cache_by_default(self):
+        self.assertIsNone(create_app(TestConfig).jinja_env.bytecode_cache)
+
+    def test_filesystem_cache(self):
+        app = self.make_app('filesystem')
+        with app.test_request_context('/'):
+            render_template('errors/404.html')
+        self.assertEqual(len(os.listdir(app.config['TEMPLATE_CACHE_DIR'])),
+                         2)  # errors/404.html and base.html
+
+    def test_redis_cache(self):
+        app = self.make_app('redis')
+        app.redis = fakeredis.FakeStrictRedis()
+        cli.register(app)
+        result = app.test_cli_runner().invoke(args=['templates', 'compile'])
+        self.assertEqual(result.exit_code, 0)
+        keys = app.redis.keys('jinja2:*')
+        self.assertEqual(len(keys), len(app.jinja_env.list_templates()))
+
+        app2 = self.make_app('redis')
+        app2.redis = app.redis
+        with app2.test_request_context('/'):
+            self.assertIn('ERP-CRM', render_template('errors/404.html'))
+
+
+class AssetsCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.static = os.path.join(self.tmpdir, 'static')
+        os.makedirs(os.path.join(self.static, 'css'))
+        os.makedirs(os.path.join(self.static, 'fonts'))
+        with open(os.path.join(self.static, 'fonts', 'a.woff'), 'wb') as f:
+            f.write(b'font')
+        with open(os.path.join(self.static, 'css', 'site.css'), 'w') as f:
+            f.write('@font-face {src: url("../fonts/a.woff?v=1")}' +
+                    ' ' * 2000 + 'a {background: url(data:image/png,x)}')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_build(self):
+        manifest_path = os.path.join(self.static, 'dist', 'manifest.json')
+        manifest = build_assets(self.static, 'dist', manifest_path)
+        self.assertEqual(sorted(manifest), ['css/site.css', 'fonts/a.woff'])
+        font = manifest['fonts/a.woff']
+        self.assertRegex(font, r'^dist/fonts/a\.[0-9a-f]{12}\.woff$')
+        css = os.path.join(self.static, manifest['css/site.css'])
+        with open(css) as f:
+            content = f.read()
+        self.assertIn('url("../fonts/{}?v=1")'.format(
+            os.path.basename(font)), content)
+        self.assertIn('url(data:image/png,x)', content)
+        # small files and already compressed formats are left alone
+        self.assertTrue(os.path.exists(css + '.gz'))
+        with open(css + '.br', 'rb') as f:
+            self.assertEqual(brotli.decompress(f.read()).decode(), content)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.static, font) + '.gz'))
+
+        # building again gives the same names
+        self.assertEqual(build_assets(self.static, 'dist', manifest_path),
+                         manifest)
+
+        class AssetsConfig(TestConfig):
+            ASSETS_MANIFEST = manifest_path
+
+        app = create_app(AssetsConfig)
+        with app.test_request_context('/'):
+            self.assertEqual(asset_url('css/site.css'),
+                             '/static/' + manifest['css/site.css'])
+            self.assertEqual(asset_url('js/other.js'),
+                             '/static/js/other.js')
+        self.assertEqual(app.get_send_file_max_age('dist/x.js'),
+                         app.config['ASSETS_MAX_AGE'])
+
+
+class BrokenRedis(object):
+    def __getattr__(self, name):
+        from redis.exceptions import ConnectionError
+
+        def fail(*args, **kwargs):
+            raise ConnectionError('redis is down')
+        return fail
+
+
+class SingleFlightCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.calls = 0
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def compute(self):
+        self.calls += 1
+        return {'calls': self.calls}
+
+    def test_value_is_cached(self):
+        self.assertEqual(single_flight('k', 10, self.compute), {'calls': 1})
+        self.assertEqual(single_flight('k', 10, self.compute), {'calls': 1})
+        self.assertEqual(self.calls, 1)
+
+    def test_expired_value_is_recomputed(self):
+        single_flight('k', -1, self.compute)
+        self.assertEqual(single_flight('k', 10, self.compute), {'calls': 2})
+
+    def test_stale_value_served_while_locked(self):
+        single_flight('k', -1, self.compute)
+        lock = self.app.redis.lock('cache:k:lock', timeout=10)
+        self.assertTrue(lock.acquire(blocking=False))
+        self.assertEqual(single_flight('k', 10, self.compute), {'calls': 1})
+        self.assertEqual(self.calls, 1)
+        lock.release()
+
+    def test_redis_failure_computes_directly(self):
+        self.app.redis = BrokenRedis()
+        self.assertEqual(single_flight('k', 10, self.compute), {'calls': 1})
+        self.assertEqual(single_flight('k', 10, self.compute), {'calls': 2})
+
+
+class QueryCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['QUERY_CACHE_CLOCK_SKEW'] = 0
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        self.queries = []
+        sa.event.listen(db.engine, 'before_cursor_execute', self.record)
+
+    def tearDown(self):
+        sa.event.remove(db.engine, 'before_cursor_execute', self.record)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def record(self, conn, cursor, statement, *args):
+        if statement.startswith('SELECT'):
+            self.queries.append(statement)
+
+    def lookup(self, username):
+        # simulate a new request, sharing only the caches
+        db.session.remove()
+        return User.first_cached(username=username)
+
+    def test_lookup_is_cached(self):
+        self.assertEqual(self.lookup('john').email, 'john@example.com')
+        self.assertEqual(self.lookup('john').email, 'john@example.com')
+        self.assertEqual(len(self.queries), 1)
+        self.assertIsNone(self.lookup('susan'))
+
+    def test_secrets_are_not_cached(self):
+        user = User.query.first()
+        user.set_password('cat')
+        user.get_token()
+        db.session.commit()
+        self.lookup('john')
+        entry = pickle.loads(self.app.redis.get(
+            'qc:user:username=john'))['value']
+        self.assertNotIn('password_hash', entry)
+        self.assertNotIn('token', entry)
+        user = self.lookup('john')
+        self.assertTrue(user.check_password('cat'))
+        self.assertIsNotNone(user.token)
+
+    def test_shared_tier(self):
+        self.lookup('john')
+        self.app.extensions['query_cache'].data.clear()
+        self.assertEqual(self.lookup('john').username, 'john')
+        self.assertEqual(len(self.queries), 1)
+
+    def test_commit_invalidates(self):
+        user = self.lookup('john')
+        user.about_me = 'hello'
+        db.session.commit()
+        self.assertEqual(self.lookup('john').about_me, 'hello')
+        self.assertEqual(len(self.queries), 2)
+
+    def test_last_seen_does_not_invalidate(self):
+        user = self.lookup('john')
+        user.last_seen = datetime.utcnow()
+        db.session.commit()
+        user = self.lookup('john')
+        user.follow(user)
+        db.session.commit()
+        self.assertEqual(self.lookup('john').username, 'john')
+        self.assertEqual(len([q for q in self.queries
+                              if 'user.username = ?' in q]), 1)
+
+    def test_cached_object_is_attached(self):
+        self.lookup('john')
+        user = self.lookup('john')
+        self.assertIn(user, db.session)
+        self.assertEqual(user.posts.count(), 0)
+        user.about_me = 'changed'
+        db.session.commit()
+        self.assertEqual(User.query.get(user.id).about_me, 'changed')
+
+    def test_lru_bound(self):
+        local = self.app.extensions['query_cache']
+        local.maxsize = 1
+        db.session.add(User(username='susan', email='susan@example.com'))
+        db.session.commit()
+        self.lookup('john')
+        self.lookup('susan')
+        self.assertEqual(len(local.data), 1)
+
+
+class CronScheduleCase(unittest.TestCase):
+    def test_matches(self):
+        cron = scheduler.CronSchedule('*/15 9-17 * * 1-5')
+        self.assertTrue(cron.matches(datetime(2021, 3, 1, 9, 30)))  # Monday
+        self.assertFalse(cron.matches(datetime(2021, 3, 1, 9, 31)))
+        self.assertFalse(cron.matches(datetime(2021, 3, 1, 18, 0)))
+        self.assertFalse(cron.matches(datetime(2021, 3, 6, 9, 30)))
+        cron = scheduler.CronSchedule('0 4 1,15 * 0')
+        self.assertTrue(cron.matches(datetime(2021, 3, 7, 4, 0)))  # Sunday
+        self.assertEqual(cron.fields[2], {1, 15})
+
+    def test_invalid(self):
+        for expression in ('* * * *', '60 * * * *', '* * * * 7',
+                           '*/0 * * * *', '5-1 * * * *'):
+            with self.assertRaises(ValueError):
+                scheduler.CronSchedule(expression)
+
+
+class SchedulerCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.queue = record_jobs(self.app)['erp-crm-tasks-low']
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.runs = 0
+        # only the test job, not the ones the application registers
+        patcher = mock.patch.dict(scheduler.jobs, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        scheduler.periodic('*/5 * * * *', name='test_job')(self.job)
+
+    def tearDown(self):
+        del scheduler.jobs['test_job']
+        self.app_context.pop()
+
+    def job(self):
+        self.runs += 1
+
+    def test_single_leader(self):
+        s1 = scheduler.Scheduler(self.app)
+        s2 = scheduler.Scheduler(self.app)
+        s2.node = 'other'
+        self.assertTrue(s1.elect())
+        self.assertFalse(s2.elect())
+        self.assertTrue(s1.elect())
+
+    def test_each_tick_fires_once(self):
+        tick = datetime(2021, 3, 1, 9, 5)
+        timestamp = (tick - datetime(1970, 1, 1)).total_seconds()
+        s1 = scheduler.Scheduler(self.app)
+        s2 = scheduler.Scheduler(self.app)
+        s1.tick(timestamp + 10)
+        s2.tick(timestamp + 20)
+        self.assertEqual(self.queue.jobs,
+                         [('app.scheduler.run_job', ('test_job',))])
+        s1.tick(timestamp + 70)  # 9:06 does not match
+        self.assertEqual(len(self.queue.jobs), 1)
+
+    def test_skip_while_running(self):
+        job = scheduler.jobs['test_job']
+        s = scheduler.Scheduler(self.app)
+        self.assertTrue(s.fire(job, 0))
+        self.assertFalse(s.fire(job, 300))
+        scheduler.run_job('test_job')
+        self.assertEqual(self.runs, 1)
+        self.assertTrue(s.fire(job, 600))
+        data = scheduler.status()['test_job']
+        self.assertEqual(data['schedule'], '*/5 * * * *')
+        self.assertEqual(data['last_status'], 'ok')
+        self.assertEqual(data['last_skipped'], 300)
+        self.assertEqual(data['last_scheduled'], 600)
+
+
+class TaskCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_routing(self):
+        self.user.launch_task('export_posts', 'Exporting posts...')
+        queues = self.app.task_queues
+        self.assertEqual(queues['erp-crm-tasks-low'].count, 1)
+        self.assertEqual(queues['erp-crm-tasks'].count, 0)
+        self.app.enqueue('app.tasks.notify_unread_messages', [self.user.id])
+        self.assertEqual(queues['erp-crm-tasks-high'].count, 1)
+
+    def test_one_task_in_flight(self):
+        task = self.user.launch_task('export_posts', 'Exporting posts...')
+        db.session.commit()
+        self.assertIsNotNone(task)
+        self.assertIsNone(
+            self.user.launch_task('export_posts', 'Exporting posts...'))
+        self.assertEqual(Task.query.count(), 1)
+        task.complete = True
+        db.session.commit()
+        task.release_lock()
+        self.assertIsNotNone(
+            self.user.launch_task('export_posts', 'Exporting posts...'))
+
+    def test_progress_many(self):
+        t1 = self.user.launch_task('export_posts', 'Exporting posts...')
+        job = self.app.task_queues['erp-crm-tasks-low'].fetch_job(t1.id)
+        job.meta['progress'] = 40
+        job.save_meta()
+        t2 = Task(id='gone', name='other', user=self.user)
+        t3 = self.user.launch_task('import_posts', 'Importing posts...')
+        db.session.add(t2)
+        db.session.commit()
+        # Job.fetch_many is not available in the pinned rq 1.0
+        with mock.patch('rq.job.Job.fetch_many', create=True,
+                        side_effect=AttributeError):
+            self.assertEqual(Task.get_progress_many([t1, t2, t3]),
+                             {t1.id: 40, 'gone': 100, t3.id: 0})
+        self.assertEqual(t1.get_progress(), 40)
+        self.app.redis = BrokenRedis()
+        self.assertEqual(Task.get_progress_many([t1]), {t1.id: 100})
+
+
+class LoggingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+
+    def test_request_id(self):
+        client = self.app.test_client()
+        rv = client.get('/auth/login', headers={'X-Request-ID': 'abc-123'})
+        self.assertEqual(rv.headers['X-Request-ID'], 'abc-123')
+        rv = client.get('/auth/login', headers={'X-Request-ID': '<script>'})
+        self.assertEqual(len(rv.headers['X-Request-ID']), 32)
+
+    def test_json_lines_through_queue(self):
+        records = queue.Queue()
+        handler = logs.LogQueueHandler(records)
+        handler.addFilter(logs.RequestIdFilter())
+        logger = logging.getLogger('tests.logging')
+        logger.addHandler(handler)
+        try:
+            with self.app.test_request_context('/'):
+                logs.start_request()
+                try:
+                    1 / 0
+                except ZeroDivisionError:
+                    logger.exception('failed %s', 'here',
+                                     extra={'duration_ms': 1.5})
+        finally:
+            logger.removeHandler(handler)
+        data = json.loads(logs.JSONFormatter().format(records.get_nowait()))
+        self.assertEqual(data['message'], 'failed here')
+        self.assertEqual(data['level'], 'ERROR')
+        self.assertEqual(data['duration_ms'], 1.5)
+        self.assertEqual(len(data['request_id']), 32)
+        self.assertIn('ZeroDivisionError', data['exception'])
+
+    def test_error_emails_are_aggregated(self):
+        sent = []
+        handler = logs.RateLimitedSMTPHandler(
+            'localhost', 'from@example.com', ['admin@example.com'],
+            'Failure', interval=60, capacity=2)
+        handler.send = sent.append
+        for i in range(4):
+            handler.handle(logging.makeLogRecord({
+                'msg': 'error %d' % i, 'levelno': logging.ERROR}))
+        self.assertEqual(len(sent), 1)
+        handler.flush()
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(handler.getSubject(sent[1]), 'Failure (3 errors)')
+        self.assertIn('error 2', sent[1].msg)
+        self.assertIn('1 more errors', sent[1].msg)
+
+    def test_error_digest_is_sent_on_a_timer(self):
+        sent = []
+        handler = logs.RateLimitedSMTPHandler(
+            'localhost', 'from@example.com', ['admin@example.com'],
+            'Failure', interval=0.2)
+        handler.send = sent.append
+        for i in range(3):
+            handler.handle(logging.makeLogRecord({
+                'msg': 'error %d' % i, 'levelno': logging.ERROR}))
+        self.assertEqual(len(sent), 1)
+        handler.timer.join(5)
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(handler.getSubject(sent[1]), 'Failure (2 errors)')
+        self.assertIsNone(handler.timer)
+
+
+class FailingElasticsearch(object):
+    def __init__(self):
+        self.calls = 0
+
+    def search(self, **kwargs):
+        self.calls += 1
+        raise ConnectionError('elasticsearch is down')
+
+
+class ResilienceCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['BREAKER_THRESHOLD'] = 2
+        resilience.Breakers(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_search_fails_fast(self):
+        es = self.app.elasticsearch = FailingElasticsearch()
+        for i in range(4):
+            self.assertEqual(query_index('post', 'hello', 1, 10), ([], 0))
+        self.assertEqual(es.calls, 2)
+        b = resilience.breaker('elasticsearch')
+        self.assertEqual(b.state, 'open')
+        rv = self.app.test_client().get('/api/health')
+        self.assertEqual(rv.get_json()['status'], 'degraded')
+        self.assertEqual(rv.get_json()['breakers']['elasticsearch']['state'],
+                         'open')
+
+        b.opened_at -= b.reset_timeout
+        self.assertEqual(b.state, 'half-open')
+        query_index('post', 'hello', 1, 10)
+        self.assertEqual(es.calls, 3)
+        self.assertEqual(b.state, 'open')
+        b.opened_at -= b.reset_timeout
+        self.app.elasticsearch = mock.Mock(search=mock.Mock(return_value={
+            'hits': {'hits': [{'_id': '1'}], 'total': {'value': 1}}}))
+        self.assertEqual(query_index('post', 'hello', 1, 10), ([1], 1))
+        self.assertEqual(b.state, 'closed')
+
+    def test_translator_timeout(self):
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        with self.app.test_request_context(), mock.patch(
+                'requests.post', side_effect=requests.Timeout()) as post:
+            for i in range(2):
+                self.assertIn('failed', translate('hola', 'es', 'en'))
+            self.assertIn('not available', translate('hola', 'es', 'en'))
+        self.assertEqual(post.call_count, 2)
+        self.assertEqual(post.call_args[1]['timeout'],
+                         self.app.config['TRANSLATOR_TIMEOUT'])
+
+    def test_redis_circuit(self):
+        from redis.exceptions import ConnectionError
+        b = resilience.breaker('redis')
+        r = resilience.guarded_redis('redis://localhost:1', b,
+                                     socket_connect_timeout=0.1)
+        for i in range(2):
+            with self.assertRaises(ConnectionError):
+                r.get('key')
+        with self.assertRaises(ConnectionError) as cm:
+            r.get('key')
+        self.assertIn('unavailable', str(cm.exception))
+        self.assertEqual(b.state, 'open')
+
+
+class ProfilerCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.profiler = profiler.SamplingProfiler(self.app)
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_sample_and_dump(self):
+        self.profiler.sample()
+        self.assertEqual(self.profiler.stacks, {})
+        self.profiler.track()
+        self.profiler.sample()
+        self.profiler.sample()
+        self.profiler.untrack()
+        self.profiler.flush()
+        self.profiler.flush()
+        stacks = profiler.get_stacks()
+        self.assertEqual(list(stacks.values()), [2])
+        stack = list(stacks)[0].split(';')
+        self.assertEqual(stack[-2], 'test_sample_and_dump (tests.py:{})'
+                         .format(self.test_sample_and_dump.__code__
+                                 .co_firstlineno))
+        self.assertTrue(profiler.folded(stacks).endswith(' 2\n'))
+        data = json.loads(profiler.speedscope(stacks))
+        self.assertEqual(data['profiles'][0]['weights'], [2])
+        self.assertEqual(len(data['profiles'][0]['samples'][0]), len(stack))
+        profiler.reset()
+        self.assertEqual(profiler.get_stacks(), {})
+
+    def test_admin_only(self):
+        db.create_all()
+        admin = User(username='admin', email='admin@example.com')
+        john = User(username='john', email='john@example.com')
+        db.session.add_all([admin, john])
+        token = john.get_token()
+        db.session.commit()
+        self.app.config['ADMIN_USER_IDS'] = [admin.id]
+        client = self.app.test_client()
+        # taking an address from ADMINS does not make john an admin
+        rv = client.put('/api/users/{}'.format(john.id),
+                        headers={'Authorization': 'Bearer ' + token},
+                        json={'email': self.app.config['ADMINS'][0]})
+        self.assertEqual(rv.status_code, 200)
+        for username, status in (('john', 403), ('admin', 200)):
+            with client.session_transaction() as sess:
+                sess['_user_id'] = str(User.query.filter_by(
+                    username=username).first().id)
+            rv = client.get('/admin/profile?format=speedscope')
+            self.assertEqual(rv.status_code, status)
+        self.assertEqual(rv.get_json()['profiles'][0]['samples'], [])
+        db.session.remove()
+        db.drop_all()
+
+
+class SerializationCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_backends(self):
+        data = {'a': [1, 2.5, None, 'x\u00e9'],
+                'when': datetime(2021, 1, 2, 3, 4, 5),
+                'value': Decimal('0.10'),
+                'raw': serialization.RawJSON('{"b": [1, 2]}')}
+        for backend in serialization.BACKENDS:
+            self.app.config['JSON_BACKEND'] = backend
+            self.assertEqual(json.loads(serialization.dumps(data)), {
+                'a': [1, 2.5, None, 'x\u00e9'],
+                'when': '2021-01-02T03:04:05Z', 'value': '0.10',
+                'raw': {'b': [1, 2]}})
+
+    def test_streamed_collection(self):
+        users = [User(username='user%d' % i, email='user%d@example.com' % i,
+                      last_seen=datetime(2021, 1, 1)) for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        token = users[0].get_token()
+        db.session.commit()
+        client = self.app.test_client()
+        rv = client.get('/api/users?page=2&per_page=2',
+                        headers={'Authorization': 'Bearer ' + token})
+        self.assertTrue(rv.is_streamed)
+        with self.app.test_request_context():
+            expected = User.to_collection_dict(User.query, 2, 2,
+                                               'api.get_users')
+        self.assertEqual(rv.get_json(), expected)
+        self.assertEqual([u['username'] for u in rv.get_json()['items']],
+                         ['user2', 'user3'])
+
+    def test_notifications_pass_payload_through(self):
+        user = User(username='john', email='john@example.com')
+        db.session.add(user)
+        user.add_notification('unread_message_count', {'count': 3})
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(user.id)
+        rv = client.get('/notifications')
+        self.assertEqual(rv.get_json()[0]['data'], {'count': 3})
+
+
+class CompressionCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['COMPRESS_MIN_SIZE'] = 100
+        self.events = queue.Queue()
+
+        def events():
+            def generate():
+                while True:
+                    event = self.events.get()
+                    if event is None:
+                        return
+                    yield 'data: {}\n\n'.format(event)
+            return self.app.response_class(generate(),
+                                           mimetype='text/event-stream')
+        self.app.add_url_rule('/events', 'events', events)
+        self.app.add_url_rule('/text/<int:size>', 'text', lambda size: (
+            'x' * size, 200, {'Content-Type': 'text/plain'}))
+        self.client = self.app.test_client()
+
+    def get(self, url, encoding='gzip, deflate', **kwargs):
+        return self.client.get(url, headers={'Accept-Encoding': encoding},
+                               **kwargs)
+
+    def test_gzip(self):
+        rv = self.get('/text/1000')
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(rv.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(rv.data), b'x' * 1000)
+        self.assertEqual(int(rv.headers['Content-Length']), len(rv.data))
+
+    def test_brotli(self):
+        rv = self.get('/text/1000', 'gzip, deflate, br')
+        self.assertEqual(rv.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(rv.data), b'x' * 1000)
+        self.assertEqual(self.get('/text/1000', 'br;q=0.5, gzip')
+                         .headers['Content-Encoding'], 'gzip')
+        self.events.put('one')
+        self.events.put(None)
+        rv = self.get('/events', 'br')
+        self.assertEqual(rv.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(rv.data), b'data: one\n\n')
+
+    def test_not_compressed(self):
+        for rv in (self.get('/text/50'), self.get('/text/1000', 'identity'),
+                   self.get('/text/1000', 'gzip;q=0'),
+                   self.get('/static/images/logo.png')):
+            self.assertNotIn('Content-Encoding', rv.headers)
+            rv.close()
+
+    def test_stream_is_flushed(self):
+        # the test client reads the first chunk before it returns
+        self.events.put('one')
+        rv = self.get('/events', buffered=False)
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', rv.headers)
+        chunks = iter(rv.response)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(decompressor.decompress(next(chunks)),
+                         b'data: one\n\n')
+        # the next event can be decoded as soon as it is sent
+        self.events.put('two')
+        self.assertEqual(decompressor.decompress(next(chunks)),
+                         b'data: two\n\n')
+        self.events.put(None)
+        for chunk in chunks:
+            decompressor.decompress(chunk)
+        self.assertTrue(decompressor.eof)
+
+
+class UserAPICase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['API_INCLUDE_LIMIT'] = 2
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.users = [User(username='user%d' % i,
+                           email='user%d@example.com' % i) for i in range(5)]
+        db.session.add_all(self.users)
+        db.session.commit()
+        for user in self.users[1:]:
+            user.follow(self.users[0])
+        self.users[0].follow(self.users[1])
+        db.session.add(Post(body='hi', author=self.users[0]))
+        db.session.commit()
+        self.headers = {'Authorization': 'Bearer ' +
+                        self.users[0].get_token()}
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.statements = []
+        sa.event.listen(db.engine, 'before_cursor_execute', self.record)
+
+    def tearDown(self):
+        sa.event.remove(db.engine, 'before_cursor_execute', self.record)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def record(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def get(self, url):
+        self.statements = []
+        rv = self.client.get(url, headers=self.headers)
+        self.assertEqual(rv.status_code, 200)
+        return rv.get_json()
+
+    def test_sparse_fields(self):
+        data = self.get('/api/users?fields=id,username')
+        self.assertEqual(data['items'][0], {'id': 1, 'username': 'user0'})
+        self.assertIn('fields=id%2Cusername', data['_links']['self'])
+        self.assertFalse([s for s in self.statements if 'user.token =' not in s
+                          and ('user.email' in s or 'FROM post' in s or
+                               'FROM followers' in s)])
+        data = self.get('/api/users/1?fields=follower_count,post_count')
+        self.assertEqual(data, {'follower_count': 4, 'post_count': 1})
+
+    def test_counts_are_batched(self):
+        data = self.get('/api/users?per_page=2')
+        small = len(self.statements)
+        data = self.get('/api/users?per_page=5')
+        self.assertEqual(len(self.statements), small)
+        self.assertEqual([(u['follower_count'], u['followed_count'])
+                          for u in data['items']],
+                         [(4, 1), (1, 1), (0, 1), (0, 1), (0, 1)])
+        with self.app.test_request_context():
+            self.assertEqual(data['items'][0], self.users[0].to_dict())
+
+    def test_include(self):
+        data = self.get('/api/users?fields=id&include=followers,followed')
+        embedded = [u['_embedded'] for u in data['items']]
+        self.assertEqual(embedded[0], {'followers': [{'id': 2}, {'id': 3}],
+                                       'followed': [{'id': 2}]})
+        self.assertEqual(embedded[2], {'followers': [],
+                                       'followed': [{'id': 1}]})
+        rv = self.client.get('/api/users?include=posts,friends',
+                             headers=self.headers)
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(rv.get_json()['message'],
+                         'unknown fields: friends, posts')
+
+    def test_include_without_window_functions(self):
+        expected = self.get('/api/users?fields=id&include=followers,followed')
+        with mock.patch('app.models.has_window_functions',
+                        return_value=False):
+            data = self.get('/api/users?fields=id&include=followers,followed')
+        self.assertEqual(data, expected)
+        self.assertFalse([s for s in self.statements if 'OVER' in s])
+
+
+class BatchAPICase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+        self.john.follow(self.susan)
+        self.headers = {'Authorization': 'Bearer ' + self.john.get_token()}
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def batch(self, items):
+        return self.client.post('/api/batch', json=items,
+                                headers=self.headers)
+
+    def test_batch(self):
+        with mock.patch.object(User, 'check_token',
+                               wraps=User.check_token) as check_token:
+            rv = self.batch([
+                {'path': '/api/users/1?fields=id,username'},
+                {'path': '/api/users/1/followed?fields=username'},
+                {'method': 'PUT', 'path': '/api/users/1',
+                 'body': {'about_me': 'hello'}},
+                {'path': '/api/users/1?fields=about_me'},
+                {'path': '/api/users/99'},
+                {'method': 'PUT', 'path': '/api/users/2', 'body': {}}])
+        self.assertEqual(check_token.call_count, 1)
+        self.assertEqual(rv.status_code, 200)
+        results = rv.get_json()
+        self.assertEqual([r['status'] for r in results],
+                         [200, 200, 200, 200, 404, 403])
+        self.assertEqual(results[0]['body'], {'id': 1, 'username': 'john'})
+        self.assertEqual(results[1]['body']['items'],
+                         [{'username': 'susan'}])
+        self.assertEqual(results[3]['body'], {'about_me': 'hello'})
+        self.assertEqual(results[0]['headers']['Content-Type'],
+                         'application/json')
+
+    def test_failed_write_is_isolated(self):
+        from_dict = User.from_dict
+
+        def fail_once(user, data, new_user=False):
+            from_dict(user, data, new_user)
+            fail_once.calls += 1
+            if fail_once.calls == 1:
+                db.session.add(User(username='susan'))
+                db.session.flush()  # raises IntegrityError
+        fail_once.calls = 0
+
+        with mock.patch.object(User, 'from_dict', fail_once):
+            rv = self.batch([
+                {'method': 'PUT', 'path': '/api/users/1',
+                 'body': {'username': 'johnny'}},
+                {'method': 'PUT', 'path': '/api/users/1',
+                 'body': {'about_me': 'hello'}}])
+        self.assertEqual([r['status'] for r in rv.get_json()], [500, 200])
+        db.session.remove()
+        user = User.query.get(1)
+        self.assertEqual((user.username, user.about_me), ('john', 'hello'))
+
+    def test_limits(self):
+        self.app.config['BATCH_MAX_REQUESTS'] = 2
+        self.assertEqual(self.batch([{'path': '/api/users/1'}] * 3)
+                         .status_code, 400)
+        for item in ({'path': '/auth/login'}, {'path': '/api/batch'},
+                     {'path': '/api/users', 'method': 'TRACE'}):
+            self.assertEqual(self.batch([item]).status_code, 400)
+        rv = self.client.post('/api/batch', json=[{'path': '/api/users/1'}])
+        self.assertEqual(rv.status_code, 401)
+
+    def test_no_nesting(self):
+        for path in ('/api/%62atch', '/api/batch?x=1'):
+            rv = self.batch([{'path': path, 'method': 'POST', 'body': [
+                {'path': '/api/users/1'}]}])
+            self.assertEqual(rv.status_code, 400)
+        with mock.patch('app.api.batch.is_batch', return_value=False):
+            rv = self.batch([{'path': '/api/batch', 'method': 'POST',
+                              'body': [{'path': '/api/users/1'}]}])
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.get_json()[0]['status'], 400)
+
+
+class PostAPICase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['API_STREAM_BATCH_SIZE'] = 3
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.susan = User(username='susan', email='susan@example.com')
+        self.mary = User(username='mary', email='mary@example.com')
+        db.session.add_all([self.john, self.susan, self.mary])
+        now = datetime(2021, 1, 1)
+        for i in range(10):
+            # pairs of posts share a timestamp to exercise the tie breaker
+            db.session.add(Post(
+                body='post %d' % i,
+                author=(self.john, self.susan, self.mary)[i % 3],
+                timestamp=now + timedelta(seconds=i // 2)))
+        db.session.commit()
+        self.john.follow(self.susan)
+        self.headers = {'Authorization': 'Bearer ' + self.john.get_token()}
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get_all(self, url):
+        bodies = []
+        while url:
+            rv = self.client.get(url, headers=self.headers)
+            self.assertEqual(rv.status_code, 200)
+            data = rv.get_json()
+            bodies += [post['body'] for post in data['items']]
+            url = data['_links']['next']
+        return bodies
+
+    def test_cursor_paging(self):
+        self.assertEqual(self.get_all('/api/posts?limit=3'),
+                         ['post %d' % i for i in range(9, -1, -1)])
+        self.assertEqual(self.get_all('/api/users/2/posts?limit=2'),
+                         ['post 7', 'post 4', 'post 1'])
+        self.assertEqual(self.get_all('/api/feed?limit=4'),
+                         ['post %d' % i for i in (9, 7, 6, 4, 3, 1, 0)])
+        rv = self.client.get('/api/posts?cursor=nonsense',
+                             headers=self.headers)
+        self.assertEqual(rv.status_code, 400)
+
+    def test_ndjson(self):
+        headers = dict(self.headers, Accept='application/x-ndjson')
+        rv = self.client.get('/api/feed', headers=headers)
+        self.assertTrue(rv.is_streamed)
+        self.assertEqual(rv.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in
+                 rv.get_data(as_text=True).splitlines()]
+        self.assertEqual([line['body'] for line in lines],
+                         ['post %d' % i for i in (9, 7, 6, 4, 3, 1, 0)])
+        rv = self.client.get('/api/feed?format=ndjson&cursor=' +
+                             lines[3]['_cursor'], headers=self.headers)
+        self.assertEqual(len(rv.get_data(as_text=True).splitlines()), 3)
+
+
+class IdempotencyCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def create_user(self, key, username='john'):
+        return self.client.post('/api/users', headers={
+            'Idempotency-Key': key}, json={
+                'username': username, 'email': username + '@example.com',
+                'password': 'cat'})
+
+    def test_replay(self):
+        with mock.patch.object(User, 'set_password',
+                               wraps=User.set_password,
+                               autospec=True) as set_password:
+            rv1 = self.create_user('abc')
+            rv2 = self.create_user('abc')
+        self.assertEqual(set_password.call_count, 1)
+        self.assertEqual(rv1.status_code, 201)
+        self.assertEqual(rv2.status_code, 201)
+        self.assertEqual(rv2.get_json(), rv1.get_json())
+        self.assertEqual(rv2.headers['Location'], rv1.headers['Location'])
+        self.assertEqual(rv2.headers['Idempotent-Replayed'], 'true')
+        self.assertNotIn('Idempotent-Replayed', rv1.headers)
+        self.assertEqual(User.query.count(), 1)
+        self.assertEqual(self.create_user('abc', 'susan').status_code, 422)
+        self.assertEqual(self.create_user('xyz').status_code, 400)
+
+    def test_replays_are_authenticated(self):
+        for username in ('john', 'susan'):
+            user = User(username=username, email=username + '@example.com')
+            user.set_password('cat')
+            db.session.add(user)
+        db.session.commit()
+
+        def get_token(credentials):
+            return self.client.post('/api/tokens', headers={
+                'Idempotency-Key': 'abc', 'Authorization': 'Basic ' +
+                base64.b64encode(credentials).decode()})
+
+        with mock.patch.object(User, 'check_password',
+                               wraps=User.check_password,
+                               autospec=True) as check_password:
+            rv1 = get_token(b'john:cat')
+            rv2 = get_token(b'john:cat')
+        self.assertEqual(check_password.call_count, 2)
+        self.assertEqual(rv2.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(rv1.get_json(), rv2.get_json())
+        self.assertEqual(get_token(b'john:dog').status_code, 401)
+        # the same key from another user is another request
+        rv3 = get_token(b'susan:cat')
+        self.assertNotIn('Idempotent-Replayed', rv3.headers)
+        self.assertNotEqual(rv3.get_json(), rv1.get_json())
+
+    def test_expired_lock_is_not_released(self):
+        # the lock timed out while the view ran and another request took it
+        def view():
+            view.lock, = self.app.redis.keys('idempotency:*:lock')
+            self.app.redis.set(view.lock, 'other')
+            return 'done'
+        with self.app.test_request_context(headers={'Idempotency-Key': 'a'}):
+            self.assertEqual(idempotent(view)().get_data(), b'done')
+        self.assertEqual(self.app.redis.get(view.lock), b'other')
+
+    def test_concurrent_duplicate(self):
+        # another request with the same key holds the lock
+        with mock.patch.object(self.app.redis, 'set', return_value=None):
+            rv = self.create_user('abc')
+        self.assertEqual(rv.status_code, 409)
+        self.assertEqual(User.query.count(), 0)
+
+
+class RankCase(unittest.TestCase):
+    def test_rank_between(self):
+        ranks = []
+        for i in range(200):
+            j = (i * 7) % (len(ranks) + 1)
+            ranks.insert(j, rank_between(ranks[j - 1] if j > 0 else None,
+                                         ranks[j] if j < len(ranks) else None))
+        self.assertEqual(ranks, sorted(ranks))
+        self.assertEqual(len(set(ranks)), len(ranks))
+        self.assertRaises(ValueError, rank_between, 'b', 'a')
+
+    def test_spread(self):
+        for count in (1, 35, 36, 1000):
+            ranks = spread(count)
+            self.assertEqual(ranks, sorted(set(ranks)))
+            self.assertFalse([rank for rank in ranks if rank.endswith('0')])
+
+
+class BoardAPICase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+        self.headers = {'Authorization': 'Bearer ' + self.john.get_token()}
+        db.session.commit()
+        self.client = self.app.test_client()
+        rv = self.client.post('/api/boards', headers=self.headers, json={
+            'name': 'Sales', 'columns': ['Open', 'Won']})
+        self.assertEqual(rv.status_code, 201)
+        self.board = rv.get_json()
+        self.open, self.won = [c['id'] for c in self.board['columns']]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_card(self, title, **kwargs):
+        kwargs.setdefault('column_id', self.open)
+        rv = self.client.post('/api/boards/{}/cards'.format(
+            self.board['id']), headers=self.headers, json=dict(
+                title=title, **kwargs))
+        self.assertEqual(rv.status_code, 201)
+        return rv.get_json()['id']
+
+    def titles(self):
+        rv = self.client.get('/api/boards/{}'.format(self.board['id']),
+                             headers=self.headers)
+        return [[card['title'] for card in column['cards']]
+                for column in rv.get_json()['columns']]
+
+    def test_place_cards(self):
+        a = self.add_card('a')
+        self.add_card('c')
+        self.add_card('b', after_id=a)
+        self.add_card('top', before_id=a)
+        self.assertEqual(self.titles(), [['top', 'a', 'b', 'c'], []])
+        rv = self.client.post('/api/boards/{}/cards'.format(
+            self.board['id']), headers=self.headers, json={
+                'title': 'x', 'column_id': self.won, 'after_id': a})
+        self.assertEqual(rv.status_code, 400)
+
+    def test_move_updates_one_row(self):
+        ids = [self.add_card(str(i)) for i in range(5)]
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            if statement.startswith('UPDATE'):
+                statements.append(statement)
+        sa.event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            rv = self.client.put('/api/cards/{}'.format(ids[4]),
+                                 headers=self.headers,
+                                 json={'after_id': ids[0]})
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(self.titles(), [['0', '4', '1', '2', '3'], []])
+
+    def test_bulk_move(self):
+        ids = [self.add_card(str(i)) for i in range(3)]
+        rv = self.client.post('/api/boards/{}/cards/move'.format(
+            self.board['id']), headers=self.headers, json={'moves': [
+                {'id': ids[2], 'column_id': self.won},
+                {'id': ids[0], 'column_id': self.won, 'after_id': ids[2]}]})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(self.titles(), [['1'], ['2', '0']])
+
+    def test_rebalance(self):
+        first = self.add_card('first')
+        for i in range(60):
+            first = self.add_card(str(i), before_id=first)
+        ranks = [card.rank for card in Card.query.order_by(Card.rank)]
+        self.assertLessEqual(max(len(rank) for rank in ranks),
+                             Card.MAX_RANK_LENGTH)
+        self.assertEqual(self.titles()[0][:2], ['59', '58'])
+
+    def test_load_board_in_one_query(self):
+        self.add_card('a')
+        db.session.expire_all()
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        sa.event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            with self.app.test_request_context():
+                board, columns = Board.load(self.board['id'])
+                data = board.to_dict(columns)
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual([len(c['cards']) for c in data['columns']], [1, 0])
+
+    def test_invalid_fields(self):
+        a = self.add_card('a')
+        url = '/api/boards/{}/cards'.format(self.board['id'])
+        for data in ({'owner_id': 'abc'}, {'owner_id': 999},
+                     {'column_id': 'x'}, {'after_id': [a]},
+                     {'value': 'NaN'}, {'value': '1e20'}, {'title': 5}):
+            rv = self.client.post(url, headers=self.headers, json=dict(
+                {'title': 'x', 'column_id': self.open}, **data))
+            self.assertEqual(rv.status_code, 400, data)
+        rv = self.client.put('/api/cards/{}'.format(a), headers=self.headers,
+                             json={'before_id': 'x'})
+        self.assertEqual(rv.status_code, 400)
+        rv = self.client.post('/api/boards/{}/cards/move'.format(
+            self.board['id']), headers=self.headers, json={'moves': [
+                {'id': str(a), 'column_id': self.won}]})
+        self.assertEqual(rv.status_code, 400)
+        with mock.patch('app.models.rank_between', side_effect=ValueError):
+            rv = self.client.put('/api/cards/{}'.format(a),
+                                 headers=self.headers,
+                                 json={'column_id': self.won})
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(self.add_card('b', owner_id=self.susan.id) - a, 1)
+
+    def test_other_owner(self):
+        headers = {'Authorization': 'Bearer ' + self.susan.get_token()}
+        db.session.commit()
+        rv = self.client.get('/api/boards/{}'.format(self.board['id']),
+                             headers=headers)
+        self.assertEqual(rv.status_code, 403)
+
+
+class PipelineRollupCase(unittest.TestCase):
+    setUp = BoardAPICase.setUp
+    tearDown = BoardAPICase.tearDown
+    add_card = BoardAPICase.add_card
+
+    def pipeline(self):
+        rv = self.client.get('/api/boards/{}/pipeline'.format(
+            self.board['id']), headers=self.headers)
+        self.assertEqual(rv.status_code, 200)
+        return rv.get_json()
+
+    def test_incremental(self):
+        a = self.add_card('a', value=100)
+        b = self.add_card('b', value='50.5')
+        self.add_card('c', column_id=self.won, status='won', value=10)
+        self.client.put('/api/cards/{}'.format(b), headers=self.headers,
+                        json={'column_id': self.won, 'status': 'won'})
+        self.client.put('/api/cards/{}'.format(a), headers=self.headers,
+                        json={'value': 80})
+        self.client.delete('/api/cards/{}'.format(a), headers=self.headers)
+        data = self.pipeline()
+        today = datetime.utcnow().date().isoformat()
+        self.assertEqual(data['stage'], {
+            str(self.won): {'count': 2, 'value': '60.50'}})
+        self.assertEqual(data['status'], {
+            'won': {'count': 2, 'value': '60.50'}})
+        self.assertEqual(data['owner'], {})
+        self.assertEqual(data['created'][today]['count'], 2)
+        self.assertEqual(data['won'][today]['count'], 2)
+
+        self.add_card('d', value=5)
+        incremental = self.pipeline()
+        with self.app.test_request_context():
+            PipelineRollup.rebuild()
+            db.session.commit()
+        self.assertEqual(self.pipeline(), incremental)
+        self.assertEqual(incremental['owner'], {
+            str(self.john.id): {'count': 1, 'value': '5.00'}})
+
+    def test_rebuild_command(self):
+        self.add_card('a', value=1)
+        PipelineRollup.query.delete()
+        db.session.commit()
+        runner = self.app.test_cli_runner()
+        cli.register(self.app)
+        result = runner.invoke(args=['crm', 'rollups', 'rebuild'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(self.pipeline()['stage'], {
+            str(self.open): {'count': 1, 'value': '1.00'}})
+
+    def test_invalid_status(self):
+        rv = self.client.post('/api/boards/{}/cards'.format(
+            self.board['id']), headers=self.headers, json={
+                'title': 'a', 'column_id': self.open, 'status': 'maybe'})
+        self.assertEqual(rv.status_code, 400)
+
+
+class DirectoryCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        db.session.add_all([self.john, User(username='Johanna',
+                                            email='jo@example.com')])
+        db.session.commit()
+        self.headers = {'Authorization': 'Bearer ' + self.john.get_token()}
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def autocomplete(self, q):
+        rv = self.client.get('/api/users/autocomplete?q=' + q,
+                             headers=self.headers)
+        return [user['username'] for user in rv.get_json()['items']]
+
+    def test_negative_check(self):
+        # until the directory is rebuilt it can't tell what is missing
+        self.assertTrue(directory.may_exist('username', 'susan'))
+        self.assertEqual(directory.rebuild(), 2)
+        with mock.patch.object(User, 'query') as query:
+            self.assertFalse(User.username_taken('susan'))
+            self.assertFalse(User.email_taken('susan@example.com'))
+        query.filter_by.assert_not_called()
+        self.assertTrue(User.username_taken('john'))
+        self.assertTrue(User.email_taken('jo@example.com'))
+        # whether another case is the same name is up to the database
+        self.assertTrue(directory.may_exist('username', 'John'))
+        self.assertTrue(directory.may_exist('email', 'JO@example.com'))
+
+    def test_stale_directory(self):
+        directory.rebuild()
+        # a user the directory does not know about
+        db.session.execute(User.__table__.insert().values(
+            username='susan', email='susan@example.com'))
+        db.session.commit()
+        self.assertFalse(User.username_taken('susan'))
+        rv = self.client.post('/api/users', json={
+            'username': 'susan', 'email': 'other@example.com',
+            'password': 'cat'})
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(rv.get_json()['message'],
+                         'please use a different username')
+        rv = self.client.put('/api/users/{}'.format(self.john.id),
+                             headers=self.headers,
+                             json={'email': 'susan@example.com'})
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(rv.get_json()['message'],
+                         'please use a different email address')
+
+    def test_changes_during_rebuild(self):
+        entry = directory.entry
+        committed = []
+
+        def scan(value, id):
+            # a user that was already read is renamed during the rebuild
+            if not committed:
+                committed.append(True)
+                self.john.username = 'jack'
+                db.session.commit()
+            return entry(value, id)
+        with mock.patch('app.directory.entry', side_effect=scan):
+            self.assertEqual(directory.rebuild(batch_size=1), 2)
+        self.assertEqual(directory.lookup('username', 'jack'),
+                         [('jack', self.john.id)])
+
+    def test_failed_update_during_rebuild(self):
+        from redis.exceptions import ConnectionError
+        entry = directory.entry
+
+        def scan(value, id):
+            # an update fails while the rebuild is running
+            with mock.patch.object(self.app.redis, 'pipeline',
+                                   side_effect=ConnectionError):
+                directory.update([('username', None, 'lost')])
+            return entry(value, id)
+        with mock.patch('app.directory.entry', side_effect=scan):
+            self.assertIsNone(directory.rebuild())
+        self.assertIsNone(directory.lookup('username', 'john'))
+
+    def test_autocomplete_before_rebuild(self):
+        self.assertIsNone(directory.search('jo'))
+        self.assertEqual(self.autocomplete('jo'), ['Johanna', 'john'])
+        directory.rebuild()
+        self.app.redis.delete(directory.READY_KEY)
+        self.app.redis.delete(directory.KEYS['username'])
+        self.assertEqual(self.autocomplete('jo'), ['Johanna', 'john'])
+
+    def test_kept_up_to_date(self):
+        directory.rebuild()
+        rv = self.client.post('/api/users', json={
+            'username': 'susan', 'email': 'susan@example.com',
+            'password': 'cat'})
+        self.assertEqual(rv.status_code, 201)
+        self.assertTrue(User.username_taken('susan'))
+        self.assertEqual(self.autocomplete('J'), ['Johanna', 'john'])
+        self.assertEqual(self.autocomplete('su'), ['susan'])
+        self.john.username = 'jack'
+        db.session.commit()
+        self.assertEqual(self.autocomplete('jo'), ['Johanna'])
+        self.assertEqual(self.autocomplete('ja'), ['jack'])
+        self.assertFalse(User.username_taken('john'))
+        db.session.delete(User.query.filter_by(username='Johanna').first())
+        db.session.commit()
+        self.assertEqual(self.autocomplete('jo'), [])
+        self.assertFalse(User.email_taken('jo@example.com'))
+
+    def test_redis_down(self):
+        directory.rebuild()
+        self.app.redis = BrokenRedis()
+        self.assertTrue(User.username_taken('john'))
+        self.assertEqual(self.autocomplete('jo'), ['Johanna', 'john'])
+        db.session.add(User(username='susan', email='susan@example.com'))
+        db.session.commit()
+        self.app.redis = fakeredis.FakeStrictRedis()
+        # the failed update turned negative checks off
+        self.assertIsNone(directory.lookup('username', 'susan'))
+
+    def test_repair(self):
+        from redis.exceptions import ConnectionError
+        from app.tasks import repair_directory
+        self.assertIn('repair_directory', scheduler.jobs)
+        repair_directory()
+        self.assertEqual(directory.lookup('username', 'john'),
+                         [('john', self.john.id)])
+        with mock.patch('app.directory.rebuild') as rebuild:
+            repair_directory()
+        rebuild.assert_not_called()
+        # an update fails and turns the directory off until the next run
+        with mock.patch.object(self.app.redis, 'pipeline',
+                               side_effect=ConnectionError):
+            self.john.username = 'jack'
+            db.session.commit()
+        self.assertIsNone(directory.lookup('username', 'jack'))
+        repair_directory()
+        self.assertEqual(directory.lookup('username', 'jack'),
+                         [('jack', self.john.id)])
+
+
+class RecommendationCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.users = {}
+        for name in ('john', 'susan', 'mary', 'david', 'ann'):
+            self.users[name] = User(username=name,
+                                    email=name + '@example.com')
+            db.session.add(self.users[name])
+        db.session.commit()
+        for follower, followed in (('john', 'susan'), ('susan', 'mary'),
+                                   ('david', 'susan'), ('david', 'mary'),
+                                   ('david', 'ann'), ('mary', 'david')):
+            self.users[follower].follow(self.users[followed])
+        db.session.commit()
+        self.headers = {'Authorization': 'Bearer ' +
+                        self.users['john'].get_token()}
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def suggestions(self):
+        rv = self.client.get('/api/recommendations', headers=self.headers)
+        self.assertEqual(rv.status_code, 200)
+        ids = {user.id: name for name, user in self.users.items()}
+        return [(ids[item['id']], item['score'])
+                for item in rv.get_json()['items']]
+
+    def test_scores(self):
+        self.assertEqual(recommendations.refresh(), 5)
+        # mary is followed by susan and by david, who also follows susan
+        self.assertEqual(self.suggestions(), [('mary', 1.5), ('ann', 0.5)])
+
+    def test_follow_events(self):
+        recommendations.refresh()
+        # the users that followed someone in setUp
+        self.assertEqual(recommendations.refresh_dirty(), 4)
+        self.users['john'].follow(self.users['mary'])
+        db.session.commit()
+        # the followed user is gone right away
+        self.assertEqual(self.suggestions(), [('ann', 0.5)])
+        self.assertEqual(recommendations.refresh_dirty(), 1)
+        # mary follows david, and david, who follows the same people as
+        # john now, follows ann
+        self.assertEqual(sorted(self.suggestions()),
+                         [('ann', 1.0), ('david', 1.0)])
+        self.assertEqual(recommendations.refresh_dirty(), 0)
+
+    def test_failed_refresh_is_retried(self):
+        self.users['john'].follow(self.users['mary'])
+        db.session.commit()
+        dirty = self.app.redis.smembers(recommendations.DIRTY_KEY)
+        with mock.patch('app.recommendations.store', side_effect=IOError):
+            with self.assertRaises(IOError):
+                recommendations.refresh_dirty()
+        self.assertEqual(self.app.redis.smembers(recommendations.DIRTY_KEY),
+                         dirty)
+
+    def test_redis_down(self):
+        self.app.redis = BrokenRedis()
+        self.assertEqual(self.suggestions(), [])
+
+
+class RateLimitCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['RATELIMIT_ENABLED'] = True
+        self.app.config['RATELIMITS'] = {'POST auth.login': '3/minute',
+                                         'api': '5/second'}
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, addr='10.0.0.1'):
+        return self.client.post('/auth/login', data={},
+                                environ_base={'REMOTE_ADDR': addr})
+
+    def test_token_bucket(self):
+        self.assertEqual([self.login().status_code for i in range(4)],
+                         [200, 200, 200, 429])
+        rv = self.login()
+        self.assertEqual(rv.status_code, 429)
+        self.assertEqual(rv.headers['Retry-After'], '20')
+        # other clients and other methods have buckets of their own
+        self.assertEqual(self.login('10.0.0.2').status_code, 200)
+        self.assertEqual(self.client.get('/auth/login').status_code, 200)
+        with mock.patch('app.ratelimit.time', return_value=time() + 20):
+            self.assertEqual(self.login().status_code, 200)
+
+    def test_api_error(self):
+        statuses = [self.client.get('/api/users/1').status_code
+                    for i in range(6)]
+        self.assertEqual(statuses[-1], 429)
+        rv = self.client.get('/api/users/1')
+        self.assertEqual(rv.get_json(), {'error': 'Too Many Requests'})
+        self.assertEqual(rv.headers['Retry-After'], '1')
+
+    def test_api_identity(self):
+        user = User(username='john', email='john@example.com')
+        db.session.add(user)
+        token = user.get_token()
+        db.session.commit()
+        # made up tokens don't get buckets of their own
+        statuses = [self.client.get('/api/users/1', headers={
+            'Authorization': 'Bearer made-up-{}'.format(i)}).status_code
+            for i in range(6)]
+        self.assertEqual(statuses, [401] * 5 + [429])
+        rv = self.client.get('/api/users/1',
+                             headers={'Authorization': 'Bearer ' + token})
+        self.assertEqual(rv.status_code, 200)
+
+    def test_limit_applies_before_the_request_is_logged(self):
+        # every request in an application context of its own, so that the
+        # request id and start time of an earlier one are not around
+        self.app_context.pop()
+        try:
+            responses = [self.client.get('/api/users/1') for i in range(6)]
+        finally:
+            self.app_context.push()
+        self.assertEqual(responses[-1].status_code, 429)
+        self.assertEqual(len(responses[-1].headers['X-Request-ID']), 32)
+
+    def test_local_fallback(self):
+        self.app.redis = BrokenRedis()
+        self.assertEqual([self.login().status_code for i in range(4)],
+                         [200, 200, 200, 429])
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)